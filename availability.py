@@ -0,0 +1,105 @@
+"""Craftable and researchable sets, kept up to date from the items that changed"""
+
+from craft import max_craftable
+from utils import recipe_index
+
+class AvailabilityIndex():
+    """
+    Reverse indexes over the game data, built once per data set.
+
+    recipe_users: item -> recipes whose crafting tree reads the item, at any depth
+    tech_users:   potion -> techs that need it
+    dependents:   tech -> techs that list it as a prerequisite
+    """
+    def __init__(self, data):
+        index = recipe_index(data.recipes)
+        self.recipe_users = {}
+        for name in index.ingredients:
+            # walk the whole crafting tree, has_items can go down to any of these
+            seen = set()
+            stack = [name]
+            while stack:
+                for ingredient, _ in index.ingredients[stack.pop()]:
+                    if ingredient not in seen:
+                        seen.add(ingredient)
+                        self.recipe_users.setdefault(ingredient, set()).add(name)
+                        if ingredient in index.ingredients:
+                            stack.append(ingredient)
+        self.tech_users = {}
+        self.dependents = {}
+        for tech, t in data.technology.items():
+            for potion in t['research_unit_ingredients']:
+                self.tech_users.setdefault(potion['name'], set()).add(tech)
+            for preq in t['prerequisites']:
+                self.dependents.setdefault(preq, set()).add(tech)
+
+_indexes = {}
+
+def availability_index(data):
+    entry = _indexes.get(id(data.recipes))
+    if entry is None or entry[0] is not data.recipes:
+        entry = (data.recipes, AvailabilityIndex(data))
+        _indexes[id(data.recipes)] = entry
+    return entry[1]
+
+class Availability():
+    """
+    What the player can craft and research, for a Sim.
+
+    The sim reports every inventory item it changes with touch(), and research
+    with researched(). Answers are only worked out again for the recipes and
+    techs that read a changed item, the next time someone asks.
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.index = availability_index(sim.data)
+        self.reset()
+
+    def reset(self):
+        # the whole state was replaced, start over
+        sim = self.sim
+        self.frontier = {tech for tech in sim.data.technology if tech not in sim.current_tech and sim.preqs_researched(tech)}
+        self.max_craft = {}
+        self.ready = {}
+        self.dirty = set()
+
+    def touch(self, item):
+        self.dirty.add(item)
+
+    def touch_all(self, items):
+        self.dirty.update(items)
+
+    def researched(self, tech):
+        sim = self.sim
+        self.frontier.discard(tech)
+        self.ready.pop(tech, None)
+        for dependent in self.index.dependents.get(tech, ()):
+            if dependent not in sim.current_tech and sim.preqs_researched(dependent):
+                self.frontier.add(dependent)
+        # unlocked recipes change what every crafting tree can use
+        self.max_craft.clear()
+
+    def refresh(self):
+        for item in self.dirty:
+            for recipe in self.index.recipe_users.get(item, ()):
+                self.max_craft.pop(recipe, None)
+            for tech in self.index.tech_users.get(item, ()):
+                self.ready.pop(tech, None)
+        self.dirty.clear()
+
+    def all_researchable(self):
+        return set(self.frontier)
+
+    def researchable_all(self):
+        self.refresh()
+        for tech in self.frontier:
+            if tech not in self.ready:
+                self.ready[tech] = self.sim.researchable(tech)[0] == 0
+        return {tech: self.ready[tech] for tech in sorted(self.frontier)}
+
+    def craftable_all(self):
+        self.refresh()
+        for item in self.sim.current_recipes:
+            if item not in self.max_craft:
+                self.max_craft[item] = max_craftable(self.sim, item)
+        return {item: self.max_craft[item] for item in sorted(self.sim.current_recipes)}
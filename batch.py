@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""Runs many factorio-cli scripts, or variants of one, each against its own Sim across CPU cores"""
+
+from concurrent.futures import ProcessPoolExecutor
+from string import Template
+import argparse
+import itertools
+import json
+import os
+import time
+
+from commands import CommandRunner
+from files import load_files
+from metrics import Timings
+from sim import Sim, ENGINES
+
+STARTUP_SCRIPT = 'scripts/startup.txt'
+
+# game data loaded once per worker process
+worker_data = None
+
+def init_worker():
+    global worker_data
+    worker_data = load_files()
+
+def run_job(job):
+    """Run one script from a fresh game, returns the result of the run as a dict"""
+    name, lines, engine = job
+    if worker_data is None:
+        init_worker()
+    start = time.perf_counter()
+    sim = Sim(worker_data, engine)
+    runner = CommandRunner(sim)
+    if os.path.exists(STARTUP_SCRIPT):
+        with open(STARTUP_SCRIPT) as startup:
+            runner.run_lines(startup.readlines())
+    results = runner.run_lines(lines)
+    return {
+        'name': name,
+        'game_time': sim.game_time,
+        'launches': runner.launches,
+        'commands': len(results),
+        'errors': [(line, msg) for line, res, msg in results if res != 0],
+        'seconds': time.perf_counter() - start,
+        # command -> [calls, seconds], startup script included
+        'timings': runner.timings.totals,
+        'state': json.loads(sim.serialize_state()),
+    }
+
+def make_jobs(scripts, params, engine='dict'):
+    """
+    One job per script per combination of params.
+    Scripts can use $name placeholders, params maps each name to a list of values.
+    """
+    names = list(params)
+    jobs = []
+    for script in scripts:
+        with open(script) as f:
+            template = Template(f.read())
+        for values in itertools.product(*(params[name] for name in names)):
+            variant = dict(zip(names, values))
+            label = script + ''.join(f' {k}={v}' for k, v in variant.items())
+            lines = template.safe_substitute(variant).splitlines()
+            jobs.append((label, lines, engine))
+    return jobs
+
+def run_batch(jobs, workers=None):
+    """Run all jobs, results come back in the same order as the jobs"""
+    if workers == 1 or len(jobs) == 1:
+        return [run_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        return list(pool.map(run_job, jobs))
+
+def parse_params(args):
+    """['minutes=30,60', 'drills=4'] -> {'minutes': ['30', '60'], 'drills': ['4']}"""
+    params = {}
+    for arg in args:
+        name, _, values = arg.partition('=')
+        if not name or not values:
+            raise argparse.ArgumentTypeError(f'expected name=value[,value...], got {arg}')
+        params[name] = values.split(',')
+    return params
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run factorio-cli scripts in parallel, without a server')
+    parser.add_argument('scripts', nargs='+', help='script files, same commands as the shell')
+    parser.add_argument('-p', '--param', action='append', default=[], help='name=v1,v2,... replaces $name in the scripts, one run per value')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes, defaults to the number of CPUs')
+    parser.add_argument('-e', '--engine', default='dict', choices=ENGINES)
+    parser.add_argument('-t', '--timings', action='store_true', help='report the time spent per command, over all runs')
+    parser.add_argument('-o', '--out', help='write every result including its state to this file, one JSON object per line')
+    args = parser.parse_args()
+
+    jobs = make_jobs(args.scripts, parse_params(args.param), args.engine)
+    start = time.perf_counter()
+    results = run_batch(jobs, args.workers)
+    elapsed = time.perf_counter() - start
+
+    if args.out:
+        with open(args.out, 'w') as out:
+            for result in results:
+                out.write(json.dumps(result) + '\n')
+    for result in results:
+        print(f"{result['name']}: game time {result['game_time']}s, {result['launches']} launches, "
+              f"{len(result['errors'])}/{result['commands']} commands failed, {result['seconds']:.2f}s")
+    print(f'{len(results)} runs in {elapsed:.2f}s')
+    if args.timings:
+        timings = Timings()
+        for result in results:
+            timings.merge(result['timings'])
+        print(timings.report())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for the simulation hot paths, results are written to a JSON file for comparing commits"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+from commands import CommandRunner
+from craft import craftable, has_items
+from files import load_files
+from sim import Sim, ENGINES
+from utils import shopping_list, tech_needed
+
+SAVE_FILE = 'fullgame_save.json'
+SCRIPT_FILE = 'fullgame_script.txt'
+DEFAULT_OUT = 'bench_results.json'
+# slower than this ratio of the old median counts as a regression
+REGRESSION = 1.10
+
+def measure(fn, setup=None, min_time=0.5, min_runs=5):
+    """Run fn until both min_time and min_runs are reached, setup runs untimed before every call"""
+    times = []
+    total = 0
+    while total < min_time or len(times) < min_runs:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        total += elapsed
+    return {
+        'runs': len(times),
+        'best': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+    }
+
+def benchmarks(data_dict, save, script, engine):
+    """name -> (fn, setup) for every benchmark, all against the factory in the full game save"""
+    data = SimpleNamespace(**data_dict)
+    sim = Sim(data_dict, engine)
+    sim.deserialize_state(save)
+
+    def reload():
+        sim.deserialize_state(save)
+
+    def next_step():
+        # compile the production plan first so only the run is measured
+        reload()
+        sim.production_plan()
+
+    def replay():
+        runner = CommandRunner(Sim(data_dict, engine))
+        with contextlib.redirect_stdout(io.StringIO()):
+            runner.run_lines(script)
+
+    # big enough orders that crafting has to go a few levels deep
+    sh = shopping_list(data.recipes, {'assembling-machine-2': 2000})
+    return {
+        'load_files': (load_files, None),
+        'sim.next': (lambda: sim.next(60), next_step),
+        'sim.next_cold': (lambda: sim.next(60), reload),
+        'sim.production': (sim.production, next_step),
+        'craft.craftable': (lambda: craftable(sim, 'electric-mining-drill', 500), reload),
+        'craft.has_items': (lambda: has_items(sim, sh, sim.current_items.copy()), reload),
+        'utils.shopping_list': (lambda: shopping_list(data.recipes, {'rocket-silo': 1, 'rocket-part': 100}), None),
+        'utils.tech_needed': (lambda: tech_needed(data.technology, 'rocket-silo'), None),
+        'sim.all_researchable': (sim.all_researchable, reload),
+        'sim.serialize_state': (sim.serialize_state, reload),
+        'sim.deserialize_state': (reload, None),
+        'replay.fullgame_script': (replay, None),
+    }
+
+def run(names, engine, min_time):
+    data_dict = load_files()
+    with open(SAVE_FILE) as save_file:
+        save = save_file.read()
+    with open(SCRIPT_FILE) as script_file:
+        script = script_file.readlines()
+    results = {}
+    for name, (fn, setup) in benchmarks(data_dict, save, script, engine).items():
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = measure(fn, setup, min_time)
+        print(f"{name:<28} {results[name]['median'] * 1000:10.3f} ms  ({results[name]['runs']} runs)")
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(old_file, new_file):
+    """Print the median of every benchmark in both files, returns True if anything got slower"""
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print(f"{'benchmark':<28} {old['commit']:>12} {new['commit']:>12}  ratio")
+    regressed = False
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['median'], result['median']
+        ratio = after / before
+        flag = ''
+        if ratio > REGRESSION:
+            flag = '  <- slower'
+            regressed = True
+        print(f'{name:<28} {before * 1000:10.3f}ms {after * 1000:10.3f}ms  {ratio:.2f}x{flag}')
+    return regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the simulation hot paths')
+    parser.add_argument('names', nargs='*', help='only run benchmarks with one of these in their name')
+    parser.add_argument('-o', '--out', default=DEFAULT_OUT, help=f'results file, defaults to {DEFAULT_OUT}')
+    parser.add_argument('-e', '--engine', default='dict', choices=ENGINES)
+    parser.add_argument('-t', '--min-time', type=float, default=0.5, help='least seconds to spend on each benchmark')
+    parser.add_argument('-c', '--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    results = run(args.names, args.engine, args.min_time)
+    with open(args.out, 'w') as out:
+        json.dump({
+            'commit': git_commit(),
+            'time': time.time(),
+            'python': platform.python_version(),
+            'engine': args.engine,
+            'results': results,
+        }, out, indent=4)
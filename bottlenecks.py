@@ -0,0 +1,92 @@
+"""Why machine groups made less than they could, recorded from the production plan's traces"""
+
+from collections import deque
+
+from plan import MINER
+
+# a group's state in a tick is one byte: it ran at its potential, was held back by
+# its rate limit, or was starved, STARVED + i meaning by the i-th bottleneck ingredient
+FULL = 0
+CAPPED = 1
+STARVED = 2
+
+def states(plan, trace):
+    """One state byte per machine group of plan, from the trace of a run"""
+    out = bytearray(len(trace))
+    for i, (entry, (potential, capped, a, actual, _, reads)) in enumerate(zip(plan.entries, trace)):
+        if entry[1] == MINER or actual >= potential:
+            continue
+        if a < capped:
+            bottleneck = entry[5]
+            # the ingredient that ran out first, same ratio the plan takes the min of
+            j = min(range(len(bottleneck)), key=lambda j: reads[j] // bottleneck[j][1])
+            out[i] = STARVED + j
+        else:
+            out[i] = CAPPED
+    return bytes(out)
+
+class Layout():
+    """The machine groups of a production plan, what the state bytes of a tick refer to"""
+    def __init__(self, plan):
+        self.plan = plan
+        self.keys = list(plan.keys)
+        self.ingredients = [[x for x, _ in entry[5]] for entry in plan.entries]
+
+class Bottlenecks():
+    """
+    A state byte per machine group for every tick the factory ran, the latest size
+    rows of them. A row is a tick of seconds at game time start, or a stretch fast
+    forward skipped over: count ticks, every period ticks from start on.
+
+    Off until enabled, a sim with it off only pays for checking the flag. Going
+    back in game time drops the rows after it, like timeseries.TimeSeries.
+    """
+    def __init__(self, size=4096, enabled=False):
+        self.enabled = enabled
+        # (start, seconds, count, period, layout, states)
+        self.rows = deque(maxlen=size)
+        self.layout = None
+
+    def record(self, plan, start, seconds, trace, count=1, period=1):
+        if self.layout is None or self.layout.plan is not plan:
+            self.layout = Layout(plan)
+        self.rows.append((start, seconds, count, period, self.layout, states(plan, trace)))
+
+    def truncate(self, time):
+        while self.rows and row_end(self.rows[-1]) > time:
+            self.rows.pop()
+
+    def clear(self):
+        self.rows.clear()
+
+    def summary(self, start=None, end=None):
+        """
+        Per machine group, seconds spent in each state between game times start
+        and end, worst first. latest is the group's state in the latest tick.
+        """
+        groups = {}
+        for row in self.rows:
+            t, seconds, count, period, layout, row_states = row
+            if (start is not None and row_end(row) <= start) or (end is not None and t >= end):
+                continue
+            for key, ingredients, state in zip(layout.keys, layout.ingredients, row_states):
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = {'machine': key, 'seconds': 0, 'full': 0, 'capped': 0, 'starved': {}, 'latest': None}
+                spent = seconds * count
+                group['seconds'] += spent
+                if state == FULL:
+                    group['full'] += spent
+                    group['latest'] = 'full'
+                elif state == CAPPED:
+                    group['capped'] += spent
+                    group['latest'] = 'capped'
+                else:
+                    x = ingredients[state - STARVED]
+                    group['starved'][x] = group['starved'].get(x, 0) + spent
+                    group['latest'] = f'starved:{x}'
+        return sorted(groups.values(), key=lambda g: g['full'] - g['seconds'])
+
+def row_end(row):
+    start, seconds, count, period, _, _ = row
+    return start + seconds * (count - 1) * period + seconds
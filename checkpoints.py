@@ -0,0 +1,122 @@
+"""Checkpoints of a sim's state, to rewind to without replaying the commands before them"""
+
+from collections import defaultdict
+
+from deltas import SECTIONS
+
+class Checkpoint():
+    """
+    The state after command index. sections holds a read only copy of every
+    state section, sections that didn't change are the same objects as in the
+    checkpoint before.
+    """
+    def __init__(self, index, command, game_time, sections):
+        self.index = index
+        self.command = command
+        self.game_time = game_time
+        self.sections = sections
+
+    def summary(self):
+        return {'index': self.index, 'command': self.command, 'game_time': self.game_time}
+
+class Checkpoints():
+    """
+    A checkpoint after every command that changed the state of a Sim.
+
+    Whoever runs commands calls record() after each one. Only the sections the
+    sim touched since the previous checkpoint get copied, see deltas.Changes.
+    The latest size checkpoints are kept one per command, every time there are
+    more the older half is thinned out to every other one.
+    """
+    def __init__(self, sim, size=128):
+        self.sim = sim
+        self.size = size
+        # commands that changed the state so far
+        self.index = 0
+        self.points = []
+        self.record('start')
+
+    def marks(self):
+        # a section changed when it was touched, or a key showed up by reading a defaultdict
+        changes = self.sim.changes
+        return {
+            section: (changes.base, changes.counts[section], len(getattr(self.sim, section)))
+            for section in SECTIONS
+        }
+
+    def record(self, command):
+        """Checkpoint the state after command, unless the state didn't change"""
+        sim = self.sim
+        if self.points and sim.version == self.version:
+            return None
+        if self.points:
+            self.index += 1
+        marks = self.marks()
+        sections = {}
+        for section in SECTIONS:
+            if self.points and marks[section] == self.last_marks[section]:
+                sections[section] = self.points[-1].sections[section]
+            else:
+                sections[section] = copy(getattr(sim, section))
+        point = Checkpoint(self.index, command, sim.game_time, sections)
+        self.points.append(point)
+        self.version, self.last_marks = sim.version, marks
+        if len(self.points) > self.size:
+            half = len(self.points) // 2
+            self.points[:half] = self.points[:half:2]
+        return point
+
+    def rewind(self, index=None, game_time=None):
+        """
+        Restore the latest checkpoint at or before command index and game_time,
+        the checkpoints after it are dropped. Returns the checkpoint, None if
+        there is no such checkpoint.
+        """
+        for i in range(len(self.points) - 1, -1, -1):
+            point = self.points[i]
+            if (index is None or point.index <= index) and (game_time is None or point.game_time <= game_time):
+                break
+        else:
+            return None
+        del self.points[i + 1:]
+        s = point.sections
+        self.sim.update_state(
+            point.game_time,
+            set(s['current_tech']),
+            set(s['current_recipes']),
+            defaultdict(int, s['current_items']),
+            defaultdict(int, s['machines']),
+            dict(s['limited_items']),
+        )
+        # the sim is the checkpoint again, the next one can share with it
+        self.index = point.index
+        self.version, self.last_marks = self.sim.version, self.marks()
+        return point
+
+    def undo(self, n=1):
+        """Rewind to before the last n commands that changed the state"""
+        return self.rewind(index=self.index - n)
+
+    def summary(self):
+        return [point.summary() for point in self.points]
+
+    def fork(self, sim):
+        """
+        Checkpoints for sim, a fork of this sim, see Sim.fork. They start with
+        the latest checkpoint, shared, if the state didn't change since.
+        """
+        if self.sim.version != self.version or self.marks() != self.last_marks:
+            return Checkpoints(sim, self.size)
+        forked = Checkpoints.__new__(Checkpoints)
+        forked.sim = sim
+        forked.size = self.size
+        forked.index = 0
+        last = self.points[-1]
+        forked.points = [Checkpoint(0, 'start', last.game_time, last.sections)]
+        forked.version, forked.last_marks = sim.version, forked.marks()
+        return forked
+
+def copy(section):
+    if isinstance(section, (set, frozenset)):
+        return frozenset(section)
+    return dict(section)
@@ -1,103 +1,523 @@
 """requests client library. glue between cli and server running the simulation"""
 
-import requests
 import json
 import os
 
+from commands import CommandRunner, SIM_COMMANDS
+from craft import craftable as sim_craftable
+from deltas import delta as sim_delta
+from errors import FactorioError, SaveFileError
+import solver
+import whatif
+
 #path = "https://factorio-cli.replit.app/"
 #path = "http://127.0.0.1:5000/"
 path = os.getenv('SERVER_URL')
+# the server keeps a separate game per session token
+session = os.getenv('SESSION_TOKEN')
 
 # todo some obvious way to client source code to correponding server source code
 # why does source code not have hyperlinks to more code
 # put the endpoint as its formatted on the server here, so it's easy to cross reference
+class HttpBackend():
+  """Talks to a server running the simulation"""
+  def __init__(self, path, session=None):
+    # imported here, the local backend never needs requests
+    import requests
+    # one session for every call, connections are kept alive between commands
+    self.http = requests.Session()
+    self.http.hooks['response'].append(self.remember_state)
+    if session is not None:
+      self.http.headers['X-Session'] = session
+    self.path = path
+    # game time and state version as of the last response from the server
+    self.game_time = None
+    self.version = None
+
+  def remember_state(self, r, *args, **kwargs):
+    if 'X-Game-Time' in r.headers:
+      self.game_time = float(r.headers['X-Game-Time'])
+      self.version = int(r.headers['X-State-Version'])
+
+  def last_game_time(self):
+    # every response carries the game time, only ask when nothing was sent yet
+    if self.game_time is None:
+      return self.get_game_time()
+    return self.game_time
+
+  def state_version(self):
+    if self.version is None:
+      self.get_game_time()
+    return self.version
+
+  def get_game_time(self):
+    # /time
+    r = self.http.get(f'{self.path}time')
+    r.raise_for_status()
+    return float(r.text)
+
+  def launch(self):
+    r = self.http.post(f'{self.path}launch')
+    return r.text
+
+  def clear(self):
+    # /clear
+    r = self.http.post(f'{self.path}clear')
+    r.raise_for_status()
+
+  def spawn(self, item, amount):
+    # /spawn
+    r = self.http.post(f'{self.path}spawn?item={item}&amount={amount}')
+    r.raise_for_status()
+
+  def get_inventory(self):
+    # /inventory
+    r = self.http.get(f'{self.path}inventory')
+    r.raise_for_status()
+    return r.json()
+
+  def research(self, technology):
+    # /research
+    r = self.http.post(f'{self.path}research?technology={technology}')
+    return r.text
+
+  def researchable(self, technology):
+    # /researchable
+    r = self.http.post(f'{self.path}researchable?technology={technology}')
+    return r.text
+
+  def place(self, machine, item, amount):
+    r = self.http.post(f'{self.path}place?machine={machine}&item={item}&amount={amount}')
+    return r.text
+
+  def next(self, minutes, step=None):
+    # /next
+    url = f'{self.path}next?minutes={minutes}'
+    if step is not None:
+      url += f'&step={step}'
+    r = self.http.post(url)
+    r.raise_for_status()
+
+  def craft(self, item, amount):
+    r = self.http.post(f'{self.path}craft?item={item}&amount={amount}')
+    return r.text
+
+  def craftable(self, item, amount):
+    r = self.http.get(f'{self.path}craftable?item={item}&amount={amount}')
+    return r.text
+
+  def craftable_all(self):
+    # /craftable_all
+    r = self.http.get(f'{self.path}craftable_all')
+    r.raise_for_status()
+    return r.json()
+
+  def researchable_all(self):
+    # /researchable_all
+    r = self.http.get(f'{self.path}researchable_all')
+    r.raise_for_status()
+    return r.json()
+
+  def mine(self, resource, amount):
+    r = self.http.post(f'{self.path}mine?resource={resource}&amount={amount}')
+    return r.text
+
+  def cookbook(self):
+    r = self.http.get(f'{self.path}cookbook')
+    return r.text
+
+  def limits(self):
+    r = self.http.get(f'{self.path}limits')
+    return r.text
+
+  def suggest(self):
+    r = self.http.get(f'{self.path}suggest')
+    return r.text
+
+  def production(self):
+    r = self.http.get(f'{self.path}production')
+    return r.text
+
+  def limit(self, item, amount):
+    r = self.http.post(f'{self.path}limit?item={item}&amount={amount}')
+    return r.text
+
+  def prio(self, machine,item,old,new):
+    r = self.http.post(f'{self.path}prio?machine={machine}&item={item}&oldprio={old}&newprio={new}')
+    return r.text
+
+  def state(self, binary=False):
+    if binary:
+      r = self.http.get(f'{self.path}state?format=binary')
+      r.raise_for_status()
+      return r.content
+    r = self.http.get(f'{self.path}state')
+    return r.text
+
+  def delta(self, since=None):
+    # /delta, the response is gzipped when it's big
+    r = self.http.get(f'{self.path}delta', params={'since': since})
+    r.raise_for_status()
+    return r.json()
+
+  def series(self, resolution='1m', start=None, end=None, items=None):
+    # /series as csv
+    params = {'resolution': resolution, 'start': start, 'end': end, 'format': 'csv'}
+    if items:
+      params['items'] = ','.join(items)
+    r = self.http.get(f'{self.path}series', params=params)
+    r.raise_for_status()
+    return r.text
+
+  def solve(self, targets, per='minute', recipes=None):
+    # /solve, the error message when the targets can't be made
+    params = {'targets': ','.join(f'{item}:{rate}' for item, rate in targets.items()), 'per': per}
+    params['recipe'] = [f'{item}:{recipe}' for item, recipe in (recipes or {}).items()]
+    r = self.http.get(f'{self.path}solve', params=params)
+    return r.json() if r.ok else r.text
+
+  def bottlenecks(self, start=None, end=None):
+    # /bottlenecks
+    r = self.http.get(f'{self.path}bottlenecks', params={'start': start, 'end': end})
+    r.raise_for_status()
+    return r.json()
+
+  def what_if(self, candidates, minutes=10, step=1):
+    # /whatif
+    r = self.http.post(f'{self.path}whatif', json={'candidates': candidates, 'minutes': minutes, 'step': step})
+    return r.json() if r.ok else r.text
+
+  def record_bottlenecks(self, enabled=True):
+    r = self.http.post(f'{self.path}bottlenecks', params={'enabled': int(enabled)})
+    r.raise_for_status()
+    return r.json()['enabled']
+
+  def update(self, state):
+    if isinstance(state, bytes):
+      # a binary save, see savefile.py
+      r = self.http.post(f'{self.path}update', data=state, headers={"Content-Type": "application/octet-stream"})
+      return r.text
+    headers = {
+        "Content-Type": "application/json"
+    }
+    r = self.http.post(f'{self.path}update', data=json.dumps(state), headers=headers)
+    return r.text
+
+  def batch(self, commands, stop_on_error=False):
+    # /batch
+    r = self.http.post(f'{self.path}batch', json={'commands': commands, 'stop_on_error': stop_on_error})
+    r.raise_for_status()
+    return r.json()['results']
+
+  def checkpoints(self):
+    # /checkpoints
+    r = self.http.get(f'{self.path}checkpoints')
+    r.raise_for_status()
+    return r.json()['checkpoints']
+
+  def rewind(self, index=None, game_time=None):
+    # /rewind
+    r = self.http.post(f'{self.path}rewind', params={'index': index, 'time': game_time})
+    return r.json() if r.ok else r.text
+
+  def undo(self, n=1):
+    # /undo
+    r = self.http.post(f'{self.path}undo?n={n}')
+    return r.json() if r.ok else r.text
+
+class LocalBackend():
+  """Runs the simulation in this process, gives the same answers as the server endpoints"""
+  def __init__(self, sim):
+    self.sim = sim
+
+  def record(self, command):
+    # checkpoint like the server does after every request
+    self.sim.checkpoints.record(command)
+
+  def get_game_time(self):
+    return float(self.sim.game_time)
+
+  def last_game_time(self):
+    return float(self.sim.game_time)
+
+  def state_version(self):
+    return self.sim.version
+
+  def launch(self):
+    launched = self.sim.launch()
+    self.record('launch')
+    if launched:
+      return '3. 2. 1. LIFT OFF!!! GG'
+    return 'NOT ENOUGH ROCKET PARTS'
+
+  def clear(self):
+    self.sim.clear()
+    self.record('clear')
+
+  def spawn(self, item, amount):
+    self.sim.place_in_inventory(item, int(amount))
+    self.record(f'spawn {item} {amount}')
+
+  def get_inventory(self):
+    return dict(self.sim.current_items)
+
+  def research(self, technology):
+    res, msg = self.sim.research(technology)
+    self.record(f'research {technology}')
+    return msg
+
+  def researchable(self, technology):
+    res, msg = self.sim.researchable(technology)
+    return 'pog' if res == 0 else msg
+
+  def place(self, machine, item, amount):
+    res, msg = self.sim.place_machine(machine, item, int(amount))
+    self.record(f'place {machine} {item} {amount}')
+    return 'pog' if res == 0 else msg
+
+  def next(self, minutes, step=None):
+    if step is None:
+      self.sim.next(int(minutes) * 60)
+    else:
+      self.sim.fast_forward(int(minutes) * 60, int(step) * 60)
+    self.record(f'next {minutes}')
+
+  def craft(self, item, amount):
+    res, msg = self.sim.craft(item, int(amount))
+    self.record(f'craft {item} {amount}')
+    return 'pog' if res == 0 else msg
+
+  def craftable(self, item, amount):
+    res, missing, available, not_enough_item = sim_craftable(self.sim, item, int(amount))
+    return 'pog' if res == 0 else 'not pog'
+
+  def craftable_all(self):
+    return self.sim.craftable_all()
+
+  def researchable_all(self):
+    return self.sim.researchable_all()
+
+  def mine(self, resource, amount):
+    res, msg = self.sim.mine(resource, int(amount))
+    self.record(f'mine {resource} {amount}')
+    return 'pog' if res == 0 else msg
+
+  def cookbook(self):
+    return '\n'.join(self.sim.current_recipes)
+
+  def limits(self):
+    return '\n'.join(self.sim.limited_items)
+
+  def suggest(self):
+    return '\n'.join(self.sim.all_researchable())
+
+  def production(self):
+    # the server sends this as json
+    return json.dumps(self.sim.production())
+
+  def limit(self, item, amount):
+    self.sim.set_limit(item, int(amount))
+    self.record(f'limit {item} {amount}')
+    return 'pog'
+
+  def prio(self, machine,item,old,new):
+    self.sim.set_machine_prio(machine, item, int(old), int(new))
+    self.record(f'prio {machine} {item} {old} {new}')
+    return 'prio set'
+
+  def state(self, binary=False):
+    if binary:
+      return self.sim.serialize_binary()
+    return self.sim.serialize_state()
+
+  def delta(self, since=None):
+    return sim_delta(self.sim, since)
+
+  def series(self, resolution='1m', start=None, end=None, items=None):
+    return self.sim.series.to_csv(resolution, start, end, items)
+
+  def solve(self, targets, per='minute', recipes=None):
+    try:
+      return solver.solve(self.sim.data, targets, self.sim.machines, recipes, solver.parse_per(per))
+    except FactorioError as e:
+      return str(e)
+
+  def bottlenecks(self, start=None, end=None):
+    return {'enabled': self.sim.bottlenecks.enabled, 'groups': self.sim.bottlenecks.summary(start, end)}
+
+  def what_if(self, candidates, minutes=10, step=1):
+    try:
+      return whatif.evaluate(self.sim, whatif.parse_candidates(candidates), minutes * 60, step * 60)
+    except ValueError as e:
+      return str(e)
+
+  def record_bottlenecks(self, enabled=True):
+    self.sim.bottlenecks.enabled = enabled
+    if not enabled:
+      self.sim.bottlenecks.clear()
+    return enabled
+
+  def update(self, state):
+    try:
+      if isinstance(state, bytes):
+        self.sim.deserialize_binary(state)
+      else:
+        self.sim.deserialize_state(state)
+    except SaveFileError as e:
+      return str(e)
+    self.record('load')
+    return ''
+
+  def batch(self, commands, stop_on_error=False):
+    runner = CommandRunner(self.sim, SIM_COMMANDS)
+    results = runner.run_lines(commands, stop_on_error)
+    return [{'command': command, 'res': res, 'msg': msg} for command, res, msg in results]
+
+  def checkpoints(self):
+    return self.sim.checkpoints.summary()
+
+  def rewind(self, index=None, game_time=None):
+    point = self.sim.checkpoints.rewind(index, game_time)
+    return 'no checkpoint that far back' if point is None else point.summary()
+
+  def undo(self, n=1):
+    point = self.sim.checkpoints.undo(int(n))
+    return 'no checkpoint that far back' if point is None else point.summary()
+
+backend = None
+# answers that only change along with the game state, name -> (state version, answer)
+cache = {}
+
+def use_backend(new_backend):
+  """Send every call below to new_backend, a HttpBackend or LocalBackend"""
+  global backend
+  backend = new_backend
+  cache.clear()
+
+def cached(name, fetch):
+  # fetch again only once the state version moved on
+  if name not in cache or cache[name][0] != state_version():
+    answer = fetch()
+    cache[name] = (state_version(), answer)
+  return cache[name][1]
+
+def get_backend():
+  # talk to the server at SERVER_URL unless told otherwise
+  if backend is None:
+    use_backend(HttpBackend(path, session))
+  return backend
+
 def get_game_time():
-  # /time
-  r = requests.get(f'{path}time') 
-  r.raise_for_status()
-  return float(r.text) 
+  return get_backend().get_game_time()
+
+def last_game_time():
+  return get_backend().last_game_time()
+
+def state_version():
+  return get_backend().state_version()
 
 def launch():
-  r = requests.post(f'{path}launch')
-  return r.text
+  return get_backend().launch()
 
 def clear():
-  # /clear
-  r = requests.post(f'{path}clear')
-  r.raise_for_status()
+  get_backend().clear()
 
 def spawn(item, amount):
-  # /spawn
-  r = requests.post(f'{path}spawn?item={item}&amount={amount}')
-  r.raise_for_status()
+  get_backend().spawn(item, amount)
 
 def get_inventory():
-  # /inventory
-  r = requests.get(f'{path}inventory')
-  r.raise_for_status()
-  return r.json()
+  return get_backend().get_inventory()
 
 def research(technology):
-  # /research
-  r = requests.post(f'{path}research?technology={technology}')
-  return r.text
+  return get_backend().research(technology)
 
 def researchable(technology):
-  # /researchable
-  r = requests.post(f'{path}researchable?technology={technology}')
-  return r.text
+  return get_backend().researchable(technology)
 
 def place(machine, item, amount):
-  r = requests.post(f'{path}place?machine={machine}&item={item}&amount={amount}')
-  return r.text
+  return get_backend().place(machine, item, amount)
 
-def next(minutes):
-  r = requests.post(f'{path}next?minutes={minutes}')
-  r.raise_for_status()
+def next(minutes, step=None):
+  get_backend().next(minutes, step)
 
 def craft(item, amount):
-  r = requests.post(f'{path}craft?item={item}&amount={amount}')
-  return r.text
+  return get_backend().craft(item, amount)
 
 def craftable(item, amount):
-  r = requests.get(f'{path}craftable?item={item}&amount={amount}')
-  return r.text
+  return get_backend().craftable(item, amount)
+
+def craftable_all():
+  """item -> most of it that can be crafted right now, for every unlocked recipe"""
+  return cached('craftable_all', get_backend().craftable_all)
+
+def researchable_all():
+  """tech -> whether it can be researched right now, for every tech with its prerequisites done"""
+  return cached('researchable_all', get_backend().researchable_all)
 
 def mine(resource, amount):
-  r = requests.post(f'{path}mine?resource={resource}&amount={amount}')
-  return r.text
+  return get_backend().mine(resource, amount)
 
 def cookbook():
-  r = requests.get(f'{path}cookbook')
-  return r.text
+  return get_backend().cookbook()
 
 def limits():
-  r = requests.get(f'{path}limits')
-  return r.text
+  return get_backend().limits()
 
 def suggest():
-  r = requests.get(f'{path}suggest')
-  return r.text
+  return get_backend().suggest()
 
 def production():
-  r = requests.get(f'{path}production')
-  return r.text
+  return get_backend().production()
 
 def limit(item, amount):
-  r = requests.post(f'{path}limit?item={item}&amount={amount}')
-  return r.text
+  return get_backend().limit(item, amount)
 
 def prio(machine,item,old,new):
-  r = requests.post(f'{path}prio?machine={machine}&item={item}&oldprio={old}&newprio={new}')
-  return r.text
+  return get_backend().prio(machine, item, old, new)
+
+def state(binary=False):
+  """The save file as json text, or as binary save bytes"""
+  return get_backend().state(binary)
+
+def delta(since=None):
+  """Changes to the state after version since, apply them with deltas.apply_delta"""
+  return get_backend().delta(since)
+
+def series(resolution='1m', start=None, end=None, items=None):
+  """Recorded production between game times start and end as csv, resolution is one of timeseries.RESOLUTIONS"""
+  return get_backend().series(resolution, start, end, items)
+
+def solve(targets, per='minute', recipes=None):
+  """Machines needed to make targets (item -> amount every per), see solver.solve. A dict on success and the error otherwise"""
+  return get_backend().solve(targets, per, recipes)
+
+def bottlenecks(start=None, end=None):
+  """Per machine group, seconds it ran full, capped by its limit or starved (by ingredient) between game times start and end"""
+  return get_backend().bottlenecks(start, end)
 
-def state():
-  r = requests.get(f'{path}state')
-  return r.text
+def what_if(candidates, minutes=10, step=1):
+  """Each candidate (a command or a list of them) tried on its own fork for minutes, see whatif.evaluate. A dict on success and the error otherwise"""
+  return get_backend().what_if(candidates, minutes, step)
+
+def record_bottlenecks(enabled=True):
+  """Start or stop recording bottlenecks, stopping forgets what was recorded"""
+  return get_backend().record_bottlenecks(enabled)
 
 def update(state):
-  headers = {
-      "Content-Type": "application/json"
-  }
-  r = requests.post(f'{path}update', data=json.dumps(state), headers=headers)
-  return r.text
\ No newline at end of file
+  # json text or binary save bytes
+  return get_backend().update(state)
+
+def checkpoints():
+  """Every checkpoint rewind() can go back to, oldest first"""
+  return get_backend().checkpoints()
+
+def rewind(index=None, game_time=None):
+  """Back to the latest checkpoint at or before command index and game_time, a dict on success and the error otherwise"""
+  return get_backend().rewind(index, game_time)
+
+def undo(n=1):
+  return get_backend().undo(n)
+
+def batch(commands, stop_on_error=False):
+  """Run script lines in one go, returns a {'command', 'res', 'msg'} dict per command that ran"""
+  return get_backend().batch(commands, stop_on_error)
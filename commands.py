@@ -0,0 +1,329 @@
+"""Run shell script commands directly against a Sim, without the shell or the server"""
+
+import argparse
+import json
+import shlex
+import time
+
+from shortcuts import convert_aliases
+from metrics import Timings
+import savefile
+
+# shell commands that only display something, they never change the simulation
+DISPLAY_COMMANDS = {'wish', 'tech_needed', 'help', 'history', 'set', 'shortcuts', 'macro', 'edit', 'shell', 'py', 'ipy', 'quit', 'eof'}
+MINEABLE = ['stone', 'coal', 'iron-ore', 'copper-ore']
+# commands that only touch the simulation, safe to run for a remote client
+SIM_COMMANDS = ('mine', 'craft', 'place', 'next', 'research', 'limit', 'prio', 'spawn', 'launch', 'clear', 'undo', 'rewind')
+
+class CommandError(Exception):
+    """A command line that the shell would refuse to run"""
+    pass
+
+def positive_int(value):
+    # argparse type for steps, next -s 0 would never get anywhere
+    n = int(value)
+    if n <= 0:
+        raise argparse.ArgumentTypeError(f'has to be positive, got {n}')
+    return n
+
+# the arguments of every command that takes some, as (names, add_argument kwargs).
+# the shell's parsers and CommandRunner are both made from these, see make_parser
+ARGUMENTS = {
+    'spawn': [
+        (('item',), {'help': 'item type to spawn in'}),
+        (('amount',), {'type': int, 'help': 'amount of the given item to be spawned in'}),
+    ],
+    'research': [
+        (('tech',), {'help': 'name of technology to research'}),
+    ],
+    'prio': [
+        (('machine',), {'help': 'machine type of the machines'}),
+        (('item',), {'help': 'item type the machines produce'}),
+        (('old',), {'type': int, 'help': 'priority the machine has now'}),
+        (('new',), {'type': int, 'help': 'priority to move one machine to'}),
+    ],
+    'place': [
+        (('machine',), {'help': 'machine type to be placed'}),
+        (('item',), {'help': 'item type this machine will generate'}),
+        (('amount',), {'type': int, 'default': 1, 'nargs': '?', 'help': 'number of machines to place with the given config'}),
+    ],
+    'next': [
+        (('minutes',), {'type': int, 'default': 1, 'nargs': '?', 'help': 'the number of minutes to run the simulation for'}),
+        (('-s', '--step'), {'type': positive_int, 'help': 'simulate in steps of this many minutes, same as calling next STEP over and over'}),
+    ],
+    'mine': [
+        (('resource',), {'choices': MINEABLE, 'help': 'resource type'}),
+        (('amount',), {'type': int, 'help': 'amount of the given resource to be mined'}),
+    ],
+    'craft': [
+        (('item',), {'help': 'item type'}),
+        (('amount',), {'nargs': '?', 'default': 1, 'type': int, 'help': 'amount of the given item, defaults to 1'}),
+    ],
+    'limit': [
+        (('item',), {'help': 'item type'}),
+        (('amount',), {'nargs': '?', 'default': 1, 'type': int, 'help': 'amount of the given item, defaults to 1'}),
+    ],
+    'undo': [
+        (('n',), {'type': int, 'default': 1, 'nargs': '?', 'help': 'the number of commands to undo, defaults to 1'}),
+    ],
+    'rewind': [
+        (('index',), {'type': int, 'nargs': '?', 'help': 'go back to the state after this command, see checkpoints'}),
+        (('-t', '--time'), {'type': float, 'help': 'go back to the state at this game time (in seconds)'}),
+    ],
+    'save': [
+        (('file',), {'help': 'path to save file'}),
+    ],
+    'load': [
+        (('file',), {'help': 'path to save file'}),
+    ],
+    'run_script': [
+        (('file',), {'help': 'path to script file'}),
+    ],
+}
+ARGUMENTS['@'] = ARGUMENTS['run_script']
+
+class ScriptParser(argparse.ArgumentParser):
+    """Parses the arguments of a script line, raises CommandError where the shell would print usage"""
+    def __init__(self, **kwargs):
+        super().__init__(add_help=False, **kwargs)
+
+    def error(self, message):
+        raise CommandError(message)
+
+    def exit(self, status=0, message=None):
+        raise CommandError(message or f'{self.prog} exited')
+
+def make_parser(command, parser_class=ScriptParser, **extra):
+    """
+    A parser for the arguments of command. extra adds add_argument kwargs by
+    argument name, e.g. the shell's choices_provider for tab completion.
+    """
+    parser = parser_class(prog=command)
+    for names, kwargs in ARGUMENTS[command]:
+        parser.add_argument(*names, **kwargs, **extra.get(names[-1].lstrip('-'), {}))
+    return parser
+
+# command -> ScriptParser, made the first time a script uses the command
+script_parsers = {}
+
+def script_parser(command):
+    parser = script_parsers.get(command)
+    if parser is None:
+        parser = script_parsers[command] = make_parser(command)
+    return parser
+
+class CommandRunner():
+    """
+    Runs lines of a factorio-cli script against a Sim the same way the shell would.
+
+    Arguments are parsed with the same definitions as the shell parsers, see
+    ARGUMENTS, and lines the shell would reject don't touch the simulation. cmd2 aliases made with
+    `alias create` are expanded, and anything after a pipe or redirect is dropped.
+    Saves are kept in memory by file name, loads fall back to reading the file.
+    If allowed is given, every other command is refused. timings adds up the time
+    every command took, see metrics.Timings.report.
+    """
+    def __init__(self, sim, allowed=None):
+        self.sim = sim
+        self.allowed = allowed
+        self.aliases = {}
+        self.saves = {}
+        self.launches = 0
+        self.timings = Timings()
+        self.handlers = {
+            'craft': self.craft,
+            'mine': self.mine,
+            'place': self.place,
+            'next': self.next,
+            'research': self.research,
+            'limit': self.limit,
+            'prio': self.prio,
+            'spawn': self.spawn,
+            'launch': self.launch,
+            'clear': self.clear,
+            'undo': self.undo,
+            'rewind': self.rewind,
+            'checkpoints': self.checkpoints,
+            'prod': self.prod,
+            'inventory': self.inventory,
+            'time': self.time,
+            'cookbook': self.cookbook,
+            'limits': self.limits,
+            'suggest': self.suggest,
+            'save': self.save,
+            'load': self.load,
+            'alias': self.alias,
+            'run_script': self.run_script,
+            '@': self.run_script,
+        }
+        if allowed is not None:
+            self.handlers = {k: v for k, v in self.handlers.items() if k in allowed}
+
+    def run(self, line):
+        """Run one script line, returns res, msg like the sim functions"""
+        try:
+            args = self.parse(line)
+        except (CommandError, ValueError) as e:
+            return 1, str(e)
+        if not args:
+            return 0, None
+        command, args = args[0], args[1:]
+        if command in DISPLAY_COMMANDS and self.allowed is None:
+            return 0, None
+        if command not in self.handlers:
+            return 1, f'{command} is not a recognized command'
+        start = time.perf_counter()
+        try:
+            if command in ARGUMENTS:
+                return self.handlers[command](script_parser(command).parse_args(args))
+            return self.handlers[command](*args)
+        except CommandError as e:
+            return 1, str(e)
+        except Exception as e:
+            # the server answers these with an error, the script keeps going
+            return 1, f'{command}: {e!r}'
+        finally:
+            # something to rewind to, if the command changed the state
+            self.sim.checkpoints.record(line.strip())
+            self.timings.add(command, time.perf_counter() - start)
+
+    def run_lines(self, lines, stop_on_error=False):
+        """Run script lines in order, returns a (line, res, msg) tuple for every command"""
+        results = []
+        for line in lines:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            res, msg = self.run(line)
+            results.append((line.rstrip('\n'), res, msg))
+            if res != 0 and stop_on_error:
+                break
+        return results
+
+    def parse(self, line):
+        args = shlex.split(line, comments=True)
+        # aliases can point to other aliases, like cmd2 stop once one repeats
+        seen = set()
+        while args and args[0] in self.aliases and args[0] not in seen:
+            seen.add(args[0])
+            args = self.aliases[args[0]] + args[1:]
+        # output redirection and pipes don't change what the command does
+        for i, arg in enumerate(args):
+            if arg in ('|', '>', '>>'):
+                args = args[:i]
+                break
+        return convert_aliases(args)
+
+    # ---- sim commands, args are parsed from ARGUMENTS
+    def craft(self, args):
+        res, msg = self.sim.craft(args.item, args.amount)
+        return res, msg or 'pog'
+
+    def mine(self, args):
+        res, msg = self.sim.mine(args.resource, args.amount)
+        return res, msg or 'pog'
+
+    def place(self, args):
+        res, msg = self.sim.place_machine(args.machine, args.item, args.amount)
+        return res, msg or 'pog'
+
+    def next(self, args):
+        if args.step is None:
+            self.sim.next(args.minutes * 60)
+        else:
+            self.sim.fast_forward(args.minutes * 60, args.step * 60)
+        return 0, None
+
+    def research(self, args):
+        return self.sim.research(args.tech)
+
+    def limit(self, args):
+        self.sim.set_limit(args.item, args.amount)
+        return 0, 'pog'
+
+    def prio(self, args):
+        self.sim.set_machine_prio(args.machine, args.item, args.old, args.new)
+        return 0, 'prio set'
+
+    def spawn(self, args):
+        self.sim.place_in_inventory(args.item, args.amount)
+        return 0, None
+
+    def launch(self):
+        if self.sim.launch():
+            self.launches += 1
+            return 0, '3. 2. 1. LIFT OFF!!! GG'
+        return 1, 'NOT ENOUGH ROCKET PARTS'
+
+    def clear(self):
+        self.sim.clear()
+        return 0, None
+
+    def undo(self, args):
+        return rewound(self.sim.checkpoints.undo(args.n))
+
+    def rewind(self, args):
+        return rewound(self.sim.checkpoints.rewind(args.index, args.time))
+
+    def checkpoints(self):
+        return 0, '\n'.join(f'{p.index} {p.game_time} {p.command}' for p in self.sim.checkpoints.points)
+
+    def prod(self):
+        return 0, self.sim.production()
+
+    # ---- display commands that read the sim
+    def inventory(self):
+        return 0, json.dumps(self.sim.current_items, indent=4)
+
+    def time(self):
+        return 0, self.sim.game_time
+
+    def cookbook(self):
+        return 0, '\n'.join(self.sim.current_recipes)
+
+    def limits(self):
+        return 0, '\n'.join(self.sim.limited_items)
+
+    def suggest(self):
+        return 0, '\n'.join(self.sim.all_researchable())
+
+    # ---- saves and scripts
+    def save(self, args):
+        self.saves[args.file] = self.sim.serialize_state()
+        return 0, None
+
+    def load(self, args):
+        file = args.file
+        if file in self.saves:
+            self.sim.deserialize_state(self.saves[file])
+            return 0, None
+        with open(file, 'rb') as save_file:
+            content = save_file.read()
+        if savefile.is_binary(content):
+            self.sim.deserialize_binary(content)
+        else:
+            self.sim.deserialize_state(content.decode())
+        return 0, None
+
+    def alias(self, action, name=None, *command):
+        if action == 'create':
+            self.aliases[name] = list(command)
+        elif action == 'delete':
+            self.aliases.pop(name, None)
+        return 0, None
+
+    def run_script(self, args):
+        file = args.file
+        try:
+            with open(file) as script:
+                lines = script.readlines()
+        except OSError as e:
+            return 1, f"Problem accessing script from '{file}': {e}"
+        results = self.run_lines(lines)
+        failed = sum(1 for _, res, _ in results if res != 0)
+        return (1 if failed else 0), f'{len(results)} commands, {failed} failed'
+
+def rewound(point):
+    if point is None:
+        return 1, 'no checkpoint that far back'
+    return 0, f'rewound to command {point.index} ({point.command}) at {point.game_time}'
+
@@ -1,53 +1,209 @@
 """Code related to crafting items"""
 
 from collections import defaultdict, Counter
-from utils import * 
+from fractions import Fraction
+import heapq
+import math
+
+from utils import *
+from metrics import timed
 
 # data dependent, not state dependent
 def is_crafting_recipe(sim, item):
     return sim.data.recipes[item]['category'] == 'crafting'
 
+class CraftPlan():
+    """
+    Everything needed to hand craft an order, worked out against the inventory.
+
+    res:       0 -> success
+               1 -> an ordered item can't be hand crafted at all
+               2 -> out of raw material, can't go deeper
+    missing:   item -> amount of every intermediate that has to be crafted first
+    available: item -> amount that gets deducted from the inventory
+    short:     item -> amount the player is missing and can't hand craft
+    msg:       reason the order can't be crafted
+    """
+    def __init__(self, res=0, msg=''):
+        self.res = res
+        self.msg = msg
+        self.missing = {}
+        self.available = {}
+        self.short = {}
+
 # state dependent
 # check if a recipe exists, if the recipe is unlocked, and
 # the player has all the required items
+def plan_craft(sim, order):
+    """CraftPlan for an order of {item: amount}, items in the order can share intermediates"""
+    for item in order:
+        # check if item recipe is unlocked
+        if item not in sim.current_recipes:
+            return CraftPlan(1, f'{item} recipe is locked')
+        # check if crafting recipe
+        if not is_crafting_recipe(sim, item):
+            return CraftPlan(1, f'{item} does not have a crafting recipe')
+    return plan_list(sim, shopping_list(sim.data.recipes, order), sim.current_items)
+
+def plan_list(sim, sh, ci):
+    """
+    CraftPlan for a shopping list(sh) against the inventory ci, ci is not changed.
+
+    One pass over the crafting tree in topological order, see RecipeIndex.hand_order:
+    an item comes up once everything that uses it has, so its whole demand is
+    known. The inventory covers what it can, the rest is crafted in one go,
+    rounded up once, and its ingredients add to the demand of the items below.
+    Items that can't be hand crafted go to short, the first one decides msg.
+    """
+    index = recipe_index(sim.data.recipes)
+    plan = CraftPlan()
+    demand = dict(sh)
+    queue = [(hand_position(index, item), item) for item in demand]
+    heapq.heapify(queue)
+    while queue:
+        _, item = heapq.heappop(queue)
+        amount = demand[item]
+        # get() so reading doesn't add zero keys to the inventory
+        have = max(ci.get(item, 0), 0)
+        if have > 0:
+            plan.available[item] = min(amount, have)
+        if have >= amount:
+            continue
+        n = amount - have
+        if (item not in sim.current_recipes) or (not is_crafting_recipe(sim, item)):
+            if plan.res == 0:
+                plan.res, plan.msg = 2, f'can not craft {item}'
+            plan.short[item] = n
+            continue
+        plan.missing[item] = n
+        crafts = math.ceil(n / index.product_amount[item])
+        for ingredient, per_craft in index.ingredients[item]:
+            if ingredient not in demand:
+                demand[ingredient] = 0
+                heapq.heappush(queue, (hand_position(index, ingredient), ingredient))
+            demand[ingredient] += per_craft * crafts
+    return plan
+
+def hand_position(index, item):
+    # items that can't be hand crafted have no ingredients to wait for, they go last
+    return index.hand_order.get(item, len(index.hand_order))
+
+@timed('craftable')
 def craftable(sim, item, amount):
-    """return type: res, missing, available"""
-    # check if item recipe is unlocked
-    if item not in sim.current_recipes:
-        return 1, None, None, f'{item} recipe is locked' 
-    # check if crafting recipe
-    if not is_crafting_recipe(sim, item):
-        return 1, None, None, f'{item} does not have a crafting recipe'
-    sh = shopping_list(sim.data.recipes, {
-        item: amount
-    }) 
-    # check if the player has the items available to craft
-    return has_items(sim, sh, sim.current_items.copy())
+    """return type: res, missing, available, msg"""
+    plan = plan_craft(sim, {item: amount})
+    if plan.res == 1:
+        return 1, None, None, plan.msg
+    return plan.res, Counter(plan.missing), Counter(plan.available), plan.msg
 
 # given a shopping list(sh) and a copy of current_items(ci)
 # return:
 # res = 0 -> success
-# res = 1 -> missing items go deeper (recursion)
 # res = 2 -> out of raw material, can't go deeper
 # available: a Counter of all items that need to be deducted from inventory
 # missing:   a Counter of all items that need to be crafted
 def has_items(sim, sh, ci):
-    res, missing, available = sim.check_list(sh, ci)
-    # player has all the ingredients in the shopping list in their inventory!
-    if res == 0:
-        return res, missing, available, ''
-
-    # otherwise, we need to recursively craft the intermediate ingredients
-    # check that missing items have unlocked crafting recipes 
-    for item, v in missing.items():
-        if (item not in sim.current_recipes) or (not is_crafting_recipe(sim, item)):
-            return 2, Counter(), Counter(), f'can not craft {item}'
+    plan = plan_list(sim, sh, ci)
+    return plan.res, Counter(plan.missing), Counter(plan.available), plan.msg
+
+def max_craftable(sim, item):
+    """
+    Most of item the player can craft right now, 0 if it can't be crafted.
+
+    One pass over the crafting tree gives how many crafts the inventory would
+    allow if nothing got rounded up: a bound the real count can't go over, and
+    usually is. Checking it is one run of the tree. When rounding up makes it
+    too many, every resource that runs out says how many crafts too many at the
+    rate it's used per craft, and the count steps down by the most of those.
+    """
+    if plan_craft(sim, {item: 1}).res != 0:
+        return 0
+    tree = craft_tree(sim, item)
+    crafts = max(bound(tree, sim.current_items), 1)
+    over = overrun(tree, sim.current_items, crafts)
+    while over:
+        # never past 1, the check above found one craft can be made
+        crafts = max(crafts - over, 1)
+        over = overrun(tree, sim.current_items, crafts)
+    # stepping down by whole crafts at a time can go a little too far
+    while overrun(tree, sim.current_items, crafts + 1) == 0:
+        crafts += 1
+    return crafts * tree[0][2]
+
+def craft_tree(sim, item):
+    """
+    Every item crafting item can come down to, in RecipeIndex.hand_order, as
+    (name, ingredients, product_amount). ingredients is None for the items
+    the player can't hand craft, the leaves of the tree.
+    """
+    index = recipe_index(sim.data.recipes)
+    tree = []
+    seen = {item}
+    queue = [(hand_position(index, item), item)]
+    while queue:
+        _, name = heapq.heappop(queue)
+        if name != item and ((name not in sim.current_recipes) or (not is_crafting_recipe(sim, name))):
+            tree.append((name, None, 1))
+            continue
+        tree.append((name, index.ingredients[name], index.product_amount[name]))
+        for ingredient, _ in index.ingredients[name]:
+            if ingredient not in seen:
+                seen.add(ingredient)
+                heapq.heappush(queue, (hand_position(index, ingredient), ingredient))
+    return tree
 
-    # deduct the items that were available from the current copy of inventory
-    for item, v in available.items():
-        ci[item] -= v
+def bound(tree, ci):
+    """
+    Most crafts of the first item in tree that the leaves in ci allow, with
+    crafts not rounded up and intermediates in ci making up for any demand
+    for them, a real plan only needs more. The demand for every item is
+    per_craft * crafts - offset.
+    """
+    per_craft = defaultdict(Fraction)
+    offset = defaultdict(Fraction)
+    most = None
+    for i, (name, ingredients, product_amount) in enumerate(tree):
+        if i == 0:
+            for ingredient, amount in ingredients:
+                per_craft[ingredient] += amount
+            continue
+        have = max(ci.get(name, 0), 0)
+        if ingredients is None:
+            limit = (have + offset[name]) / per_craft[name]
+            most = limit if most is None else min(most, limit)
+            continue
+        for ingredient, amount in ingredients:
+            per_craft[ingredient] += amount * per_craft[name] / product_amount
+            offset[ingredient] += amount * (offset[name] + have) / product_amount
+    return math.floor(most)
 
-    # recursively check the player has the ingredients to craft the missing items
-    res, rest_missing, rest_av, msg = has_items(sim, shopping_list(sim.data.recipes, missing), ci)
-    return res, missing + rest_missing, available + rest_av, msg 
-    
\ No newline at end of file
+def overrun(tree, ci, crafts):
+    """
+    0 if the inventory ci has everything crafts crafts of the first item in
+    tree come down to, the same way plan_list works it out. Otherwise how many
+    crafts too many that is, roughly: the most any leaf is short by divided by
+    how much more of it every extra craft takes at this point.
+    """
+    demand = defaultdict(int)
+    # extra demand per extra craft, for the items that are being crafted
+    rate = defaultdict(Fraction)
+    over = 0
+    for i, (name, ingredients, product_amount) in enumerate(tree):
+        if i == 0:
+            for ingredient, amount in ingredients:
+                demand[ingredient] += amount * crafts
+                rate[ingredient] += amount
+            continue
+        have = max(ci.get(name, 0), 0)
+        short = demand[name] - have
+        if ingredients is None:
+            if short > 0:
+                over = max(over, math.ceil(short / rate[name]))
+            continue
+        if short <= 0:
+            continue
+        n = math.ceil(short / product_amount)
+        for ingredient, amount in ingredients:
+            demand[ingredient] += amount * n
+            rate[ingredient] += amount * rate[name] / product_amount
+    return over
@@ -0,0 +1,92 @@
+"""Versioned changes to a sim's state, so clients can sync without fetching the whole state"""
+
+# parts of the state that are tracked key by key
+SECTIONS = ('current_items', 'machines', 'limited_items', 'current_tech', 'current_recipes')
+
+class Changes():
+    """
+    The keys of each state section that changed, and as of which version.
+
+    The sim reports keys it changes with touch(). They get stamped with the sim's
+    version the next time a delta is asked for, so a key stamped with a version
+    newer than the client's changed after the client synced. Nothing is known
+    from before base, the version of the last time the whole state was replaced.
+    counts goes up on every touch of a section, and is never reset.
+    """
+    def __init__(self, version=0):
+        self.counts = dict.fromkeys(SECTIONS, 0)
+        self.reset(version)
+
+    def reset(self, version):
+        self.base = version
+        self.stamps = {section: {} for section in SECTIONS}
+        self.pending = {section: set() for section in SECTIONS}
+
+    def touch(self, section, keys):
+        self.counts[section] += 1
+        self.pending[section].update(keys)
+
+    def stamp(self, version):
+        for section, keys in self.pending.items():
+            stamps = self.stamps[section]
+            for key in keys:
+                stamps[key] = version
+            keys.clear()
+
+    def since(self, section, version):
+        return sorted(key for key, stamp in self.stamps[section].items() if stamp > version)
+
+def delta(sim, since=None):
+    """
+    What changed in sim after version since, as a json-able dict. It is a full
+    snapshot, with full set, when since is None or older than the sim keeps track of.
+
+    Inventory and machine counts of 0 are left out of snapshots, in a delta they
+    mean the key is gone. Techs and recipes only get added until the next snapshot.
+    """
+    changes = sim.changes
+    changes.stamp(sim.version)
+    full = since is None or since < changes.base or since > sim.version
+    d = {
+        'version': sim.version,
+        'since': None if full else since,
+        'full': full,
+        'game_time': sim.game_time,
+    }
+    if full:
+        d['current_items'] = {k: v for k, v in sorted(sim.current_items.items()) if v != 0}
+        d['machines'] = {k: v for k, v in sim.machines.items() if v != 0}
+        d['limited_items'] = dict(sorted(sim.limited_items.items()))
+        d['current_tech'] = sorted(sim.current_tech)
+        d['current_recipes'] = sorted(sim.current_recipes)
+    else:
+        # get() so reading doesn't add zero keys to the inventory
+        d['current_items'] = {k: sim.current_items.get(k, 0) for k in changes.since('current_items', since)}
+        d['machines'] = {k: sim.machines.get(k, 0) for k in changes.since('machines', since)}
+        d['limited_items'] = {k: sim.limited_items[k] for k in changes.since('limited_items', since)}
+        d['current_tech'] = [k for k in changes.since('current_tech', since) if k in sim.current_tech]
+        d['current_recipes'] = [k for k in changes.since('current_recipes', since) if k in sim.current_recipes]
+    return d
+
+def apply_delta(state, d):
+    """Client side of delta(), returns state brought up to date with d. state is a previous result or None"""
+    if d['full']:
+        state = {k: v for k, v in d.items() if k not in ('since', 'full')}
+        state['current_items'] = dict(state['current_items'])
+        state['machines'] = dict(state['machines'])
+        state['limited_items'] = dict(state['limited_items'])
+        return state
+    if state is None or state['version'] != d['since']:
+        raise ValueError(f'delta since {d["since"]} does not apply to version {state and state["version"]}')
+    state['version'] = d['version']
+    state['game_time'] = d['game_time']
+    for section in ('current_items', 'machines'):
+        for k, v in d[section].items():
+            if v == 0:
+                state[section].pop(k, None)
+            else:
+                state[section][k] = v
+    state['limited_items'].update(d['limited_items'])
+    for section in ('current_tech', 'current_recipes'):
+        state[section] = sorted(set(state[section]).union(d[section]))
+    return state
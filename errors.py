@@ -10,3 +10,5 @@ class InvalidRecipeError(FactorioError):
     pass
 class CraftingError(FactorioError):
     pass
+class SaveFileError(FactorioError):
+    pass
@@ -0,0 +1,144 @@
+"""Fast forward: many next(step) calls in a number of steps proportional to the events"""
+
+from collections import defaultdict, deque
+from fractions import Fraction
+import math
+
+from plan import MINER
+
+# longest cycle of ticks to look for, and most ticks to go without looking
+MAX_PERIOD = 4
+MAX_WAIT = 32
+
+def fast_forward(plan, ci, ticks, step, record=None):
+    """
+    Same inventory as running plan.run(ci, step) ticks times in a row.
+
+    A few ticks are simulated, then the inventory is treated as a line: if every
+    machine group makes the same amounts again over the last tick (or the last few,
+    factories often settle into alternating between two states), the inventory moves
+    by the same delta every time. The traced groups tell us how long that holds,
+    until an input runs out, a limit is hit or a starved group gets its intermediate,
+    and those ticks are applied at once.
+    Returns the production rates summed over all ticks and the number of ticks that
+    were simulated one at a time.
+    record(trace, tick, count, period) is called with the trace of every tick if
+    given, tick counts from 0. A skipped stretch is recorded once per phase of
+    its cycle, repeated count times every period ticks.
+    """
+    prod_rates = defaultdict(lambda: defaultdict(int))
+    touched = plan.items
+    history = deque(maxlen=MAX_PERIOD)
+    simulated = 0
+    # back off from checking for a steady factory while it keeps changing
+    wait = skip = 0
+    total = ticks
+    while ticks > 0:
+        if skip < MAX_PERIOD:
+            before = [ci[x] for x in touched]
+            trace = []
+            plan.run(ci, step, prod_rates=prod_rates, trace=trace)
+            history.append((trace, [ci[x] - b for x, b in zip(touched, before)]))
+        elif record is not None:
+            trace = []
+            plan.run(ci, step, prod_rates=prod_rates, trace=trace)
+        else:
+            # far from the next check, no need to trace this tick
+            plan.run(ci, step, prod_rates=prod_rates)
+        if record is not None:
+            record(trace, total - ticks, 1, 1)
+        ticks -= 1
+        simulated += 1
+        if ticks == 0:
+            break
+        if skip > 0:
+            skip -= 1
+            if skip >= MAX_PERIOD:
+                history.clear()
+            continue
+        period, repeats = find_period(plan, touched, history, ticks)
+        if repeats == 0:
+            wait = min(MAX_WAIT, wait * 2 or 1)
+            skip = wait
+            continue
+        wait = 0
+        phases = list(history)[-period:]
+        for i, x in enumerate(touched):
+            d = sum(delta[i] for _, delta in phases)
+            if d:
+                ci[x] += d * repeats
+        for i, (trace, _) in enumerate(phases):
+            for entry, (potential, _, _, actual, _, _) in zip(plan.entries, trace):
+                rates = prod_rates[entry[0]]
+                rates['potential'] += potential * repeats
+                rates['actual'] += actual * repeats
+            if record is not None:
+                record(trace, total - ticks + i, repeats, period)
+        ticks -= period * repeats
+        history.clear()
+    return prod_rates, simulated
+
+def find_period(plan, touched, history, ticks):
+    """Shortest run of recent ticks that repeats, and how many more times it does"""
+    for period in range(1, len(history) + 1):
+        if period > ticks:
+            break
+        phases = list(history)[-period:]
+        delta = {x: sum(d[i] for _, d in phases) for i, x in enumerate(touched)}
+        repeats = ticks // period
+        for trace, _ in phases:
+            repeats = min(repeats, steady_ticks(plan, trace, delta, repeats))
+            if repeats == 0:
+                break
+        if repeats > 0:
+            return period, repeats
+    return 0, 0
+
+def steady_ticks(plan, trace, delta, limit):
+    """
+    How many more times every machine group makes exactly what it made in the traced
+    tick, when the inventory it sees moves by delta each time
+    """
+    repeats = limit
+    for entry, (potential, capped, a, actual, stock, reads) in zip(plan.entries, trace):
+        item, kind, _, _, item_limit, bottleneck, _, _, product_amount = entry
+        if kind == MINER:
+            continue
+        # min(potential, headroom) has to pick the same side
+        if item_limit is not None:
+            d = delta[item]
+            if potential <= capped:
+                if potential > 0:
+                    # headroom stays >= potential while stock <= limit - potential
+                    repeats = min(repeats, ticks_at_most(stock, d, math.floor(item_limit - Fraction(potential))))
+            elif capped == 0:
+                # no headroom left, stays that way while stock >= limit
+                repeats = min(repeats, ticks_at_least(stock, d, item_limit))
+            elif d != 0:
+                return 0
+        # min(a, capped) has to pick the same side, with the same bottleneck value
+        if a <= capped:
+            threshold, binding = Fraction(a), 0
+            for (x, amount), value in zip(bottleneck, reads):
+                repeats = min(repeats, ticks_at_least(value, delta[x], amount * math.ceil(threshold / product_amount)))
+                # some ingredient has to keep giving exactly a, it stays in the same multiple of amount
+                if (value // amount) * product_amount == a:
+                    binding = max(binding, ticks_at_most(value, delta[x], amount * (value // amount + 1) - 1))
+            repeats = min(repeats, binding)
+        else:
+            threshold = Fraction(capped)
+            for (x, amount), value in zip(bottleneck, reads):
+                repeats = min(repeats, ticks_at_least(value, delta[x], amount * (math.floor(threshold / product_amount) + 1)))
+        if repeats == 0:
+            return 0
+    return repeats
+
+def ticks_at_least(value, d, minimum):
+    # largest t where value + i * d >= minimum for every i in 1..t
+    if d >= 0:
+        return math.inf if value + d >= minimum else 0
+    return max(0, (value - minimum) // -d)
+
+def ticks_at_most(value, d, maximum):
+    # largest t where value + i * d <= maximum for every i in 1..t
+    return ticks_at_least(-value, -d, -maximum)
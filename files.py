@@ -1,32 +1,85 @@
 from contextlib import ExitStack
 import json
+import os
+import pickle
 
-def load_files():
-    filenames = [
-        'data/recipe.json',
-        'data/technology.json',
-        'data/mining-drill.json',
-        'data/resource.json',
-        'data/furnace.json',
-        'data/assembling-machine.json',
-        'data/rocket-silo.json',
-        'data/machines.json'
-    ]
-    # data will be accessed through key names
-    keys = [
-        'recipes',
-        'technology',
-        'mining_drills',
-        'resources',
-        'furnaces',
-        'assemblers',
-        'rocket_silo',
-        'machines',
-    ]
-    with ExitStack() as stack: 
+FILENAMES = [
+    'data/recipe.json',
+    'data/technology.json',
+    'data/mining-drill.json',
+    'data/resource.json',
+    'data/furnace.json',
+    'data/assembling-machine.json',
+    'data/rocket-silo.json',
+    'data/machines.json'
+]
+# data will be accessed through key names
+KEYS = [
+    'recipes',
+    'technology',
+    'mining_drills',
+    'resources',
+    'furnaces',
+    'assemblers',
+    'rocket_silo',
+    'machines',
+]
+CACHE_DIR = '.cache'
+CACHE_FILE = os.path.join(CACHE_DIR, 'data.pickle')
+# bump when the bundle layout changes, so old caches are rebuilt
+CACHE_VERSION = 1
+
+def load_files(use_cache=True):
+    """
+    Game data as a dict of KEYS -> parsed json. Parsed data is kept in a pickled
+    bundle that is rebuilt whenever one of the json files changes.
+    """
+    if not use_cache:
+        return compact(parse_files())
+    key = cache_key()
+    try:
+        with open(CACHE_FILE, 'rb') as cache:
+            bundle = pickle.load(cache)
+        if bundle['key'] == key:
+            return bundle['data']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError):
+        pass
+    data_dict = compact(parse_files())
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # write to a temporary file first, a half written cache is never read
+        tmp = f'{CACHE_FILE}.{os.getpid()}'
+        with open(tmp, 'wb') as cache:
+            pickle.dump({'key': key, 'data': data_dict}, cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, CACHE_FILE)
+    except OSError:
+        # read only checkout, parse every time
+        pass
+    return data_dict
+
+def parse_files():
+    with ExitStack() as stack:
         files = [
             stack.enter_context(open(filename))
-            for filename in filenames
+            for filename in FILENAMES
         ]
-        data_dict = {keys[i]: json.load(x) for i,x in enumerate(files)}
+        data_dict = {KEYS[i]: json.load(x) for i,x in enumerate(files)}
+    return data_dict
+
+def cache_key():
+    key = [CACHE_VERSION]
+    for filename in FILENAMES:
+        stat = os.stat(filename)
+        key.append((filename, stat.st_mtime_ns, stat.st_size))
+    return key
+
+def compact(data_dict):
+    """Drop the parts of the game data the sim never reads, resource.json is mostly map generation settings"""
+    data_dict['resources'] = {
+        name: {
+            'resource_category': resource['resource_category'],
+            'mineable_properties': {'mining_time': resource['mineable_properties']['mining_time']},
+        }
+        for name, resource in data_dict['resources'].items()
+    }
     return data_dict
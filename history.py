@@ -0,0 +1,204 @@
+"""Request history, the latest entries in memory and all of them in an append only log"""
+
+from collections import deque
+from itertools import islice
+import json
+import os
+import threading
+import time
+
+# the log offset of every this many entries is kept, so old pages don't read the whole file
+INDEX_EVERY = 1024
+# fields a page can filter on, the index knows which values are in every chunk of entries
+KEYS = ('session', 'command')
+
+class RequestLog():
+    """
+    Entries are dicts with an increasing id, the latest size of them are kept
+    in memory. With a path every entry is also appended to that file as a json
+    line, pages older than what's in memory are read back from there. A log left
+    by an earlier run is picked up where it ended.
+
+    The log is read in chunks of INDEX_EVERY entries. Next to it, path.index
+    has a json line for every full chunk, with where it starts and which
+    sessions and commands are in it. Filtered pages skip the chunks without
+    them, and a restart only reads the chunks after the last full one.
+    """
+    def __init__(self, path=None, size=1000):
+        self.entries = deque(maxlen=size)
+        self.path = path
+        self.next_id = 0
+        # offsets[k] -> where the first entry with id >= k * INDEX_EVERY starts in the log
+        self.offsets = []
+        # keys[k] -> the (field, value) pairs of KEYS in chunk k
+        self.keys = []
+        # full chunks written to the index
+        self.sealed = 0
+        self.log = None
+        self.index_log = None
+        self.lock = threading.Lock()
+        if path is not None:
+            self.open_log()
+
+    def open_log(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.log = open(self.path, 'ab+')
+            self.index_log = open(self.path + '.index', 'ab+')
+        except OSError:
+            # read only checkout, keep the history in memory only
+            self.close()
+            return
+        self.load_index()
+        # the entries in memory can start a chunk before the first one that isn't indexed
+        chunk = max(self.sealed - self.entries.maxlen // INDEX_EVERY - 1, 0)
+        offset = self.offsets[chunk] if self.offsets else 0
+        self.log.seek(offset)
+        last = b'\n'
+        for line in self.log:
+            entry = parse(line)
+            if entry is not None:
+                if entry['id'] >= self.sealed * INDEX_EVERY:
+                    self.index(entry, offset)
+                self.entries.append(entry)
+                self.next_id = entry['id'] + 1
+            offset += len(line)
+            last = line
+        if not last.endswith(b'\n'):
+            # a run stopped half way through a line, don't glue the next entry to it
+            self.log.write(b'\n')
+            self.log.flush()
+
+    def load_index(self):
+        size = self.log.seek(0, os.SEEK_END)
+        self.index_log.seek(0)
+        for line in self.index_log:
+            try:
+                chunk = json.loads(line)
+                offset, keys = chunk['offset'], {tuple(key) for key in chunk['keys']}
+            except (ValueError, KeyError, TypeError):
+                break
+            if offset > size or (self.offsets and offset < self.offsets[-1]):
+                # not this log's index, it gets rebuilt
+                self.offsets, self.keys = [], []
+                break
+            self.offsets.append(offset)
+            self.keys.append(keys)
+        if self.offsets and not self.starts_chunk(len(self.offsets) - 1):
+            self.offsets, self.keys = [], []
+        self.sealed = len(self.offsets)
+        # rewrite whatever came after the last good line
+        self.index_log.truncate(0)
+        for offset, keys in zip(self.offsets, self.keys):
+            self.write_index(offset, keys)
+        self.index_log.flush()
+
+    def starts_chunk(self, chunk):
+        # whether the log has the first entry of chunk where the index says
+        self.log.seek(self.offsets[chunk])
+        entry = parse(self.log.readline())
+        return entry is not None and entry['id'] == chunk * INDEX_EVERY
+
+    def write_index(self, offset, keys):
+        self.index_log.write(json.dumps({'offset': offset, 'keys': sorted(keys, key=str)}).encode() + b'\n')
+
+    def index(self, entry, offset):
+        chunk = entry['id'] // INDEX_EVERY
+        while len(self.offsets) <= chunk:
+            self.offsets.append(offset)
+            self.keys.append(set())
+        self.keys[chunk].update((key, entry.get(key)) for key in KEYS)
+        # every chunk before this one is full
+        if self.sealed < chunk:
+            for full in range(self.sealed, chunk):
+                self.write_index(self.offsets[full], self.keys[full])
+            self.index_log.flush()
+            self.sealed = chunk
+
+    def close(self):
+        for f in (self.log, self.index_log):
+            if f is not None:
+                f.close()
+        self.log = self.index_log = None
+
+    def record(self, **fields):
+        """Add an entry with fields, returns it"""
+        with self.lock:
+            entry = {'id': self.next_id, 'time': time.time(), **fields}
+            self.next_id += 1
+            self.entries.append(entry)
+            if self.log is not None:
+                self.index(entry, self.log.seek(0, os.SEEK_END))
+                self.log.write(json.dumps(entry).encode() + b'\n')
+                self.log.flush()
+            return entry
+
+    def last_id(self):
+        return self.next_id - 1
+
+    def page(self, after=None, before=None, limit=100, command=None, session=None):
+        """
+        Up to limit entries, oldest first, for command and session if given.
+        With after, the first ones with a larger id. Otherwise the last ones,
+        with an id below before if given.
+        """
+        keys = {(key, value) for key, value in (('command', command), ('session', session)) if value is not None}
+        def wanted(entry):
+            return all(entry.get(key) == value for key, value in keys)
+        with self.lock:
+            if after is not None:
+                return list(islice(filter(wanted, self.forward(after + 1, keys)), limit))
+            end = self.next_id if before is None else before
+            return list(islice(filter(wanted, self.backward(end, keys)), limit))[::-1]
+
+    def oldest_in_memory(self):
+        return self.entries[0]['id'] if self.entries else self.next_id
+
+    def chunks(self, start, end, keys):
+        # chunks of the log with ids in start..end-1 that have all of keys
+        first = start // INDEX_EVERY
+        last = min(len(self.offsets), (end - 1) // INDEX_EVERY + 1) if end > start else first
+        return [chunk for chunk in range(first, last) if keys <= self.keys[chunk]]
+
+    def forward(self, start, keys=frozenset()):
+        # entries with id >= start, oldest first
+        oldest = self.oldest_in_memory()
+        if self.log is not None:
+            for chunk in self.chunks(start, oldest, keys):
+                for entry in self.read(self.offsets[chunk], min(oldest, (chunk + 1) * INDEX_EVERY)):
+                    if entry['id'] >= start:
+                        yield entry
+        for entry in list(self.entries):
+            if entry['id'] >= start:
+                yield entry
+
+    def backward(self, end, keys=frozenset()):
+        # entries with id < end, newest first
+        for entry in reversed(self.entries):
+            if entry['id'] < end:
+                yield entry
+        end = min(end, self.oldest_in_memory())
+        if self.log is None:
+            return
+        for chunk in reversed(self.chunks(0, end, keys)):
+            stop = min(end, (chunk + 1) * INDEX_EVERY)
+            yield from reversed(list(self.read(self.offsets[chunk], stop)))
+
+    def read(self, offset, stop):
+        # entries in the log from offset on, up to the first with id >= stop
+        with open(self.path, 'rb') as log:
+            log.seek(offset)
+            for line in log:
+                entry = parse(line)
+                if entry is None:
+                    continue
+                if entry['id'] >= stop:
+                    return
+                yield entry
+
+def parse(line):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    return entry if isinstance(entry, dict) and 'id' in entry else None
@@ -2,11 +2,19 @@
 
 """Runs a CLI that interacts with the factorio simulation"""
 
+import logging
+import os
+
 from shell import *
 from files import load_files
 from sim import Sim
 
 if __name__ == "__main__":
+    # LOG_LEVEL=DEBUG shows what the sim is doing, e.g. how long crafts take
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING'))
     data_dict = load_files()
+    if client.path is None:
+        # no server to talk to, run the simulation in this process
+        client.use_backend(client.LocalBackend(Sim(data_dict, os.getenv('SIM_ENGINE', 'dict'))))
     shell = FactorioShell(data_dict)
     shell.cmdloop()
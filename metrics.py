@@ -0,0 +1,177 @@
+"""Timings of the sim functions and server requests, a Prometheus view of them, and an opt in profiler"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import cProfile
+import functools
+import io
+import pstats
+import threading
+import time
+
+# upper bounds in seconds, a request slower than the last one only counts towards +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram():
+    """Observations counted per bucket, plus their sum, the way Prometheus wants them"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (le, observations <= le) for every bucket and +Inf
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield le, total
+
+class Histograms():
+    """A histogram per label value, e.g. per endpoint"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self.lock:
+            histogram = self.histograms.get(label)
+            if histogram is None:
+                histogram = self.histograms[label] = Histogram(self.buckets)
+            histogram.observe(value)
+
+class Timings():
+    """name -> calls and seconds spent, nested calls count towards both names"""
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            total = self.totals.get(name)
+            if total is None:
+                total = self.totals[name] = [0, 0.0]
+            total[0] += 1
+            total[1] += seconds
+
+    def merge(self, totals):
+        for name, (calls, seconds) in totals.items():
+            with self.lock:
+                total = self.totals.setdefault(name, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+
+    def report(self, title='command'):
+        """A table of the names, slowest in total first"""
+        rows = sorted(self.totals.items(), key=lambda kv: -kv[1][1])
+        spent = sum(seconds for _, seconds in self.totals.values()) or 1
+        width = max([len(title)] + [len(name) for name in self.totals])
+        lines = [f'{title:<{width}} {"calls":>8} {"seconds":>10} {"mean ms":>10} {"share":>6}']
+        for name, (calls, seconds) in rows:
+            lines.append(f'{name:<{width}} {calls:>8} {seconds:>10.3f} {1000 * seconds / calls:>10.3f} {100 * seconds / spent:>5.1f}%')
+        return '\n'.join(lines)
+
+# every Sim in this process reports to these
+sim_timings = Timings()
+request_latency = Histograms()
+
+def timed(name):
+    """Count calls of the decorated function and the time they take in sim_timings"""
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                sim_timings.add(name, time.perf_counter() - start)
+        return decorated_function
+    return decorator
+
+class Profiler():
+    """
+    cProfile that can be switched on and off while running. Only one thread can
+    be profiled at a time, so while it's on profiled blocks run one after the other.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.profile = None
+        self.lock = threading.Lock()
+
+    def enable(self):
+        with self.lock:
+            self.profile = cProfile.Profile()
+            self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def profiled(self):
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+
+    def report(self, sort='cumulative', limit=40):
+        """pstats text of everything profiled since enable()"""
+        with self.lock:
+            if self.profile is None:
+                return 'nothing profiled yet\n'
+            out = io.StringIO()
+            try:
+                pstats.Stats(self.profile, stream=out).sort_stats(sort).print_stats(limit)
+            except TypeError:
+                # pstats has nothing to sort when no call was profiled
+                return 'nothing profiled yet\n'
+            return out.getvalue()
+
+profiler = Profiler()
+
+def labels(**values):
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in values.items()) + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus(gauges=()):
+    """
+    Everything above in the Prometheus text format. gauges are extra
+    (name, help, value) tuples, e.g. for the server's sessions.
+    """
+    lines = [
+        '# HELP factorio_request_seconds Time spent answering requests, by endpoint.',
+        '# TYPE factorio_request_seconds histogram',
+    ]
+    with request_latency.lock:
+        for endpoint, histogram in sorted(request_latency.histograms.items()):
+            for le, count in histogram.cumulative():
+                lines.append(f'factorio_request_seconds_bucket{labels(endpoint=endpoint, le=le)} {count}')
+            lines.append(f'factorio_request_seconds_sum{labels(endpoint=endpoint)} {histogram.sum}')
+            lines.append(f'factorio_request_seconds_count{labels(endpoint=endpoint)} {histogram.count}')
+    with sim_timings.lock:
+        totals = sorted(sim_timings.totals.items())
+    lines += [
+        '# HELP factorio_sim_calls_total Calls of the timed sim functions.',
+        '# TYPE factorio_sim_calls_total counter',
+    ]
+    lines += [f'factorio_sim_calls_total{labels(function=name)} {calls}' for name, (calls, _) in totals]
+    lines += [
+        '# HELP factorio_sim_seconds_total Time spent in the timed sim functions, including nested ones.',
+        '# TYPE factorio_sim_seconds_total counter',
+    ]
+    lines += [f'factorio_sim_seconds_total{labels(function=name)} {seconds}' for name, (_, seconds) in totals]
+    for name, help, value in gauges:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
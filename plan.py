@@ -0,0 +1,104 @@
+"""Production plan: the factory compiled into a priority ordered list of machine groups"""
+
+from collections import defaultdict
+import math
+
+from utils import shopping_list
+
+# machine kinds, see data/machines.json
+MINER = 0
+ASSEMBLER = 1
+FURNACE = 2
+
+class ProductionPlan():
+    """
+    Everything next() needs about the placed machines, worked out once.
+
+    Each entry is a tuple of:
+        item        - item the machine group produces
+        kind        - MINER, ASSEMBLER or FURNACE
+        rate        - amount_of_machines * craft_speed * amount_produced
+        energy      - seconds per craft (1 for miners)
+        limit       - rate limit on the item, None if not limited
+        bottleneck  - (ingredient, amount) pairs needed to craft a single item
+        ingredients - (ingredient, amount) pairs consumed per craft, None for resources
+        product     - item placed in the inventory
+        product_amount - amount made per craft
+
+    keys holds the machines key (item:machine:priority) of every entry, and
+    items lists every inventory item a run reads or writes.
+    """
+    def __init__(self, data, machines, limited_items):
+        self.entries = []
+        self.keys = []
+        # ordering of machines processed matters, because inventory is affected immediately
+        # sort by priority! sorted() is stable so ties keep their placement order
+        for machine_item_key, amount in sorted(machines.items(), key=lambda item: int(item[0].split(':')[-1])):
+            item, machine, _ = machine_item_key.split(':')
+            kind = data.machines[machine]
+            self.keys.append(machine_item_key)
+            if kind == MINER:
+                rate = amount * data.mining_drills[machine]['mining_speed'] * 1
+                self.entries.append((item, kind, rate, 1, None, (), None, item, 1))
+                continue
+            recipe = data.recipes[item]
+            product_amount = recipe['products'][0]['amount']
+            speed = data.assemblers[machine]['crafting_speed'] if kind == ASSEMBLER else data.furnaces[machine]['crafting_speed']
+            # furnaces always count a single product per craft
+            rate = amount * speed * (product_amount if kind == ASSEMBLER else 1)
+            limit = limited_items[item] if item in limited_items else None
+            bottleneck = tuple(shopping_list(data.recipes, {item: 1}).items())
+            ingredients = None
+            if item not in data.resources:
+                ingredients = tuple((ing['name'], ing['amount']) for ing in recipe['ingredients'])
+            self.entries.append((item, kind, rate, recipe['energy'], limit, bottleneck, ingredients, recipe['products'][0]['name'], product_amount))
+        items = {}
+        for item, kind, rate, energy, limit, bottleneck, ingredients, product, product_amount in self.entries:
+            items[product] = None
+            items.update((x, None) for x, _ in bottleneck)
+            items.update((x, None) for x, _ in (ingredients or ()))
+            if limit is not None:
+                items[item] = None
+        self.items = list(items)
+
+    def run(self, ci, seconds, first=0, prod_rates=None, trace=None):
+        """
+        Run every machine group once over the given seconds, changing ci in place.
+        first and prod_rates let another engine hand over part way through the plan.
+        If trace is a list, one (potential, capped, a, actual, stock, reads) tuple is
+        appended per machine group, with the inventory it saw before crafting.
+        """
+        if prod_rates is None:
+            prod_rates = defaultdict(lambda: defaultdict(int))
+        entries = self.entries if first == 0 else self.entries[first:]
+        # core algo: for each machine: potential -> actual -> craft
+        for item, kind, rate, energy, limit, bottleneck, ingredients, product, product_amount in entries:
+            # potential = amount_of_machines * craft_speed * seconds // energy
+            potential = rate * (seconds if energy == 1 else (seconds // energy))
+            if kind == MINER:
+                actual = potential
+                if trace is not None:
+                    trace.append((potential, None, None, actual, None, None))
+            else:
+                capped = potential
+                # respect rate limits
+                if limit is not None:
+                    # should almost always be > 0 but if the limit was set after getting a lot of items we could go negative
+                    capped = min(potential, max(0, limit - ci[item]))
+                # find the bottleneck ingredient ratio and multiply by amount produced by recipe
+                # a trace keeps the reads, bottlenecks.py tells the player which one it was
+                a = min([ci[x] // amount for x, amount in bottleneck]) * product_amount
+                actual = min(a, capped)
+                if trace is not None:
+                    trace.append((potential, capped, a, actual, ci[item] if limit is not None else None, [ci[x] for x, _ in bottleneck]))
+            rates = prod_rates[item]
+            rates['potential'] += potential
+            rates['actual'] += actual
+            if ingredients is not None:
+                # amount needed always rounds up, same as shopping_list()
+                crafts = math.ceil(actual / product_amount)
+                for x, amount in ingredients:
+                    ci[x] -= amount * crafts
+            # enfore integral system - avoid very real issues
+            ci[product] += int(actual)
+        return prod_rates
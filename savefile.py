@@ -0,0 +1,235 @@
+"""
+Binary save files, a compact alternative to the json from Sim.serialize_state.
+
+    magic        b'FCSV'
+    format       1 byte
+    data version 8 bytes, hash of the name table below
+    length       varint, bytes in the body
+    checksum     crc32 of the body, 4 bytes little endian
+    body         game time, techs, recipes, inventory, zero entries, machines, limits
+
+Names are interned: every recipe, tech, item and machine in the game data gets
+an id, names the data doesn't know are written out after an id of 0. Counts
+are zigzag varints, non integer numbers are written as doubles. Inventory
+entries of 0 are only listed by id. Everything is sorted the way the json is,
+so the same state always gives the same bytes. Saves can be written one after
+the other into the same stream.
+"""
+
+from hashlib import sha1
+import io
+import json
+import struct
+import zlib
+
+from errors import SaveFileError
+
+MAGIC = b'FCSV'
+FORMAT = 1
+# save files with this ending are written in this format
+EXTENSION = '.fsav'
+
+class NameTable():
+    """name <-> id for a data set, ids start at 1"""
+    def __init__(self, data):
+        names = set(data.recipes) | set(data.technology) | set(data.resources) | set(data.machines)
+        for recipe in data.recipes.values():
+            names.update(x['name'] for x in recipe['ingredients'])
+            names.update(x['name'] for x in recipe['products'])
+        self.names = [None] + sorted(names)
+        self.ids = {name: i for i, name in enumerate(self.names) if i > 0}
+        self.version = sha1('\n'.join(self.names[1:]).encode()).digest()[:8]
+
+_tables = {}
+
+def name_table(data):
+    entry = _tables.get(id(data.recipes))
+    if entry is None or entry[0] is not data.recipes:
+        entry = (data.recipes, NameTable(data))
+        _tables[id(data.recipes)] = entry
+    return entry[1]
+
+class Writer():
+    def __init__(self, table):
+        self.table = table
+        self.out = bytearray()
+
+    def varint(self, n):
+        while n > 0x7f:
+            self.out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        self.out.append(n)
+
+    def number(self, n):
+        # ints as zigzag << 1, anything else as a tag of 1 and a double
+        if isinstance(n, int):
+            zigzag = n << 1 if n >= 0 else (-n << 1) - 1
+            self.varint(zigzag << 1)
+        else:
+            self.varint(1)
+            self.out += struct.pack('<d', n)
+
+    def name(self, name):
+        i = self.table.ids.get(name)
+        if i is None:
+            self.varint(0)
+            raw = name.encode()
+            self.varint(len(raw))
+            self.out += raw
+        else:
+            self.varint(i)
+
+class Reader():
+    def __init__(self, table, body):
+        self.table = table
+        self.body = body
+        self.pos = 0
+
+    def byte(self):
+        if self.pos >= len(self.body):
+            raise SaveFileError('save file ends too early')
+        b = self.body[self.pos]
+        self.pos += 1
+        return b
+
+    def varint(self):
+        n = shift = 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def number(self):
+        tag = self.varint()
+        if tag & 1:
+            value, = struct.unpack_from('<d', self.body, self.pos)
+            self.pos += 8
+            return value
+        n = tag >> 1
+        return (n >> 1) ^ -(n & 1)
+
+    def name(self):
+        i = self.varint()
+        if i == 0:
+            size = self.varint()
+            raw = self.body[self.pos:self.pos + size]
+            self.pos += size
+            return raw.decode()
+        if i >= len(self.table.names):
+            raise SaveFileError(f'unknown name id {i}')
+        return self.table.names[i]
+
+def dumps(state, data, zeros=True):
+    """
+    Bytes for a state dict shaped like json.loads(Sim.serialize_state()).
+    With zeros=False inventory entries of 0 are left out altogether.
+    """
+    table = name_table(data)
+    w = Writer(table)
+    w.number(state['game_time'])
+    for section in ('current_tech', 'current_recipes'):
+        names = sorted(state[section])
+        w.varint(len(names))
+        for name in names:
+            w.name(name)
+    items = sorted(state['current_items'].items())
+    counts = [(k, v) for k, v in items if v != 0]
+    w.varint(len(counts))
+    for k, v in counts:
+        w.name(k)
+        w.number(v)
+    empty = [k for k, v in items if v == 0] if zeros else []
+    w.varint(len(empty))
+    for k in empty:
+        w.name(k)
+    machines = sorted(state['machines'].items())
+    w.varint(len(machines))
+    for key, count in machines:
+        item, machine, prio = key.rsplit(':', 2)
+        w.name(item)
+        w.name(machine)
+        w.number(int(prio))
+        w.number(count)
+    limits = sorted(state['limited_items'].items())
+    w.varint(len(limits))
+    for k, v in limits:
+        w.name(k)
+        w.number(v)
+    body = bytes(w.out)
+    header = Writer(table)
+    header.out += MAGIC + bytes([FORMAT]) + table.version
+    header.varint(len(body))
+    header.out += struct.pack('<I', zlib.crc32(body))
+    return bytes(header.out) + body
+
+def loads(raw, data):
+    """State dict for the bytes of one save, the same dict json.loads gives for the json save"""
+    state = load(io.BytesIO(raw), data)
+    if state is None:
+        raise SaveFileError('empty save file')
+    return state
+
+def dump(state, data, f, zeros=True):
+    f.write(dumps(state, data, zeros))
+
+def load(f, data):
+    """Read the next save from a binary file, None at the end of the file"""
+    head = f.read(len(MAGIC) + 1 + 8)
+    if not head:
+        return None
+    if len(head) < len(MAGIC) + 9 or head[:len(MAGIC)] != MAGIC:
+        raise SaveFileError('not a save file')
+    if head[len(MAGIC)] != FORMAT:
+        raise SaveFileError(f'save file format {head[len(MAGIC)]} is not supported')
+    table = name_table(data)
+    if head[len(MAGIC) + 1:] != table.version:
+        raise SaveFileError('save file was made with different game data')
+    size = 0
+    shift = 0
+    while True:
+        b = f.read(1)
+        if not b:
+            raise SaveFileError('save file ends too early')
+        size |= (b[0] & 0x7f) << shift
+        if b[0] < 0x80:
+            break
+        shift += 7
+    checksum = f.read(4)
+    body = f.read(size)
+    if len(checksum) < 4 or len(body) < size:
+        raise SaveFileError('save file ends too early')
+    if struct.unpack('<I', checksum)[0] != zlib.crc32(body):
+        raise SaveFileError('save file is corrupted, checksum does not match')
+    r = Reader(table, body)
+    state = {'game_time': r.number()}
+    for section in ('current_tech', 'current_recipes'):
+        state[section] = [r.name() for _ in range(r.varint())]
+    items = {}
+    for _ in range(r.varint()):
+        k = r.name()
+        items[k] = r.number()
+    for _ in range(r.varint()):
+        items[r.name()] = 0
+    state['current_items'] = dict(sorted(items.items()))
+    machines = {}
+    for _ in range(r.varint()):
+        item, machine, prio = r.name(), r.name(), r.number()
+        machines[f'{item}:{machine}:{prio}'] = r.number()
+    state['machines'] = machines
+    state['limited_items'] = {}
+    for _ in range(r.varint()):
+        k = r.name()
+        state['limited_items'][k] = r.number()
+    return state
+
+def to_json(raw, data):
+    """The json save for binary save bytes, the same text Sim.serialize_state writes"""
+    return json.dumps(loads(raw, data), sort_keys=True)
+
+def from_json(s_json, data, zeros=True):
+    return dumps(json.loads(s_json), data, zeros)
+
+def is_binary(raw):
+    return raw[:len(MAGIC)] == MAGIC
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""Searches for a short script that reaches a goal, e.g. a rocket launch, and writes it out for the shell"""
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+import argparse
+import math
+import sys
+import time
+
+from commands import CommandRunner, MINEABLE
+from files import load_files
+from sim import Sim, ENGINES
+import solver
+from data import craft_time
+from utils import get_potion_list
+
+# candidate actions per state: how much to mine by hand, the most machines to
+# build of a kind at once, the most of the goal to hand craft at once
+MINE = 20
+BUILD = 2
+CRAFT = 10
+NEXT = (1, 5)
+# the factory is grown to make the goal within this many seconds of running
+HORIZON = 3600
+# raw materials per second the player mines by hand, for the estimate
+HAND_RATE = 1
+
+# game data and a sim to load states into, once per worker process
+worker_data = None
+worker_sim = None
+
+def init_worker(engine='dict'):
+    global worker_data, worker_sim
+    worker_data = load_files()
+    worker_sim = Sim(worker_data, engine)
+
+class Goal():
+    """amount of item in the inventory. 'rocket' is the rocket parts of a launch, and the launch"""
+    def __init__(self, data, item, amount=1):
+        self.launch = item == 'rocket'
+        if self.launch:
+            item, amount = 'rocket-part', solver.ROCKET_PARTS * amount
+        self.item = item
+        self.amount = amount
+        # every recipe on the way, and the cheapest machine kind for each
+        answer = solver.solve(data, {item: amount}, per=HORIZON)
+        self.chain = [row['recipe'] for row in answer['recipes']]
+        self.chain += [next(iter(row['machines'])) for row in answer['recipes'] if row['machines']]
+        unlocks = {}
+        for tech, t in data.technology.items():
+            for effect in t['effects']:
+                if effect['type'] == 'unlock-recipe':
+                    unlocks.setdefault(effect['recipe'], tech)
+        self.unlocks = unlocks
+
+    def missing(self, sim):
+        return self.amount - sim.current_items.get(self.item, 0)
+
+    def techs(self, sim):
+        """techs still to research for the recipes on the way, with their prerequisites"""
+        todo = [self.unlocks[r] for r in self.chain if r not in sim.current_recipes and r in self.unlocks]
+        needed = {}
+        while todo:
+            tech = todo.pop()
+            if tech in needed or tech in sim.current_tech:
+                continue
+            needed[tech] = None
+            todo.extend(sim.data.technology[tech]['prerequisites'])
+        return list(needed)
+
+    def estimate(self, sim):
+        """
+        Seconds the goal is still away, roughly: everything the goal and the
+        research on the way still take that isn't in the inventory, resources
+        at the rate miners and hand mining bring them in, smelting at the rate of
+        the furnaces (or one), and the rest crafted by hand.
+        """
+        missing = self.missing(sim)
+        if missing <= 0:
+            return 0
+        wants = [(self.item, missing)]
+        for tech in self.techs(sim):
+            wants += get_potion_list(sim.data.technology, tech).items()
+        rates = {}
+        for key, amount in sim.machines.items():
+            item, machine, _ = key.split(':')
+            rates[item] = rates.get(item, 0) + amount * solver.machine_rate(sim.data, machine, item)
+        seconds = 0
+        for item, n in shortfall(sim, wants).items():
+            if item in sim.data.resources:
+                seconds += n / (rates.get(item, 0) + HAND_RATE)
+            elif item not in sim.data.recipes:
+                continue
+            elif sim.data.recipes[item]['category'] == 'crafting':
+                seconds += craft_time(sim.data, item, n)
+            else:
+                seconds += n / max(rates.get(item, 0), 1 / sim.data.recipes[item]['energy'])
+        return seconds
+
+    def actions(self, sim):
+        """Lines of script worth trying next, each list is one step of the search"""
+        out = [[f'next {minutes}'] for minutes in NEXT]
+        out += [[f'mine {resource} {MINE}'] for resource in MINEABLE]
+        # research on the way, crafting the packs by hand if they're missing
+        for tech in self.techs(sim):
+            if not all(p in sim.current_tech for p in sim.data.technology[tech]['prerequisites']):
+                continue
+            lines = []
+            for pack, n in get_potion_list(sim.data.technology, tech).items():
+                have = sim.current_items.get(pack, 0)
+                if have < n:
+                    lines.append(f'craft {pack} {n - have}')
+            out.append(lines + [f'research {tech}'])
+        # more machines where the factory falls short of making the goal in time
+        missing = self.missing(sim)
+        answer = solver.solve(sim.data, {self.item: missing}, sim.machines, per=HORIZON)
+        for row in answer['recipes']:
+            for kind, short in row['short'].items():
+                have = sim.current_items.get(kind, 0)
+                if have == 0 and kind not in sim.current_recipes:
+                    continue
+                n = min(short, BUILD)
+                lines = [f'craft {kind} {n - have}'] if have < n else []
+                out.append(lines + [f'place {kind} {row["recipe"]} {n}'])
+                break
+        out.append([f'craft {self.item} {min(missing, CRAFT)}'])
+        return out
+
+def shortfall(sim, wants):
+    """item -> amount still to make for wants, after what's in the inventory at every level"""
+    recipes = sim.data.recipes
+    used = {}
+    short = {}
+    todo = list(wants)
+    while todo:
+        item, n = todo.pop()
+        # get() so reading doesn't add zero keys to the inventory
+        take = min(n, sim.current_items.get(item, 0) - used.get(item, 0))
+        if take > 0:
+            used[item] = used.get(item, 0) + take
+            n -= take
+        if n <= 0:
+            continue
+        short[item] = short.get(item, 0) + n
+        if item in recipes and item not in sim.data.resources:
+            crafts = math.ceil(n / recipes[item]['products'][0]['amount'])
+            todo += [(ing['name'], ing['amount'] * crafts) for ing in recipes[item]['ingredients']]
+    return short
+
+class Node():
+    """A state the search got to, and the script that got there"""
+    def __init__(self, lines, state, game_time, estimate, actions, done):
+        self.lines = lines
+        self.state = state
+        self.game_time = game_time
+        self.estimate = estimate
+        self.actions = actions
+        self.done = done
+
+    def score(self):
+        return self.game_time + self.estimate
+
+def expand(job):
+    """Run lines from state in a worker, None if a line fails. Returns what the search keeps of the result"""
+    state, lines, goal = job
+    if worker_sim is None:
+        init_worker()
+    sim = worker_sim
+    sim.import_state(state)
+    runner = CommandRunner(sim)
+    for line in lines:
+        res, _ = runner.run(line)
+        if res != 0:
+            return None
+    done = goal.missing(sim) <= 0
+    key = sha1(sim.serialize_state().encode()).digest()
+    return key, sim.export_state(), sim.game_time, goal.estimate(sim), [] if done else goal.actions(sim), done
+
+def search(goal, sim, width=8, steps=200, budget=60, workers=None):
+    """
+    Beam search from the state of sim: every step tries every action of every
+    state in the beam and keeps the width states with the lowest game time plus
+    estimate. Stops when the beam is empty, after steps steps or budget seconds,
+    with the finished script that took the least game time, or the best
+    unfinished one if none got there.
+    """
+    start = time.perf_counter()
+    root = Node([], sim.export_state(), sim.game_time, goal.estimate(sim), goal.actions(sim), goal.missing(sim) <= 0)
+    beam = [root]
+    best = root if root.done else None
+    seen = set()
+    evaluated = 0
+    pool = None if workers == 1 else ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(sim.engine,))
+    try:
+        for step in range(steps):
+            if not beam or time.perf_counter() - start > budget:
+                break
+            jobs = [(node, action) for node in beam for action in node.actions]
+            args = [(node.state, action, goal) for node, action in jobs]
+            results = pool.map(expand, args, chunksize=4) if pool else map(expand, args)
+            children = []
+            for (node, action), result in zip(jobs, results):
+                evaluated += 1
+                if result is None:
+                    continue
+                key, state, game_time, estimate, actions, done = result
+                if key in seen:
+                    continue
+                seen.add(key)
+                child = Node(node.lines + action, state, game_time, estimate, actions, done)
+                if done:
+                    if best is None or not best.done or child.game_time < best.game_time:
+                        best = child
+                elif best is None or not best.done or child.game_time < best.game_time:
+                    children.append(child)
+            children.sort(key=Node.score)
+            beam = children[:width]
+            if beam and (best is None or not best.done):
+                # nothing finished yet, the furthest the search got
+                best = beam[0]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return {
+        'found': best is not None and best.done,
+        'game_time': best.game_time if best else None,
+        'lines': best.lines + (['launch'] if goal.launch and best.done else []) if best else [],
+        'steps': step + 1 if steps else 0,
+        'evaluated': evaluated,
+        'seconds': time.perf_counter() - start,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='search for a script that reaches a goal as early in game time as it can')
+    parser.add_argument('item', help="item to have in the inventory, or rocket for a launch")
+    parser.add_argument('amount', type=int, nargs='?', default=1)
+    parser.add_argument('-s', '--save', help='start from this save file instead of a new game')
+    parser.add_argument('-b', '--width', type=int, default=8, help='states kept after every step')
+    parser.add_argument('-n', '--steps', type=int, default=200, help='most steps to search')
+    parser.add_argument('-t', '--budget', type=float, default=60, help='most seconds to search')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes, defaults to the number of CPUs')
+    parser.add_argument('-e', '--engine', default='dict', choices=ENGINES)
+    parser.add_argument('-o', '--out', help='write the script to this file, runnable with run_script or batch.py')
+    args = parser.parse_args()
+
+    data_dict = load_files()
+    sim = Sim(data_dict, args.engine)
+    if args.save:
+        with open(args.save) as save_file:
+            sim.deserialize_state(save_file.read())
+    goal = Goal(sim.data, args.item, args.amount)
+    result = search(goal, sim, args.width, args.steps, args.budget, args.workers)
+
+    status = 'reached' if result['found'] else 'not reached, best partial script'
+    header = [f"# {args.item} {args.amount}: {status} at game time {result['game_time']}s"]
+    script = '\n'.join(header + result['lines']) + '\n'
+    if args.out:
+        with open(args.out, 'w') as out:
+            out.write(script)
+    else:
+        print(script, end='')
+    # on stderr, so the script can be redirected to a file as it is
+    print(f"{status}, {len(result['lines'])} commands, {result['evaluated']} states in {result['steps']} steps, {result['seconds']:.1f}s", file=sys.stderr)
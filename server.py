@@ -1,17 +1,35 @@
 """Flask server running a factorio simulation"""
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import gzip
 import json
+import logging
+import os
 import time
+from urllib.parse import quote
 
 from flask import Flask
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from flask import request, render_template, Response, stream_with_context
+from flask import request, render_template, redirect, g, Response
+from werkzeug.local import LocalProxy
 
 from files import load_files
-from sim import Sim
-from shell import *
+from sessions import SessionPool
+from streams import StreamHub
+from deltas import delta
+from history import RequestLog
+from timeseries import RESOLUTIONS
+import solver
+import whatif
+import metrics
+from errors import FactorioError, SaveFileError
 from craft import *
+from commands import CommandRunner, SIM_COMMANDS
+
+# LOG_LEVEL=DEBUG shows what the sim is doing, e.g. how long crafts take
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING'))
 
 app = Flask(__name__)
 limiter = Limiter(
@@ -21,10 +39,14 @@ limiter = Limiter(
   storage_uri="memory://",
 )
 
-request_history = []
+# the latest requests in memory, all of them in logs/requests.jsonl
+request_log = RequestLog(os.getenv('HISTORY_LOG', 'logs/requests.jsonl'), int(os.getenv('HISTORY_SIZE', 1000)))
 
 data_dict = load_files()
-sim = Sim(data_dict)
+# every player gets their own sim, picked by the X-Session header or ?session=
+pool = SessionPool(data_dict, os.getenv('SIM_ENGINE', 'dict'), int(os.getenv('MAX_SESSIONS', 64)), int(os.getenv('MAX_EVICTED', 1024)))
+# the sim of the session the current request belongs to, see with_sim
+sim = LocalProxy(lambda: g.session.sim)
 
 ### LETS TRY OUT A RECORD HISTORY
 from functools import wraps
@@ -33,15 +55,121 @@ def record_request(f):
   @wraps(f)
   def decorated_function(*args, **kwargs):
     # record request details
-    request_details = {
-      'path': request.url
-    }
-    request_history.append(request_details) 
+    request_log.record(session=session_token(), command=request.endpoint, path=request.url)
     return f(*args, **kwargs)
   return decorated_function
 
 ### RECORD HISTORY END
 
+def session_token():
+  return request.headers.get('X-Session') or request.args.get('session') or 'default'
+
+@contextmanager
+def checked_out(token):
+  # the session can't be evicted while checked out, and nothing else touches its sim
+  session = pool.checkout(token)
+  try:
+    with session.lock:
+      yield session
+  finally:
+    pool.checkin(session)
+
+def with_sim(f):
+  # runs the endpoint holding its session's lock, so a batch runs without anything in between
+  @wraps(f)
+  def decorated_function(*args, **kwargs):
+    with checked_out(session_token()) as session:
+      g.session = session
+      # requests take turns while the profiler is on, see /profile
+      with metrics.profiler.profiled():
+        response = f(*args, **kwargs)
+      # something to rewind to, if the request changed the state
+      session.sim.checkpoints.record(request.full_path.rstrip('?'))
+      # anyone streaming this session gets the new state
+      hub.publish(session)
+      return response
+  return decorated_function
+
+# entries in a /ping frame at most, older ones are paged in from /history
+PING_HISTORY = 50
+# token -> id of the last history entry /ping has looked at, least recently used first
+ping_cursors = OrderedDict()
+# cursors kept at most, a stream whose cursor was dropped goes on from the latest entry
+PING_CURSORS = 1024
+
+def ping_payload(session, since):
+  # the state itself comes from /stateping, and history only has the entries
+  # that came in since the previous frame
+  last = request_log.last_id()
+  if since is None:
+    entries = request_log.page(limit=PING_HISTORY, session=session.token)
+  else:
+    entries = request_log.page(after=ping_cursors.get(session.token, last), limit=PING_HISTORY, session=session.token)
+  # a session only adds entries while holding its lock, so anything up to last was seen
+  ping_cursors[session.token] = entries[-1]['id'] if len(entries) == PING_HISTORY else last
+  ping_cursors.move_to_end(session.token)
+  while len(ping_cursors) > PING_CURSORS:
+    ping_cursors.popitem(last=False)
+  # what the factory made over the latest next(), a dashboard shouldn't simulate anything
+  production = session.sim.recorded_production()
+  return json.dumps({
+    'production': session.sim.production() if production is None else production,
+    'history': entries,
+  })
+
+def state_payload(session, since):
+  # only what changed since the previous frame, see deltas.py
+  return json.dumps(delta(session.sim, since))
+
+# /ping and /stateping only send something when the state changed
+hub = StreamHub({'ping': ping_payload, 'stateping': state_payload}, checked_out)
+
+def stream_response(kind):
+  # with STREAM_PORT set the streams are served by the hub's own asyncio server,
+  # where they cost no thread, and the routes send the client there
+  if not os.getenv('STREAM_PORT'):
+    return Response(hub.frames(session_token(), kind), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+  origin = f'{request.scheme}://{request.host}'
+  port = hub.listen(os.getenv('STREAM_HOST', '127.0.0.1'), int(os.getenv('STREAM_PORT')), origin)
+  base = os.getenv('STREAM_URL') or f'{request.scheme}://{request.host.rsplit(":", 1)[0]}:{port}'
+  # EventSource follows the redirect
+  return redirect(f'{base.rstrip("/")}/{kind}?session={quote(session_token())}', 307)
+
+@app.before_request
+def start_timer():
+  g.request_start = time.perf_counter()
+
+# after_request functions run last to first, so this one sees the compressed response
+@app.after_request
+def observe_latency(response):
+  if 'request_start' in g:
+    metrics.request_latency.observe(request.endpoint or 'unknown', time.perf_counter() - g.request_start)
+  return response
+
+# smaller responses aren't worth the cpu
+COMPRESS_MIN = 1024
+
+@app.after_request
+def compress(response):
+  # full states and deltas are mostly item names, they shrink a lot
+  if (response.status_code == 200 and not response.direct_passthrough and not response.is_streamed
+      and 'gzip' in request.headers.get('Accept-Encoding', '')
+      and 'Content-Encoding' not in response.headers):
+    data = response.get_data()
+    if len(data) >= COMPRESS_MIN:
+      response.set_data(gzip.compress(data, 5))
+      response.headers['Content-Encoding'] = 'gzip'
+      response.headers['Vary'] = 'Accept-Encoding'
+  return response
+
+@app.after_request
+def add_state_headers(response):
+  # clients keep their prompt and caches up to date from these, no extra /time request needed
+  if 'session' in g:
+    response.headers['X-Game-Time'] = f'{sim.game_time}'
+    response.headers['X-State-Version'] = f'{sim.version}'
+  return response
+
 
 # ROOT
 @app.route("/")
@@ -67,30 +195,37 @@ def root():
 
 # GET REQUESTS
 @app.route("/time", methods=["GET"])
+@with_sim
 def game_time():
   return f"{sim.game_time}"
 
 @app.route("/cookbook", methods=["GET"])
+@with_sim
 def cookbook():
   return '\n'.join(sim.current_recipes)
 
 @app.route("/limits", methods=["GET"])
+@with_sim
 def limits():
   return '\n'.join(sim.limited_items)
 
 @app.route("/suggest", methods=["GET"])
+@with_sim
 def suggest():
   return '\n'.join(sim.all_researchable())
 
 @app.route("/production", methods=["GET"])
+@with_sim
 def production():
   return sim.production()
 
 @app.route("/inventory")
+@with_sim
 def inventory():
   return sim.current_items
 
 @app.route("/craftable", methods=["GET"])
+@with_sim
 def SERVERcraftable():
   item = request.args.get('item')
   amount = int(request.args.get('amount'))
@@ -100,25 +235,127 @@ def SERVERcraftable():
   else:
     return 'not pog', 200
 
+@app.route("/craftable_all", methods=["GET"])
+@with_sim
+def craftable_all():
+  # every unlocked recipe with the most the player can craft right now
+  return sim.craftable_all()
+
+@app.route("/researchable_all", methods=["GET"])
+@with_sim
+def researchable_all():
+  return sim.researchable_all()
+
+@app.route("/wish", methods=["GET"])
+@with_sim
+def wish():
+  item = request.args.get('item')
+  amount = int(request.args.get('amount', 1))
+  if item not in sim.data.recipes:
+    return f'could not find a recipe for {item}', 400
+  return {
+    'ingredients': shopping_list(sim.data.recipes, {item: amount}),
+    'raw': raw_materials(sim.data.recipes, {item: amount}),
+  }
+
 # export save file
 @app.route("/state")
+@with_sim
 def state():
+  if request.args.get('format') == 'binary':
+    # see savefile.py
+    return Response(sim.serialize_binary(), mimetype='application/octet-stream')
   return sim.serialize_state(), 200
 
+@app.route("/delta")
+@with_sim
+def state_delta():
+  # what changed after version ?since=, or the full state when since is missing or too old
+  return delta(sim, request.args.get('since', type=int)), 200
+
+@app.route("/series")
+@with_sim
+def series():
+  # recorded production between game times ?start= and ?end=, see timeseries.py
+  resolution = request.args.get('resolution', '1m')
+  if resolution not in RESOLUTIONS:
+    return f'unknown resolution {resolution}, expected one of {", ".join(RESOLUTIONS)}', 400
+  items = request.args.get('items')
+  args = (resolution, request.args.get('start', type=float), request.args.get('end', type=float), items and items.split(','))
+  if request.args.get('format') == 'csv':
+    return Response(sim.series.to_csv(*args), mimetype='text/csv')
+  return {'resolution': resolution, 'buckets': sim.series.range(*args)}
+
+@app.route("/solve", methods=["GET"])
+@with_sim
+def solve():
+  # machines needed for ?targets=rocket:1,iron-plate:60 every ?per=hour, next to the placed ones
+  try:
+    targets = solver.parse_targets(request.args.get('targets', '').split(','))
+    per = solver.parse_per(request.args.get('per', 'minute'))
+    recipes = dict(pair.rsplit(':', 1) for pair in request.args.getlist('recipe'))
+  except (ValueError, KeyError):
+    return 'expected ?targets=item:rate,... with ?per=second, minute, hour or seconds', 400
+  try:
+    return solver.solve(sim.data, targets, sim.machines, recipes, per)
+  except FactorioError as e:
+    return str(e), 400
+
+@app.route("/whatif", methods=["POST"])
+def what_if():
+  # {"candidates": [["place stone-furnace iron-plate 5"], "research automation"], "minutes": 10, "step": 1},
+  # every candidate runs on its own fork of the sim, the sim itself doesn't change
+  body = request.get_json(silent=True)
+  if not isinstance(body, dict):
+    return 'expected a json object with a list of candidates', 400
+  try:
+    candidates = whatif.parse_candidates(body.get('candidates'))
+    minutes = int(body.get('minutes', 10))
+    step = int(body.get('step', 1))
+  except (TypeError, ValueError) as e:
+    return str(e), 400
+  if minutes < 0 or step <= 0:
+    return 'minutes and step have to be positive', 400
+  if minutes * 60 > whatif.MAX_HORIZON:
+    return f'minutes can be {whatif.MAX_HORIZON // 60} at most', 400
+  # only forking needs the session's lock, its other requests don't wait for the candidates
+  with checked_out(session_token()) as session:
+    g.session = session
+    base = session.sim.fork()
+  return whatif.evaluate(base, candidates, minutes * 60, step * 60)
+
+@app.route("/bottlenecks", methods=["GET"])
+@with_sim
+def bottlenecks():
+  # seconds each machine group ran full, capped by its limit or starved, between ?start= and ?end=
+  return {
+    'enabled': sim.bottlenecks.enabled,
+    'groups': sim.bottlenecks.summary(request.args.get('start', type=float), request.args.get('end', type=float)),
+  }
+
 # POST REQUESTS
 @app.route("/clear", methods=["POST"])
+@with_sim
 def clear():
   sim.clear()
   return ('', 204)
 
 # load save file
 @app.route("/update", methods=["POST"])
+@with_sim
 def update():
+  if request.mimetype == 'application/octet-stream':
+    try:
+      sim.deserialize_binary(request.get_data())
+    except SaveFileError as e:
+      return str(e), 400
+    return '', 200
   json_s = request.get_json() 
   sim.deserialize_state(json_s)
   return '', 200
 
 @app.route("/spawn", methods=["POST"])
+@with_sim
 def spawn():
   item = request.args.get('item')
   amount = request.args.get('amount')
@@ -126,12 +363,14 @@ def spawn():
   return ('', 200)
 
 @app.route("/research", methods=["POST"])
+@with_sim
 def research():
   technology = request.args.get('technology')
   res, msg = sim.research(technology)
   return (msg, 200)
 
 @app.route("/researchable", methods=["POST"])
+@with_sim
 def researchable():
   technology = request.args.get('technology')
   res, msg = sim.researchable(technology)
@@ -142,6 +381,7 @@ def researchable():
     return (msg, 400)
 
 @app.route("/place", methods=["POST"])
+@with_sim
 @record_request
 def place():
   machine = request.args.get('machine')
@@ -155,6 +395,7 @@ def place():
     return (msg, 400)
 
 @app.route("/prio", methods=["POST"])
+@with_sim
 def prio():
   machine = request.args.get('machine')
   item = request.args.get('item')
@@ -164,12 +405,21 @@ def prio():
   return 'prio set', 200
 
 @app.route("/next", methods=["POST"])
+@with_sim
 def next():
     minutes = int(request.args.get('minutes'))
-    sim.next(minutes * 60)
+    step = request.args.get('step', type=int)
+    if step is None:
+      sim.next(minutes * 60)
+    else:
+      if step <= 0:
+        return 'step has to be positive', 400
+      # same result as calling next with step minutes over and over
+      sim.fast_forward(minutes * 60, step * 60)
     return '', 200
 
 @app.route("/craft", methods=["POST"])
+@with_sim
 @record_request
 def craft():
   item = request.args.get('item')
@@ -182,6 +432,7 @@ def craft():
 
 
 @app.route("/mine", methods=["POST"])
+@with_sim
 @record_request
 def mine():
   resource = request.args.get('resource')
@@ -193,6 +444,7 @@ def mine():
     return msg, 200
 
 @app.route("/limit", methods=["POST"])
+@with_sim
 def limit():
   item = request.args.get('item')
   amount = int(request.args.get('amount'))
@@ -201,38 +453,108 @@ def limit():
   return 'pog', 200
 
 @app.route("/launch", methods=["POST"])
+@with_sim
 def launch():
   if sim.launch():
     return '3. 2. 1. LIFT OFF!!! GG', 200
   return 'NOT ENOUGH ROCKET PARTS', 200
 
+@app.route("/checkpoints", methods=["GET"])
+@with_sim
+def checkpoints():
+  # every checkpoint /rewind can go back to, oldest first
+  return {'index': sim.checkpoints.index, 'checkpoints': sim.checkpoints.summary()}
+
+@app.route("/rewind", methods=["POST"])
+@with_sim
+def rewind():
+  # back to the latest checkpoint at or before ?index= and ?time=
+  point = sim.checkpoints.rewind(request.args.get('index', type=int), request.args.get('time', type=float))
+  if point is None:
+    return 'no checkpoint that far back', 400
+  return point.summary()
+
+@app.route("/undo", methods=["POST"])
+@with_sim
+def undo():
+  point = sim.checkpoints.undo(request.args.get('n', 1, type=int))
+  if point is None:
+    return 'no checkpoint that far back', 400
+  return point.summary()
+
+@app.route("/bottlenecks", methods=["POST"])
+@with_sim
+def record_bottlenecks():
+  # ?enabled=1 starts recording, ?enabled=0 stops and forgets what was recorded
+  enabled = request.args.get('enabled', '1') not in ('0', 'false', 'off')
+  sim.bottlenecks.enabled = enabled
+  if not enabled:
+    sim.bottlenecks.clear()
+  return {'enabled': enabled}
+
+@app.route("/batch", methods=["POST"])
+@with_sim
+def batch():
+  # run a list of script lines in order, e.g. {"commands": ["mine stone 10", "next 5"], "stop_on_error": true}
+  body = request.get_json()
+  if not isinstance(body, dict) or not isinstance(body.get('commands'), list):
+    return 'expected a json object with a list of commands', 400
+  if not all(isinstance(command, str) for command in body['commands']):
+    return 'a command is a script line', 400
+  runner = CommandRunner(sim, SIM_COMMANDS)
+  results = runner.run_lines(body['commands'], body.get('stop_on_error', False))
+  return {
+    'results': [{'command': command, 'res': res, 'msg': msg} for command, res, msg in results],
+  }
+
 @app.route("/ping", methods=["GET"])
 def ping():
-  def inventory_stream():
-    while True:
-        data = {
-          'production': sim.production(),
-          'state': sim.serialize_state(),
-          'history': json.dumps(request_history),
-        }
-        yield f'data: {json.dumps(data)}\n\n'
-        time.sleep(3)
-
-  return Response(stream_with_context(inventory_stream()), mimetype='text/event-stream')
+  return stream_response('ping')
 
 @app.route("/stateping", methods=["GET"])
 def stateping():
-  def state_stream():
-    while True: 
-      yield f'data: {json.dumps(sim.serialize_state())}\n\n' 
-      time.sleep(5)
-  return Response(stream_with_context(state_stream()), mimetype='text/event-stream')
-
+  return stream_response('stateping')
 
 @app.route("/history", methods=["GET"])
 def history():
-  return str(request_history), 200
+  # the session's latest requests, page back with ?before=<first> and forward with ?after=<last>
+  entries = request_log.page(
+    after=request.args.get('after', type=int),
+    before=request.args.get('before', type=int),
+    limit=min(request.args.get('limit', 100, type=int), 1000),
+    command=request.args.get('command'),
+    session=session_token(),
+  )
+  return {
+    'entries': entries,
+    'first': entries[0]['id'] if entries else None,
+    'last': entries[-1]['id'] if entries else None,
+  }
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+  # request latency and time spent in the sim, in the Prometheus text format
+  gauges = (
+    ('factorio_sessions_active', 'Sessions with a sim in memory.', len(pool.active)),
+    ('factorio_sessions_evicted', 'Sessions compressed until their next request.', len(pool.evicted)),
+    ('factorio_profiler_enabled', 'Whether /profile is recording.', int(metrics.profiler.enabled)),
+  )
+  return Response(metrics.prometheus(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route("/profile", methods=["GET"])
+def profile():
+  # cProfile stats of every request with a sim since the profiler was turned on, ?sort=tottime
+  return Response(metrics.profiler.report(request.args.get('sort', 'cumulative'), request.args.get('limit', 40, type=int)), mimetype='text/plain')
+
+@app.route("/profile", methods=["POST"])
+def toggle_profile():
+  # ?enabled=1 starts over with an empty profile, ?enabled=0 stops and keeps it for GET /profile
+  if request.args.get('enabled', '1') in ('0', 'false', 'off'):
+    metrics.profiler.disable()
+  else:
+    metrics.profiler.enable()
+  return {'enabled': metrics.profiler.enabled}
 
 @app.shell_context_processor
 def make_shell_context():
-  return {'sim': sim}
\ No newline at end of file
+  return {'pool': pool}
\ No newline at end of file
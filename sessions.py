@@ -0,0 +1,68 @@
+"""Sims by session token, so one server can host many players at once"""
+
+from collections import OrderedDict
+import threading
+import zlib
+
+from sim import Sim
+
+class Session():
+    def __init__(self, token, sim):
+        self.token = token
+        self.sim = sim
+        # held while a request works on the sim
+        self.lock = threading.Lock()
+        # requests currently using the session, it is never evicted while > 0
+        self.users = 0
+
+class SessionPool():
+    """
+    Keeps at most size sims alive. When there are more sessions than that, the
+    least recently used idle ones are evicted to their exported state, and
+    restored the next time their token shows up. At most keep evicted states
+    are held on to, past that the oldest are dropped and their tokens start
+    over with a new sim.
+    """
+    def __init__(self, data_dict, engine='dict', size=64, keep=1024):
+        self.data_dict = data_dict
+        self.engine = engine
+        self.size = size
+        self.keep = keep
+        self.active = OrderedDict()
+        # token -> compressed Sim.export_state(), oldest first
+        self.evicted = OrderedDict()
+        self.lock = threading.Lock()
+
+    def checkout(self, token):
+        """Session for token, created or restored if needed. Hand it back with checkin()"""
+        with self.lock:
+            session = self.active.get(token)
+            if session is None:
+                sim = Sim(self.data_dict, self.engine)
+                if token in self.evicted:
+                    sim.import_state(zlib.decompress(self.evicted.pop(token)))
+                session = Session(token, sim)
+                self.active[token] = session
+            self.active.move_to_end(token)
+            session.users += 1
+            self.evict()
+            return session
+
+    def checkin(self, session):
+        with self.lock:
+            session.users -= 1
+            # the pool can go over size while every session is busy
+            self.evict()
+
+    def evict(self):
+        excess = len(self.active) - self.size
+        for token in list(self.active):
+            if excess <= 0:
+                break
+            session = self.active[token]
+            if session.users == 0:
+                self.evicted[token] = zlib.compress(session.sim.export_state())
+                del self.active[token]
+                excess -= 1
+        while len(self.evicted) > self.keep:
+            self.evicted.popitem(last=False)
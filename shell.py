@@ -8,10 +8,15 @@ import argparse
 import datetime
 import json
 import ast
+import shlex
 from types import SimpleNamespace
 
 from shortcuts import convert_aliases
+from commands import SIM_COMMANDS, MINEABLE, make_parser
 import client
+import savefile
+from timeseries import RESOLUTIONS
+import solver
 import utils
 
 
@@ -19,9 +24,6 @@ class FactorioShell(cmd2.Cmd):
     intro = "Welcome to factorio-cli. Type help or ? to list cmds \n"
     prompt = "(0:00:00) "
 
-    # todo: this is sus, move or refactor out of here
-    mineable = ['stone', 'coal', 'iron-ore', 'copper-ore']
-
     def __init__(self, data_dict):
         super().__init__(startup_script='scripts/startup.txt', silence_startup_script=True)
         # register hooks
@@ -33,7 +35,7 @@ class FactorioShell(cmd2.Cmd):
 
     def update_prompt(self, data: cmd2.plugin.PostcommandData) -> cmd2.plugin.PostcommandData:
         """Update shell prompt with the amount of time elapsed in the simulation"""
-        game_time = client.get_game_time()
+        game_time = client.last_game_time()
         self.prompt = f'({datetime.timedelta(0, game_time)})'
         return data
 
@@ -56,9 +58,9 @@ class FactorioShell(cmd2.Cmd):
         """Reset the simulation and wipe all data"""
         client.clear()
 
-    spawn_parser = cmd2.Cmd2ArgumentParser()
-    spawn_parser.add_argument('item', help='item type to spawn in')
-    spawn_parser.add_argument('amount', type=int, help='amount of the given item to be spawned in')
+    # parsers of commands scripts can run too come from commands.ARGUMENTS, so
+    # CommandRunner parses lines the same way
+    spawn_parser = make_parser('spawn', cmd2.Cmd2ArgumentParser)
 
     @cmd2.with_argparser(spawn_parser)
     def do_spawn(self, args):
@@ -66,19 +68,16 @@ class FactorioShell(cmd2.Cmd):
         client.spawn(args.item, args.amount)
 
     def research_tech_choices(self):
-        options = client.suggest().split()
         items = []
-        for i in range(len(options)):
-            researchable = client.researchable(options[i])
-            if researchable == 'pog':
+        for tech, researchable in client.researchable_all().items():
+            if researchable:
                 description = cmd2.ansi.style("researchable",fg=cmd2.ansi.Fg.LIGHT_GREEN)
             else:
                 description = cmd2.ansi.style("researchable",fg=cmd2.ansi.Fg.LIGHT_RED)
-            items.append(cmd2.CompletionItem(options[i], description))
+            items.append(cmd2.CompletionItem(tech, description))
         return items 
 
-    research_parser = cmd2.Cmd2ArgumentParser()
-    research_parser.add_argument('tech', choices_provider=research_tech_choices, help='name of technology to research')
+    research_parser = make_parser('research', cmd2.Cmd2ArgumentParser, tech={'choices_provider': research_tech_choices})
 
     @cmd2.with_argparser(research_parser)
     def do_research(self, args): 
@@ -107,11 +106,7 @@ class FactorioShell(cmd2.Cmd):
         msg = client.cookbook()
         self.poutput(msg)
 
-    prio_parser = cmd2.Cmd2ArgumentParser()
-    prio_parser.add_argument('machine', help='name of goal technology')
-    prio_parser.add_argument('item', help='name of goal technology')
-    prio_parser.add_argument('old', help='name of goal technology')
-    prio_parser.add_argument('new', help='name of goal technology')
+    prio_parser = make_parser('prio', cmd2.Cmd2ArgumentParser)
 
     @cmd2.with_argparser(prio_parser)
     def do_prio(self, args):
@@ -139,6 +134,8 @@ class FactorioShell(cmd2.Cmd):
         if args.item in self.data.recipes:
             self.poutput("CRAFTING RECIPE:")
             self.poutput(json.dumps(utils.shopping_list(self.data.recipes, request), indent=4))
+            self.poutput("RAW MATERIALS:")
+            self.poutput(json.dumps(utils.raw_materials(self.data.recipes, request), indent=4))
             found = True
         if args.item in self.data.technology:
             # if the player wished for a technology, output the list of potions required for research
@@ -155,7 +152,7 @@ class FactorioShell(cmd2.Cmd):
     def place_item_helper(self, machine):
         machine = convert_aliases([machine])[0] 
         if machine in self.data.mining_drills:
-            return {'stone', 'coal', 'iron-ore', 'copper-ore'}       
+            return set(MINEABLE)
         elif machine in self.data.furnaces:
             return {'stone-brick', 'iron-plate', 'copper-plate', 'steel-plate'}
         elif machine in self.data.assemblers:
@@ -169,10 +166,9 @@ class FactorioShell(cmd2.Cmd):
         machine = arg_tokens['machine'][0]
         return self.place_item_helper(machine)
 
-    place_parser = cmd2.Cmd2ArgumentParser()
-    place_parser.add_argument('machine', choices_provider=place_machine_choices, help='machine type to be placed')
-    place_parser.add_argument('item', choices_provider=place_item_choices, help='item type this machine will generate')
-    place_parser.add_argument('amount', type=int, default=1, nargs='?', help='number of machines to place with the given config')
+    place_parser = make_parser('place', cmd2.Cmd2ArgumentParser,
+        machine={'choices_provider': place_machine_choices},
+        item={'choices_provider': place_item_choices})
 
     @cmd2.with_argparser(place_parser)
     def do_place(self, args):
@@ -188,13 +184,12 @@ class FactorioShell(cmd2.Cmd):
         current_items = client.get_inventory()
         print(json.dumps(current_items, indent=4))
 
-    next_parser = cmd2.Cmd2ArgumentParser()
-    next_parser.add_argument('minutes', type=int, default=1, nargs='?', help='the number of minutes to run the simulation for')
+    next_parser = make_parser('next', cmd2.Cmd2ArgumentParser)
 
     @cmd2.with_argparser(next_parser)
     def do_next(self, args):
         """Simulate factory production for a given number of minutes"""
-        client.next(args.minutes)
+        client.next(args.minutes, args.step)
     
     def do_prod(self, args):
         """Return production statistcs for the current state of the factory"""
@@ -207,9 +202,7 @@ class FactorioShell(cmd2.Cmd):
         table = st.generate_table(data)
         self.poutput(table)
 
-    mine_parser = cmd2.Cmd2ArgumentParser()
-    mine_parser.add_argument('resource', choices=mineable, help='resource type')
-    mine_parser.add_argument('amount', type=int, help='amount of the given resource to be mined')
+    mine_parser = make_parser('mine', cmd2.Cmd2ArgumentParser)
 
     @cmd2.with_argparser(mine_parser) 
     def do_mine(self, args):
@@ -217,12 +210,10 @@ class FactorioShell(cmd2.Cmd):
         self.poutput(msg)
 
     def craft_item_choices(self, arg_tokens):
-        # TODO: cache / send less requests
-        return filter(lambda x: client.craftable(x, 1) == 'pog', client.cookbook().split())
+        # one request for every recipe, cached until the game state changes
+        return [cmd2.CompletionItem(item, f'up to {amount}') for item, amount in client.craftable_all().items() if amount > 0]
 
-    craft_parser = cmd2.Cmd2ArgumentParser()
-    craft_parser.add_argument('item', choices_provider=craft_item_choices, help='item type')
-    craft_parser.add_argument('amount', nargs='?', default=1, type=int, help='amount of the given item, defaults to 1')
+    craft_parser = make_parser('craft', cmd2.Cmd2ArgumentParser, item={'choices_provider': craft_item_choices})
 
     @cmd2.with_argparser(craft_parser)
     def do_craft(self, args):
@@ -230,9 +221,7 @@ class FactorioShell(cmd2.Cmd):
         msg = client.craft(args.item, args.amount)
         self.poutput(msg)
 
-    limit_parser = cmd2.Cmd2ArgumentParser() 
-    limit_parser.add_argument('item', help='item type')
-    limit_parser.add_argument('amount', nargs='?', default=1, type=int, help='amount of the given item, defaults to 1')
+    limit_parser = make_parser('limit', cmd2.Cmd2ArgumentParser)
 
     @cmd2.with_argparser(limit_parser)
     def do_limit(self, args):
@@ -240,17 +229,184 @@ class FactorioShell(cmd2.Cmd):
         msg = client.limit(args.item, args.amount)
         self.poutput(msg)
 
-    loadsave_parser = cmd2.Cmd2ArgumentParser()
-    loadsave_parser.add_argument('file', help='path to save file')
+    undo_parser = make_parser('undo', cmd2.Cmd2ArgumentParser)
 
-    @cmd2.with_argparser(loadsave_parser)
-    def do_load(self, args):
-        with open(args.file) as save_file:
-            content = ''.join(save_file.readlines())
-            client.update(content)
+    @cmd2.with_argparser(undo_parser)
+    def do_undo(self, args):
+        """Undo the last commands that changed the game, without replaying anything"""
+        self.poutput_rewound(client.undo(args.n))
+
+    rewind_parser = make_parser('rewind', cmd2.Cmd2ArgumentParser)
 
-    @cmd2.with_argparser(loadsave_parser)
+    @cmd2.with_argparser(rewind_parser)
+    def do_rewind(self, args):
+        """Go back to a checkpoint, the checkpoints after it are dropped"""
+        self.poutput_rewound(client.rewind(args.index, args.time))
+
+    def poutput_rewound(self, point):
+        if isinstance(point, dict):
+            self.poutput(f"rewound to command {point['index']} ({point['command']}) at {point['game_time']}")
+        else:
+            self.perror(point)
+
+    def do_checkpoints(self, args):
+        """List the checkpoints rewind can go back to"""
+        for point in client.checkpoints():
+            self.poutput(f"{point['index']} {point['game_time']} {point['command']}")
+
+    series_parser = cmd2.Cmd2ArgumentParser()
+    series_parser.add_argument('items', nargs='*', help='only these items')
+    series_parser.add_argument('-r', '--resolution', default='1m', choices=RESOLUTIONS, help='raw is one row per next')
+    series_parser.add_argument('-s', '--start', type=float, help='from this game time (in seconds)')
+    series_parser.add_argument('-e', '--end', type=float, help='up to this game time (in seconds)')
+
+    @cmd2.with_argparser(series_parser)
+    def do_series(self, args):
+        """Recorded production and inventory over game time as csv, e.g. series -r 10m iron-plate > plates.csv"""
+        self.poutput(client.series(args.resolution, args.start, args.end, args.items or None), end='')
+
+    solve_parser = cmd2.Cmd2ArgumentParser()
+    solve_parser.add_argument('targets', nargs='+', help='pairs of item and rate, e.g. rocket 1 automation-science-pack 60')
+    solve_parser.add_argument('-p', '--per', default='minute', help='second, minute, hour or a number of seconds, defaults to minute')
+    solve_parser.add_argument('-r', '--recipe', action='append', default=[], help='item:recipe, e.g. petroleum-gas:advanced-oil-processing')
+
+    @cmd2.with_argparser(solve_parser)
+    def do_solve(self, args):
+        """Machines needed to make items at a rate, and how many more than are placed"""
+        try:
+            targets = solver.parse_targets(args.targets)
+            recipes = dict(pair.rsplit(':', 1) for pair in args.recipe)
+        except ValueError as e:
+            self.perror(e)
+            return
+        answer = client.solve(targets, args.per, recipes)
+        if isinstance(answer, str):
+            self.perror(answer)
+            return
+        data = []
+        for row in answer['recipes']:
+            machines = ', '.join(f'{n:.2f} {machine}' for machine, n in row['machines'].items())
+            # more of what's placed already, or of the first kind that can run it
+            kind = max(row['placed'], key=row['placed'].get) if row['placed'] else next(iter(row['short']), None)
+            short = f"+{row['short'][kind]} {kind}" if kind in row['short'] else ''
+            data.append([row['recipe'], f"{row['rate']:.2f}", f"{row['placed_rate']:.2f}", short, machines])
+        cols = [Column("Recipe", width=30), Column(f"Needed/{args.per}", width=12), Column("Placed", width=10), Column("Short", width=28), Column("Machines", width=60)]
+        self.poutput(SimpleTable(cols).generate_table(data))
+        for item, rate in answer['inputs'].items():
+            self.poutput(f'{item}: {rate:.2f}/{args.per} from outside the factory')
+
+    bottlenecks_parser = cmd2.Cmd2ArgumentParser()
+    bottlenecks_parser.add_argument('record', nargs='?', choices=('on', 'off'), help='start or stop recording, off forgets what was recorded')
+    bottlenecks_parser.add_argument('-s', '--start', type=float, help='from this game time (in seconds)')
+    bottlenecks_parser.add_argument('-e', '--end', type=float, help='up to this game time (in seconds)')
+
+    @cmd2.with_argparser(bottlenecks_parser)
+    def do_bottlenecks(self, args):
+        """Show how long each machine group ran full, was capped by its limit or starved of an ingredient"""
+        if args.record is not None:
+            enabled = client.record_bottlenecks(args.record == 'on')
+            self.poutput(f"recording bottlenecks {'on' if enabled else 'off'}")
+            return
+        answer = client.bottlenecks(args.start, args.end)
+        if not answer['enabled'] and not answer['groups']:
+            self.perror('not recording bottlenecks, start with: bottlenecks on')
+            return
+        def percent(seconds, total):
+            return f'{100 * seconds / total:.0f}%' if total else ''
+        data = []
+        for group in answer['groups']:
+            starved = ', '.join(f'{x} {percent(t, group["seconds"])}' for x, t in sorted(group['starved'].items(), key=lambda kv: -kv[1]))
+            data.append([group['machine'], percent(group['full'], group['seconds']), percent(group['capped'], group['seconds']), starved, group['latest']])
+        cols = [Column("Machines", width=40), Column("Full", width=6), Column("Capped", width=6), Column("Starved", width=40), Column("Latest", width=24)]
+        self.poutput(SimpleTable(cols).generate_table(data))
+
+    whatif_parser = cmd2.Cmd2ArgumentParser()
+    whatif_parser.add_argument('candidates', nargs='+', help='commands to compare, quoted, several commands in one candidate separated by ;')
+    whatif_parser.add_argument('-m', '--minutes', type=int, default=10, help='how long the factory runs for after the commands, defaults to 10, 60 at most')
+    whatif_parser.add_argument('-s', '--step', type=int, default=1, help='minutes per run of the factory, like next -s')
+    whatif_parser.add_argument('-n', '--top', type=int, default=5, help='most items to show per candidate')
+
+    @cmd2.with_argparser(whatif_parser)
+    def do_whatif(self, args):
+        """Compare what commands would do to the factory without doing them, e.g. whatif "place stone-furnace iron-plate 5" "research automation" """
+        candidates = [[line.strip() for line in candidate.split(';') if line.strip()] for candidate in args.candidates]
+        answer = client.what_if(candidates, args.minutes, args.step)
+        if isinstance(answer, str):
+            self.perror(answer)
+            return
+        def top(diff):
+            # biggest changes first
+            return ', '.join(f'{n:+g} {x}' for x, n in sorted(diff.items(), key=lambda kv: -abs(kv[1]))[:args.top])
+        data = []
+        for candidate in answer['candidates']:
+            failed = [r['msg'] for r in candidate['results'] if r['res'] != 0]
+            data.append(['; '.join(candidate['commands']), failed[0] if failed else top(candidate['production']), top(candidate['inventory'])])
+        cols = [Column("Candidate", width=36), Column(f"Made in {args.minutes}m vs doing nothing", width=50), Column("Inventory vs doing nothing", width=50)]
+        self.poutput(SimpleTable(cols).generate_table(data))
+
+    @cmd2.with_argparser(make_parser('load', cmd2.Cmd2ArgumentParser))
+    def do_load(self, args):
+        with open(args.file, 'rb') as save_file:
+            content = save_file.read()
+        if not savefile.is_binary(content):
+            content = content.decode()
+        msg = client.update(content)
+        if msg:
+            self.perror(msg)
+
+    @cmd2.with_argparser(make_parser('save', cmd2.Cmd2ArgumentParser))
     def do_save(self, args):
+        """Save the game, as a binary save when the file name ends in .fsav"""
+        if args.file.endswith(savefile.EXTENSION):
+            with open(args.file, 'wb') as save_file:
+                save_file.write(client.state(binary=True))
+            return
         with open(args.file, 'w') as save_file:
             cur_state = client.state()
             save_file.write(cur_state)
+
+    batch_parser = cmd2.Cmd2ArgumentParser()
+    batch_parser.add_argument('file', help='path to script file')
+    batch_parser.add_argument('-c', '--chunk', type=int, default=0, help='most commands to send in one request, defaults to no limit')
+    batch_parser.add_argument('-x', '--stop-on-error', action='store_true', help='stop the script at the first command that fails')
+
+    @cmd2.with_argparser(batch_parser)
+    def do_batch(self, args):
+        """Run a script like run_script, but send runs of sim commands in one request"""
+        try:
+            with open(args.file) as script:
+                lines = script.read().splitlines()
+        except OSError as e:
+            self.perror(f"Problem accessing script from '{args.file}': {e}")
+            return
+        chunk = []
+        for line in lines:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                command = convert_aliases(shlex.split(line)[:1])
+            except ValueError:
+                command = []
+            if command and command[0] in SIM_COMMANDS and command[0] not in self.aliases:
+                chunk.append(line)
+                if len(chunk) == args.chunk:
+                    if not self.send_batch(chunk, args.stop_on_error):
+                        return
+                    chunk = []
+                continue
+            # everything else runs through the shell as usual, after the commands before it
+            if chunk and not self.send_batch(chunk, args.stop_on_error):
+                return
+            chunk = []
+            if self.onecmd_plus_hooks(line):
+                return True
+        if chunk:
+            self.send_batch(chunk, args.stop_on_error)
+
+    def send_batch(self, commands, stop_on_error):
+        # returns False when a command failed and the script should stop
+        results = client.batch(commands, stop_on_error)
+        for result in results:
+            if result['msg'] is not None:
+                self.poutput(result['msg'])
+        return not (stop_on_error and any(result['res'] != 0 for result in results))
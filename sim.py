@@ -3,6 +3,8 @@
 # stdlib imports
 import functools
 import json
+import logging
+import pickle
 from collections import defaultdict, Counter
 from types import SimpleNamespace
 import math
@@ -14,107 +16,144 @@ from init import *
 from utils import *
 from craft import *
 from data import *
+from plan import ProductionPlan
+import fastforward
+from availability import Availability
+from deltas import Changes
+from checkpoints import Checkpoints
+from timeseries import TimeSeries
+from bottlenecks import Bottlenecks
+import savefile
+from metrics import timed
+
+log = logging.getLogger(__name__)
+
+# production engines, see plan.py and vector.py
+ENGINES = ('dict', 'numpy')
+# state sections a fork shares with the sim it came from until one of them changes it, see Sim.fork
+SHARED_SECTIONS = ('current_tech', 'current_recipes', 'machines', 'limited_items')
 
 class Sim():
-    def __init__(self, data_dict):
+    def __init__(self, data_dict, engine='dict'):
+        if engine not in ENGINES:
+            raise ValueError(f'unknown engine {engine}, expected one of {ENGINES}')
         self.data = SimpleNamespace(**data_dict)
+        self.engine = engine
+        # bumped on every change to the game state, lets clients tell when their copy is stale
+        self.version = 0
+        self.availability = None
+        # what changed since which version, see deltas.py
+        self.changes = Changes()
+        # what next() produced over game time, see timeseries.py
+        self.series = TimeSeries()
+        # why machine groups fell short, off until enabled, see bottlenecks.py
+        self.bottlenecks = Bottlenecks()
+        # sections still shared with a fork, copied before they change
+        self.shared = set()
         self.clear()
+        # to rewind to, the sim doesn't know about commands so whoever runs them records these
+        self.checkpoints = Checkpoints(self)
 
     def launch(self):
         if self.current_items['rocket-part'] >= 100:
             self.current_items['rocket-part'] -= 100
+            self.touch_items(('rocket-part',))
+            self.version += 1
             return True
         return False
     
-    # TODO: error message on crafting can return the full missing list
     def craft(self, item, amount):
-        res, missing, available, msg = craftable(self, item, amount)
-        if res == 0:
+        plan = plan_craft(self, {item: amount})
+        if plan.res == 0:
+            missing = plan.missing
             missing[item] = amount
-            self.deduct_list(available)
+            self.deduct_list(plan.available)
             self.place_in_inventory(self.data.recipes[item]['products'][0]['name'], amount)
             time_spent = self.craft_time_list(missing)
-            print(time_spent)
+            log.debug('crafting %s %s takes %s seconds', amount, item, time_spent)
             # put excess production into player inventory based on bulk orders 
             self.grant_excess_production(missing)
             if time_spent > 0:
                 self.next(time_spent)
+            self.version += 1
             return 0, None
-        elif res == 2:
-            return 1, f'crafting {amount} {item} failed, {msg}'
+        elif plan.res == 2:
+            msg = f'crafting {amount} {item} failed, {plan.msg}'
+            if plan.short:
+                msg += ', missing ' + ', '.join(f'{n} {x}' for x, n in plan.short.items())
+            return 1, msg
         else:
-            return 1, f'something went wrong, {msg}'
+            return 1, f'something went wrong, {plan.msg}'
 
+    @timed('next')
     def next(self, seconds, check_rates=False):
         # simulate factory production, moving forwards in time
         # depends on current state of inventory before next() was called.
         # next(60) + next(60) != next(120), because state changes after each call 
-        def produce(ci):
-            # potential = amount_of_machines * craft_speed * seconds // energy
-            def p_eq(amount_machines, amount_produced, speed, seconds, energy):
-                return amount_machines * speed * amount_produced * (seconds if energy == 1 else (seconds // energy))
-
-            def miner_potential(miner, item, amount, seconds):
-                return p_eq(amount, 1, self.data.mining_drills[miner]['mining_speed'], seconds, 1)
-
-            def assembler_potential(assembler, item, amount, seconds):
-                return p_eq(amount, self.data.recipes[item]['products'][0]['amount'], self.data.assemblers[assembler]['crafting_speed'], seconds, self.data.recipes[item]['energy'])
-
-            def furnace_potential(furnace, item, amount, seconds):
-                return p_eq(amount, 1, self.data.furnaces[furnace]['crafting_speed'], seconds, self.data.recipes[item]['energy'])
-
-            def machine_craft(item, num_produced, ci):
-                if item not in self.data.resources:
-                    self.deduct_list(shopping_list(self.data.recipes, {item: num_produced}), ci)
-                    self.place_in_inventory(self.data.recipes[item]['products'][0]['name'], num_produced, ci)
-                else:
-                    self.place_in_inventory(item, num_produced, ci)
-
-            def miner_actual(item, potential):
-                return potential 
-
-            def assembler_actual(item, potential):
-                # respect rate limits
-                if item in self.limited_items:
-                    # should almost always be > 0 but if the limit was set after getting a lot of items we could go negative
-                    potential = min(potential, max(0, self.limited_items[item] - ci[item]))
-                # find the bottleneck ingredient ratio and multiply by amount produced by recipe
-                # TODO: can we surface the bottleneck information to the player? 
-                a = min([ci[x] // amount for x, amount in shopping_list(self.data.recipes, {item:1}).items()]) * self.data.recipes[item]['products'][0]['amount']
-
-                return min(a, potential) 
-
-            def furnace_actual(item, potential):
-                return assembler_actual(item, potential) 
-
-            prod_rates = defaultdict(lambda: defaultdict(int))
-            calc_actual = {0: miner_actual, 1: assembler_actual, 2: furnace_actual}
-            calc_potential = {0: miner_potential, 1: assembler_potential, 2: furnace_potential}
-            # core algo: for each machine: potential -> actual -> craft
-            # TODO: ordering of machines processed matters, because inventory is affected immediately
-            # players probably will probably want more control of this ordering
-            # having something deterministic will help with testing as well
-            
-            # iterate through sorted keys - sort by priority! 
-            for machine_item_key, amount in sorted(self.machines.items(), key=lambda item: int(item[0].split(':')[-1])):
-                item, machine, _ = machine_item_key.split(':')
-                key = self.data.machines[machine]
-                potential = calc_potential[key](machine, item, amount, seconds)  
-                actual = calc_actual[key](item, potential) 
-                prod_rates[item]['potential'] += potential 
-                prod_rates[item]['actual'] += actual
-                machine_craft(item, actual, ci)
-
-            return prod_rates
-
-        # ---- end of produce() helper function                    
         if check_rates:
             ci = self.current_items.copy()
         else:
             # move time forwards and commit to item changes
+            start = self.game_time
             self.game_time += seconds
+            self.version += 1
             ci = self.current_items
-        return produce(ci)
+        plan = self.production_plan()
+        if check_rates:
+            return plan.run(ci, seconds)
+        # anything the machines read or write may have changed
+        self.touch_items(self.plan.items)
+        before = self.stock(self.plan.items)
+        if self.bottlenecks.enabled:
+            # traced with the dict engine, every engine makes the same
+            trace = []
+            prod_rates = self.plan.run(ci, seconds, trace=trace)
+            self.bottlenecks.record(self.plan, start, seconds, trace)
+        else:
+            prod_rates = plan.run(ci, seconds)
+        self.series.record(start, self.game_time, prod_rates, before, ci)
+        return prod_rates
+
+    @timed('fast_forward')
+    def fast_forward(self, seconds, step=60):
+        # same as calling next(step) over and over for the given seconds, with
+        # next(seconds % step) at the end. Stretches where the factory runs the same
+        # every step are skipped over at once, so long horizons stay cheap
+        ticks, rest = divmod(seconds, step)
+        self.version += 1
+        self.production_plan()
+        self.touch_items(self.plan.items)
+        start = self.game_time
+        before = self.stock(self.plan.items)
+        record = None
+        if self.bottlenecks.enabled:
+            def record(trace, tick, count, period):
+                self.bottlenecks.record(self.plan, start + tick * step, step, trace, count, period)
+        prod_rates, _ = fastforward.fast_forward(self.plan, self.current_items, int(ticks), step, record)
+        self.game_time += step * int(ticks)
+        if rest > 0:
+            trace = [] if record else None
+            self.plan.run(self.current_items, rest, prod_rates=prod_rates, trace=trace)
+            if record:
+                self.bottlenecks.record(self.plan, self.game_time, rest, trace)
+            self.game_time += rest
+        self.series.record(start, self.game_time, prod_rates, before, self.current_items)
+        return prod_rates
+
+    def stock(self, items):
+        # get() so reading doesn't add zero keys to the inventory
+        return {x: self.current_items.get(x, 0) for x in items}
+
+    def production_plan(self):
+        # compiled lazily, and thrown away whenever the machines or limits change
+        if self.plan is None:
+            self.plan = ProductionPlan(self.data, self.machines, self.limited_items)
+            self.engine_plan = self.plan
+            if self.engine == 'numpy':
+                # imported here so the dict engine never pays for loading numpy
+                from vector import VectorPlan
+                self.engine_plan = VectorPlan(self.plan)
+        return self.engine_plan
 
     def place_machine(self, machine, item, amount=1):
         res, msg = is_machine_compatible(self.data, machine, item)
@@ -129,7 +168,11 @@ class Sim():
         if res != 0:
             return res, f'failed to place {amount} of {machine}, {msg}'
         priority = 0
+        self.own('machines')
         self.machines[f'{item}:{machine}:{priority}'] += amount
+        self.changes.touch('machines', (f'{item}:{machine}:{priority}',))
+        self.plan = None
+        self.version += 1
         return 0, None
 
     def mine(self, resource, amount):
@@ -148,13 +191,19 @@ class Sim():
         if res == 0:
             pl = get_potion_list(self.data.technology, tech)
             self.deduct_list(pl)
+            self.own('current_tech')
+            self.own('current_recipes')
             self.current_tech.add(tech)
+            self.changes.touch('current_tech', (tech,))
             # unlock recipes
             unlocked = []
             for effect in self.data.technology[tech]['effects']:
                 if effect['type'] == 'unlock-recipe':
                     self.current_recipes.add(effect['recipe'])
                     unlocked.append(effect['recipe'])
+            self.changes.touch('current_recipes', unlocked)
+            self.availability.researched(tech)
+            self.version += 1
             unlocked_str = '\n'.join(unlocked)
             msg = f'unlocked the following recipes:\n\n{unlocked_str}' 
         return res, msg 
@@ -183,6 +232,7 @@ class Sim():
     def deduct_item(self, item, amount, ci=None):
         if ci == None:
             ci = self.current_items
+            self.touch_items((item,))
         if ci[item] < amount:
             return 1, f'player has < {amount} of {item} in inventory'
         ci[item] -= amount
@@ -193,20 +243,28 @@ class Sim():
         # after some validation has already been done
         if ci == None:
             ci = self.current_items
+            self.touch_items(sh)
         for k, v in sh.items():
             ci[k] -= v
 
     def place_in_inventory(self, item, amount, ci=None):
         if ci == None:
             ci = self.current_items
+            self.touch_items((item,))
+            self.version += 1
         # enfore integral system - avoid very real issues
         ci[item] += int(amount)
 
+    def touch_items(self, items):
+        # the inventory counts of items may have changed
+        self.availability.touch_all(items)
+        self.changes.touch('current_items', items)
+
     def craft_time_list(self, craft_list):
         time = 0
         for name, amount in craft_list.items():
             time += craft_time(self.data, name, amount) 
-            print(time, name, amount)
+            log.debug('crafting %s %s, %s seconds so far', amount, name, time)
         return time
 
     # TODO: is this correct?
@@ -217,14 +275,22 @@ class Sim():
                 self.place_in_inventory(name, (ratio * (1 + (amount // ratio))) - amount)
 
     def set_limit(self, item, amount):
+        self.own('limited_items')
         self.limited_items[item] = amount
+        self.changes.touch('limited_items', (item,))
+        self.plan = None
+        self.version += 1
     
     def set_machine_prio(self, machine, item, oldprio, newprio):
         oldkey = f'{item}:{machine}:{oldprio}'
         newkey = f'{item}:{machine}:{newprio}'
+        self.own('machines')
         if self.machines[oldkey] > 0:
             self.machines[oldkey] -= 1
             self.machines[newkey] += 1
+            self.changes.touch('machines', (oldkey, newkey))
+            self.plan = None
+            self.version += 1
 
     def preqs_researched(self, tech):
         preq = self.data.technology[tech]['prerequisites']    
@@ -245,7 +311,16 @@ class Sim():
         return 0, None
 
     def all_researchable(self):
-        return set(filter(lambda tech: tech not in self.current_tech and self.preqs_researched(tech), self.data.technology))
+        # kept up to date as techs get researched, see availability.py
+        return self.availability.all_researchable()
+
+    def researchable_all(self):
+        # tech -> whether it can be researched right now, for every tech in all_researchable()
+        return self.availability.researchable_all()
+
+    def craftable_all(self):
+        # item -> most of it the player can craft right now, for every unlocked recipe
+        return self.availability.craftable_all()
 
     def clear(self):
         self.game_time = 0
@@ -254,6 +329,19 @@ class Sim():
         self.current_items = get_starter_inventory() 
         self.limited_items = dict() 
         self.machines = defaultdict(int)
+        self.plan = None
+        self.shared.clear()
+        self.version += 1
+        self.changes.reset(self.version)
+        self.series.truncate(self.game_time)
+        self.bottlenecks.truncate(self.game_time)
+        self.reset_availability()
+
+    def reset_availability(self):
+        if self.availability is None:
+            self.availability = Availability(self)
+        else:
+            self.availability.reset()
 
     def update_state(self, game_time, current_tech, current_recipes, current_items, machines, limited_items):
         self.game_time = game_time 
@@ -262,36 +350,121 @@ class Sim():
         self.current_items = current_items
         self.machines = machines 
         self.limited_items = limited_items 
-
-    def serialize_state(self):
+        self.plan = None
+        self.shared.clear()
+        self.version += 1
+        self.changes.reset(self.version)
+        self.series.truncate(self.game_time)
+        self.bottlenecks.truncate(self.game_time)
+        self.reset_availability()
+
+    def state_dict(self):
         # every field is sorted so that this function is deterministic. 
         # the same actions performed in a simulation should produce the exact same
         # save file every time! Important for running tests
-        def get_state():
-            return {
-                'game_time': self.game_time,
-                'current_tech': sorted(list(self.current_tech)),
-                'current_recipes': sorted(list(self.current_recipes)),
-                'current_items': dict(sorted(self.current_items.items())),
-                'machines': dict(sorted(self.machines.items())),
-                'limited_items': dict(sorted(self.limited_items.items()))
-            }
-        # Sort the outer dictionary and ensure inner dictionaries are sorted as well
-        s = {k: v if isinstance(v, (int, str, list, float)) else dict(sorted(v.items())) for k, v in get_state().items()}
-        return json.dumps(s, sort_keys=True)
+        return {
+            'game_time': self.game_time,
+            'current_tech': sorted(list(self.current_tech)),
+            'current_recipes': sorted(list(self.current_recipes)),
+            'current_items': dict(sorted(self.current_items.items())),
+            'machines': dict(sorted(self.machines.items())),
+            'limited_items': dict(sorted(self.limited_items.items()))
+        }
+
+    @timed('serialize_state')
+    def serialize_state(self):
+        return json.dumps(self.state_dict(), sort_keys=True)
+
+    def serialize_binary(self):
+        # same state as serialize_state in a fraction of the bytes, see savefile.py
+        return savefile.dumps(self.state_dict(), self.data)
 
     def deserialize_state(self, s_json):
-        s = json.loads(s_json)
+        self.load_state_dict(json.loads(s_json))
+
+    def deserialize_binary(self, raw):
+        self.load_state_dict(savefile.loads(raw, self.data))
+
+    def load_state_dict(self, s):
         self.game_time = s['game_time']
         self.current_tech = set(s['current_tech'])
         self.current_recipes = set(s['current_recipes'])
         self.current_items = defaultdict(int, s['current_items'])
         self.machines = defaultdict(int, s['machines'])
         self.limited_items = s['limited_items']
-
+        self.plan = None
+        self.shared.clear()
+        self.version += 1
+        self.changes.reset(self.version)
+        self.series.truncate(self.game_time)
+        self.bottlenecks.truncate(self.game_time)
+        self.reset_availability()
+
+    def export_state(self):
+        # exact copy of the state as bytes. serialize_state() sorts the machines,
+        # which changes the order machines with the same priority run in
+        return pickle.dumps({
+            'game_time': self.game_time,
+            'current_tech': self.current_tech,
+            'current_recipes': self.current_recipes,
+            'current_items': dict(self.current_items),
+            'machines': dict(self.machines),
+            'limited_items': self.limited_items,
+            'version': self.version,
+        })
+
+    def import_state(self, state):
+        s = pickle.loads(state)
+        self.update_state(s['game_time'], s['current_tech'], s['current_recipes'], defaultdict(int, s['current_items']), defaultdict(int, s['machines']), s['limited_items'])
+        # same state as before it was exported
+        self.version = s['version']
+        self.changes.reset(self.version)
+
+    def fork(self):
+        """
+        A copy of the sim to try things out on without touching this one. The
+        game data and the compiled production plan are shared, so are the techs,
+        recipes, machines and limits until either sim changes them, see own().
+        The inventory changes on every next() so it's copied right away. The fork
+        starts without recorded production, its first checkpoint is where it forked.
+        """
+        fork = Sim.__new__(Sim)
+        fork.data = self.data
+        fork.engine = self.engine
+        fork.version = self.version
+        fork.game_time = self.game_time
+        fork.current_items = self.current_items.copy()
+        for section in SHARED_SECTIONS:
+            setattr(fork, section, getattr(self, section))
+        self.shared.update(SHARED_SECTIONS)
+        fork.shared = set(SHARED_SECTIONS)
+        fork.plan = self.plan
+        if self.plan is not None:
+            fork.engine_plan = self.engine_plan
+        fork.changes = Changes(self.version)
+        fork.series = TimeSeries()
+        fork.bottlenecks = Bottlenecks(enabled=self.bottlenecks.enabled)
+        fork.availability = None
+        fork.reset_availability()
+        fork.checkpoints = self.checkpoints.fork(fork)
+        return fork
+
+    def own(self, section):
+        # copy a section shared with a fork before changing it
+        if section in self.shared:
+            self.shared.discard(section)
+            setattr(self, section, getattr(self, section).copy())
+
+    @timed('production')
     def production(self):
         production = self.next(60, True)
         data = [[k, v['actual'], v['potential'], self.current_items[k], (self.limited_items[k] if k in self.limited_items else '')] for k, v in production.items()]
         return data
 
-    
\ No newline at end of file
+    def recorded_production(self):
+        # same rows as production(), over the latest full minute next() recorded
+        # instead of simulating another one. None until there is one
+        latest = self.series.latest()
+        if latest is None:
+            return None
+        return [[k, actual, potential, self.current_items.get(k, 0), self.limited_items.get(k, '')] for k, (actual, potential) in latest.items()]
@@ -0,0 +1,168 @@
+"""Machines needed for target production rates, worked out for the whole recipe graph at once"""
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from data import is_machine_compatible
+from errors import FactorioError, InvalidRecipeError
+from plan import MINER, ASSEMBLER
+
+# a rocket launch uses up this many rocket parts, see Sim.launch
+ROCKET_PARTS = 100
+# units rates can be given in, as seconds
+PER = {'second': 1, 'minute': 60, 'hour': 3600}
+# rates are rounded to this many digits, so float noise doesn't ask for an extra machine
+DIGITS = 9
+
+def recipe_for(data, item, recipes=None):
+    """
+    Name of the recipe, or resource, that makes item the way the sim runs it:
+    machines only put out the first product of their recipe. recipes can pick
+    one for items several recipes make, otherwise the recipe named after the
+    item wins, then the first that makes it. None if nothing makes it.
+    """
+    if recipes and item in recipes:
+        return recipes[item]
+    if item in data.recipes or item in data.resources:
+        return item
+    for name, recipe in data.recipes.items():
+        if recipe['products'][0]['name'] == item:
+            return name
+    return None
+
+def machine_rate(data, machine, recipe):
+    # items a single machine makes per second, the same rate ProductionPlan uses
+    kind = data.machines[machine]
+    if kind == MINER:
+        return data.mining_drills[machine]['mining_speed']
+    r = data.recipes[recipe]
+    if kind == ASSEMBLER:
+        return data.assemblers[machine]['crafting_speed'] * r['products'][0]['amount'] / r['energy']
+    return data.furnaces[machine]['crafting_speed'] / r['energy']
+
+def solve(data, targets, machines=None, recipes=None, per=60):
+    """
+    What it takes to make targets, item -> amount every per seconds. 'rocket'
+    is short for the rocket parts of a launch.
+
+    Returns a dict with a row per recipe in recipes, targets first, and the items
+    nothing can make (water, wood, ...) in inputs. A row has the rate the recipe
+    has to run at, how many machines of each kind that can run it would do that,
+    and with machines (Sim.machines) what is placed already and how many more of
+    each kind would make up for what's missing. Rates are per per seconds.
+    """
+    if np is None:
+        raise FactorioError('the solver requires numpy to be installed')
+    wanted = {}
+    for item, amount in targets.items():
+        if item == 'rocket':
+            item, amount = 'rocket-part', amount * ROCKET_PARTS
+        wanted[item] = wanted.get(item, 0) + amount / per
+
+    # every recipe the targets depend on, in the order they were found
+    order = []
+    index = {}
+    inputs = []
+    input_index = {}
+    # (consumer, ingredient, ingredient per item made) for every edge of the graph
+    uses = []
+    queue = list(wanted)
+    made = {}
+    while queue:
+        item = queue.pop(0)
+        if item in made:
+            continue
+        name = recipe_for(data, item, recipes)
+        if name is None:
+            made[item] = None
+            if item not in input_index:
+                input_index[item] = len(inputs)
+                inputs.append(item)
+            continue
+        if name not in data.recipes and name not in data.resources:
+            raise InvalidRecipeError(f'no recipe or resource called {name}')
+        if name in data.recipes and data.recipes[name]['products'][0]['name'] != item:
+            raise InvalidRecipeError(f'machines running {name} only make {data.recipes[name]["products"][0]["name"]}, not {item}')
+        made[item] = name
+        index[name] = len(order)
+        order.append((name, item))
+        if name in data.recipes:
+            recipe = data.recipes[name]
+            product_amount = recipe['products'][0]['amount']
+            for ing in recipe['ingredients']:
+                uses.append((name, ing['name'], ing['amount'] / product_amount))
+                queue.append(ing['name'])
+    missing = [item for item in wanted if made[item] is None]
+    if missing:
+        raise InvalidRecipeError(f'nothing makes {", ".join(missing)}')
+
+    # rates r solve r = t + M r, M[i, j] being item i used per item j made
+    n = len(order)
+    used = np.zeros((n, n))
+    from_outside = np.zeros((len(inputs), n))
+    for consumer, ingredient, amount in uses:
+        if made[ingredient] is None:
+            from_outside[input_index[ingredient], index[consumer]] += amount
+        else:
+            used[index[made[ingredient]], index[consumer]] += amount
+    t = np.zeros(n)
+    for item, rate in wanted.items():
+        t[index[made[item]]] += rate
+    try:
+        rates = np.linalg.solve(np.eye(n) - used, t)
+    except np.linalg.LinAlgError:
+        raise InvalidRecipeError('the recipes loop back on themselves without making anything')
+
+    # machines per recipe and kind in one go, kinds that can't run a recipe get a rate of 0
+    kinds = list(data.machines)
+    per_machine = np.zeros((n, len(kinds)))
+    placed = np.zeros((n, len(kinds)))
+    for i, (name, _) in enumerate(order):
+        for k, machine in enumerate(kinds):
+            if name in data.resources and data.machines[machine] != MINER:
+                continue
+            if is_machine_compatible(data, machine, name)[0] == 0:
+                per_machine[i, k] = machine_rate(data, machine, name)
+    for key, amount in (machines or {}).items():
+        name, machine, _ = key.split(':')
+        if name in index and machine in kinds:
+            placed[index[name], kinds.index(machine)] += amount
+    runs = per_machine > 0
+    needed = np.divide(rates[:, None], per_machine, out=np.zeros_like(per_machine), where=runs)
+    placed_rates = (placed * per_machine).sum(axis=1)
+    gap = np.maximum(np.round(rates - placed_rates, DIGITS), 0)
+    more = np.divide(gap[:, None], per_machine, out=np.zeros_like(per_machine), where=runs)
+
+    rows = []
+    for i, (name, item) in enumerate(order):
+        ks = np.flatnonzero(runs[i])
+        rows.append({
+            'recipe': name,
+            'item': item,
+            'rate': round(float(rates[i]) * per, DIGITS),
+            'machines': {kinds[k]: round(float(needed[i, k]), DIGITS) for k in ks},
+            'placed': {kinds[k]: int(placed[i, k]) for k in np.flatnonzero(placed[i])},
+            'placed_rate': round(float(placed_rates[i]) * per, DIGITS),
+            'short': {kinds[k]: math.ceil(round(float(more[i, k]), DIGITS)) for k in ks if gap[i] > 0},
+        })
+    return {
+        'per': per,
+        'recipes': rows,
+        'inputs': {item: round(float(rate) * per, DIGITS) for item, rate in zip(inputs, from_outside @ rates)},
+    }
+
+def parse_per(per):
+    """'hour' -> 3600, numbers are taken as seconds"""
+    return PER[per] if per in PER else float(per)
+
+def parse_targets(args):
+    """['rocket', '1', 'iron-plate', '60'] or ['rocket:1', 'iron-plate:60'] -> {'rocket': 1.0, 'iron-plate': 60.0}"""
+    if all(':' in arg for arg in args):
+        args = [part for arg in args for part in arg.rsplit(':', 1)]
+    if len(args) % 2:
+        raise ValueError('expected pairs of item and rate')
+    return {item: float(rate) for item, rate in zip(args[::2], args[1::2])}
@@ -0,0 +1,203 @@
+"""Server sent event streams, pushed when a session's state changes instead of on a timer"""
+
+import asyncio
+import json
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+# idle streams get a comment this often, so dead connections get noticed
+KEEPALIVE = 30
+
+HEADERS = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: text/event-stream\r\n'
+    b'Cache-Control: no-cache\r\n'
+    b'Connection: keep-alive\r\n'
+)
+NOT_FOUND = b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+def sse_frame(payload):
+    # payload is a json string, so it never spans lines
+    return f'data: {payload}\n\n'.encode()
+
+def resync_frame(version):
+    # the subscriber missed a delta, it catches up with /delta?since=<its version>
+    return f'event: resync\ndata: {json.dumps({"version": version})}\n\n'.encode()
+
+class Topic():
+    """The latest frame of one stream of one session, shared by all its subscribers"""
+    def __init__(self):
+        self.version = -1
+        self.frame = None
+        # version the frame is a delta from, None when it stands on its own
+        self.since = None
+        # replaced on every new frame, waiters on the old one wake up
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+
+class StreamHub():
+    """
+    Event streams for every session, run by one asyncio loop in a background
+    thread. frames() hands a stream to the web app to send on its own origin.
+    listen() also serves them on a port of their own, where a connection is a
+    coroutine and idle tabs cost no thread.
+
+    kinds:       stream name -> function(session, since) returning the payload as a json
+                 string, served at /<name>?session=<token>. since is the version
+                 of the previous frame, None for the first one
+    checked_out: contextmanager(token) yielding a session with its lock held
+
+    The server calls publish() after every request. When the sim's version moved
+    on and someone is listening, the payload is built once and every subscriber
+    is sent the same bytes. A slow subscriber skips to the latest frame, or gets
+    a resync event when frames are deltas it can't apply.
+    """
+    def __init__(self, kinds, checked_out):
+        self.kinds = kinds
+        self.checked_out = checked_out
+        # (token, kind) -> Topic, only touched by the loop thread
+        self.topics = {}
+        # (token, kind) -> version last handed to the loop, written with the session lock held
+        self.published = {}
+        self.loop = None
+        self.port = None
+        # sent to the port's subscribers as Access-Control-Allow-Origin
+        self.origin = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the loop the streams run on, does nothing if it's already running"""
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                self.loop = loop
+
+    def listen(self, host='127.0.0.1', port=0, origin=None):
+        """
+        Also serve the streams on host:port, returns the port. origin is the
+        page allowed to read them from there. Does nothing if already listening
+        """
+        self.start()
+        with self.lock:
+            if self.port is None:
+                server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self.handle, host, port), self.loop).result()
+                self.port = server.sockets[0].getsockname()[1]
+                self.origin = origin
+            return self.port
+
+    def frames(self, token, kind):
+        """The stream kind of session token as a blocking generator of bytes, for a WSGI response"""
+        self.start()
+        frames = self.stream((token, kind))
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(frames.__anext__(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            # the client went away, the server closes the response
+            asyncio.run_coroutine_threadsafe(frames.aclose(), self.loop).result()
+
+    def publish(self, session):
+        """Push the session's state to its subscribers if it changed, call with the session lock held"""
+        if self.loop is None:
+            return
+        sim = session.sim
+        for kind, build in self.kinds.items():
+            key = (session.token, kind)
+            since = self.published.get(key)
+            if key not in self.topics or since == sim.version:
+                continue
+            self.published[key] = sim.version
+            self.loop.call_soon_threadsafe(self.deliver, key, sim.version, since, sse_frame(build(session, since)))
+
+    def snapshot(self, key):
+        # first frame of a new topic, runs in the loop's executor since it waits on the session lock
+        token, kind = key
+        with self.checked_out(token) as session:
+            self.published[key] = session.sim.version
+            return session.sim.version, None, sse_frame(self.kinds[kind](session, None))
+
+    def deliver(self, key, version, since, frame):
+        topic = self.topics.get(key)
+        # a snapshot can finish after a newer publish
+        if topic is None or version <= topic.version:
+            return
+        topic.version, topic.since, topic.frame = version, since, frame
+        changed, topic.changed = topic.changed, asyncio.Event()
+        changed.set()
+
+    def route(self, head):
+        # (token, kind) for a request head, None if it isn't a stream
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or parts[0] != 'GET':
+            return None
+        url = urlsplit(parts[1])
+        kind = url.path.lstrip('/')
+        if kind not in self.kinds:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        token = parse_qs(url.query).get('session', [None])[0] or headers.get('x-session') or 'default'
+        return token, kind
+
+    async def stream(self, key):
+        """Frames of the stream for key, (token, kind), until the subscriber goes away"""
+        topic = self.topics.get(key)
+        new = topic is None
+        if new:
+            topic = self.topics[key] = Topic()
+        topic.subscribers += 1
+        try:
+            if new:
+                self.deliver(key, *await self.loop.run_in_executor(None, self.snapshot, key))
+            sent = None
+            sent_version = None
+            while True:
+                changed = topic.changed
+                if topic.frame is not sent:
+                    # the topic can move on while the frame is being sent
+                    sent, since, previous, sent_version = topic.frame, topic.since, sent_version, topic.version
+                    if since is not None and since != previous:
+                        yield resync_frame(sent_version)
+                    else:
+                        yield sent
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+        finally:
+            topic.subscribers -= 1
+            if topic.subscribers == 0:
+                del self.topics[key]
+                self.published.pop(key, None)
+
+    async def handle(self, reader, writer):
+        # a subscriber on the port from listen()
+        frames = None
+        try:
+            key = self.route(await reader.readuntil(b'\r\n\r\n'))
+            if key is None:
+                writer.write(NOT_FOUND)
+                await writer.drain()
+                return
+            writer.write(HEADERS)
+            if self.origin is not None:
+                writer.write(f'Access-Control-Allow-Origin: {self.origin}\r\n'.encode())
+            writer.write(b'\r\n')
+            frames = self.stream(key)
+            async for frame in frames:
+                writer.write(frame)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            if frames is not None:
+                await frames.aclose()
+            writer.close()
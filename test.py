@@ -1,9 +1,45 @@
+import ast
+import json
+import os
+import pickle
+import socket
+import sys
+import tempfile
 import unittest
+from unittest import mock
 from types import SimpleNamespace
 
 
-from utils import shopping_list
-from files import load_files
+from utils import shopping_list, raw_materials
+from files import load_files, parse_files, compact
+import files
+from sim import Sim
+import vector
+from craft import max_craftable, plan_craft
+import batch
+import client
+from sessions import SessionPool
+from commands import CommandRunner
+from deltas import delta, apply_delta
+from history import RequestLog
+import savefile
+from errors import SaveFileError, InvalidRecipeError
+
+# everything the tests write goes here instead of the working tree
+scratch = None
+
+def setUpModule():
+    global scratch
+    scratch = tempfile.TemporaryDirectory()
+    files.CACHE_DIR = os.path.join(scratch.name, '.cache')
+    files.CACHE_FILE = os.path.join(files.CACHE_DIR, 'data.pickle')
+    # server opens its request log when it's imported
+    os.environ['HISTORY_LOG'] = os.path.join(scratch.name, 'logs', 'requests.jsonl')
+
+def tearDownModule():
+    if 'server' in sys.modules:
+        sys.modules['server'].request_log.close()
+    scratch.cleanup()
 
 class Test(unittest.TestCase):
     def test_shopping_list_level0(self):
@@ -20,4 +56,495 @@ class Test(unittest.TestCase):
             'stone-furnace': 1, 
         }
 
-        self.assertDictEqual(actual, expected)
\ No newline at end of file
+        self.assertDictEqual(actual, expected)
+
+    def test_raw_materials(self):
+        data_dict = load_files()
+        data = SimpleNamespace(**data_dict) 
+        request = {
+            'electronic-circuit': 3, 
+        }
+        actual = raw_materials(data.recipes, request)
+        expected = {
+            'iron-ore': 3, 
+            'copper-ore': 5, 
+        }
+
+        self.assertDictEqual(actual, expected)
+
+    @unittest.skipIf(vector.np is None, 'numpy is not installed')
+    def test_numpy_engine_matches_dict(self):
+        data_dict = load_files()
+        with open('fullgame_save.json') as save_file:
+            save = save_file.read()
+        results = []
+        for engine in ('dict', 'numpy'):
+            sim = Sim(data_dict, engine)
+            sim.deserialize_state(save)
+            rates = [sim.next(seconds) for seconds in (60, 60, 600, 7.5)]
+            results.append(([{k: dict(v) for k, v in r.items()} for r in rates], sim.serialize_state()))
+
+        self.assertEqual(results[0], results[1])
+
+    def test_fast_forward_matches_next(self):
+        data_dict = load_files()
+        with open('demo.json') as save_file:
+            save = save_file.read()
+        stepped = Sim(data_dict)
+        stepped.deserialize_state(save)
+        for _ in range(180):
+            stepped.next(60)
+        stepped.next(30)
+        jumped = Sim(data_dict)
+        jumped.deserialize_state(save)
+        jumped.fast_forward(180 * 60 + 30, 60)
+
+        self.assertEqual(stepped.serialize_state(), jumped.serialize_state())
+
+    def test_next_rejects_steps_below_one(self):
+        runner = CommandRunner(Sim(load_files()))
+        self.assertEqual(runner.run('next 1 -s 0'), (1, 'argument -s/--step: has to be positive, got 0'))
+        self.assertEqual(runner.sim.game_time, 0)
+
+        import server
+        app = server.app.test_client()
+        headers = {'X-Session': 'step'}
+        self.assertEqual(app.post('/next?minutes=1&step=0', headers=headers).status_code, 400)
+        self.assertEqual(app.post('/next?minutes=1&step=-1', headers=headers).status_code, 400)
+        self.assertEqual(float(app.get('/time', headers=headers).text), 0)
+
+    def test_series_adds_up_to_next(self):
+        data_dict = load_files()
+        with open('demo.json') as save_file:
+            save = save_file.read()
+        sim = Sim(data_dict)
+        sim.deserialize_state(save)
+        start = sim.game_time
+        rates = []
+        for seconds in (45, 30, 600, 90):
+            rates.append(sim.next(seconds))
+            sim.checkpoints.record(f'next {seconds}')
+        total = sum(r['iron-plate']['actual'] for r in rates)
+
+        for resolution in ('raw', '1m', '10m'):
+            buckets = sim.series.range(resolution, items=['iron-plate'])
+            self.assertEqual(buckets[0]['start'], start)
+            self.assertAlmostEqual(sum(b['items']['iron-plate']['actual'] for b in buckets), total)
+            self.assertEqual(buckets[-1]['items']['iron-plate']['stock'], sim.current_items['iron-plate'])
+        self.assertEqual(len(sim.series.range('raw')), 4)
+        minutes = [b for b in sim.series.range('1m', items=['iron-plate']) if b['end'] - b['start'] == 60]
+        latest = sim.series.latest()
+        self.assertEqual(latest['iron-plate'][0], minutes[-1]['items']['iron-plate']['actual'])
+        # a craft's few seconds don't replace the minute
+        sim.next(0.5)
+        self.assertEqual(sim.series.latest(), latest)
+        sim.checkpoints.record('next 0.5')
+
+        # going back in time forgets what came after
+        sim.checkpoints.rewind(game_time=start + 75)
+        self.assertEqual(len(sim.series.range('raw')), 2)
+        self.assertEqual(sim.series.to_csv('raw', items=['iron-plate']).count('\n'), 3)
+
+    def test_bottlenecks_same_for_fast_forward(self):
+        data_dict = load_files()
+        with open('demo.json') as save_file:
+            save = save_file.read()
+        sims = []
+        for _ in range(3):
+            sim = Sim(data_dict)
+            sim.deserialize_state(save)
+            sims.append(sim)
+        stepped, jumped, off = sims
+        stepped.bottlenecks.enabled = jumped.bottlenecks.enabled = True
+        for _ in range(120):
+            stepped.next(60)
+        stepped.next(30)
+        jumped.fast_forward(120 * 60 + 30, 60)
+        off.fast_forward(120 * 60 + 30, 60)
+
+        # recording doesn't change the game
+        self.assertEqual(jumped.serialize_state(), off.serialize_state())
+        self.assertEqual(len(off.bottlenecks.rows), 0)
+        groups = stepped.bottlenecks.summary()
+        self.assertEqual(groups, jumped.bottlenecks.summary())
+        for group in groups:
+            self.assertEqual(group['full'] + group['capped'] + sum(group['starved'].values()), 120 * 60 + 30)
+        acid = next(g for g in groups if g['machine'] == 'sulfuric-acid:chemical-plant:0')
+        self.assertEqual(acid['latest'], 'starved:sulfur')
+
+    def test_metrics_count_commands_and_requests(self):
+        import server
+        runner = CommandRunner(Sim(load_files()))
+        runner.run_lines(['mine stone 10', 'craft stone-furnace', 'next 2', 'next'])
+        self.assertEqual(runner.timings.totals['next'][0], 2)
+        self.assertEqual(runner.timings.report().splitlines()[0].split(), ['command', 'calls', 'seconds', 'mean', 'ms', 'share'])
+
+        app = server.app.test_client()
+        app.post('/next?minutes=1')
+        text = app.get('/metrics').get_data(as_text=True)
+        samples = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+        self.assertGreaterEqual(int(samples['factorio_request_seconds_count{endpoint="next"}']), 1)
+        self.assertEqual(samples['factorio_request_seconds_bucket{endpoint="next",le="+Inf"}'], samples['factorio_request_seconds_count{endpoint="next"}'])
+        self.assertGreaterEqual(int(samples['factorio_sim_calls_total{function="next"}']), 3)
+
+    def test_solver_machines_for_target_rates(self):
+        import solver
+        sim = Sim(load_files())
+        sim.machines['iron-ore:burner-mining-drill:0'] = 2
+        answer = solver.solve(sim.data, {'electronic-circuit': 60}, sim.machines)
+        rows = {row['recipe']: row for row in answer['recipes']}
+
+        self.assertEqual(answer['recipes'][0]['recipe'], 'electronic-circuit')
+        self.assertEqual(rows['copper-cable']['rate'], 180)
+        self.assertEqual(rows['iron-plate']['machines'], {'stone-furnace': 3.2, 'steel-furnace': 1.6, 'electric-furnace': 1.6})
+        # 2 drills make 30 ore a minute, 2 more catch up with the furnaces
+        self.assertEqual(rows['iron-ore']['placed_rate'], 30)
+        self.assertEqual(rows['iron-ore']['short'], {'burner-mining-drill': 2, 'electric-mining-drill': 1})
+        self.assertEqual(solver.solve(sim.data, {'rocket': 1}, per=3600)['recipes'][0]['rate'], 100)
+        with self.assertRaises(InvalidRecipeError):
+            solver.solve(sim.data, {'petroleum-gas': 1}, recipes={'petroleum-gas': 'advanced-oil-processing'})
+
+    def test_search_script_reaches_goal(self):
+        import search
+        data_dict = load_files()
+        goal = search.Goal(SimpleNamespace(**data_dict), 'automation-science-pack', 5)
+        result = search.search(goal, Sim(data_dict), width=3, steps=40, budget=30, workers=1)
+
+        self.assertTrue(result['found'])
+        # the script does the same when the shell runs it
+        sim = Sim(data_dict)
+        results = CommandRunner(sim).run_lines(result['lines'])
+        self.assertEqual([res for _, res, _ in results], [0] * len(result['lines']))
+        self.assertGreaterEqual(sim.current_items['automation-science-pack'], 5)
+        self.assertEqual(sim.game_time, result['game_time'])
+
+    def test_fork_and_what_if_leave_the_sim_alone(self):
+        import whatif
+        data_dict = load_files()
+        with open('demo.json') as save_file:
+            save = save_file.read()
+        sim = Sim(data_dict)
+        sim.deserialize_state(save)
+        before = sim.export_state()
+        fork = sim.fork()
+        self.assertIs(fork.machines, sim.machines)
+        CommandRunner(fork).run_lines(['spawn stone-furnace 5', 'place stone-furnace iron-plate 5', 'next 10'])
+        self.assertIsNot(fork.machines, sim.machines)
+        self.assertEqual(sim.export_state(), before)
+        # same as doing it on a copy of the state
+        copy = Sim(data_dict)
+        copy.import_state(before)
+        CommandRunner(copy).run_lines(['spawn stone-furnace 5', 'place stone-furnace iron-plate 5', 'next 10'])
+        self.assertEqual(fork.serialize_state(), copy.serialize_state())
+
+        answer = whatif.evaluate(sim, [['spawn stone-furnace 5', 'place stone-furnace iron-plate 5'], ['research nothing']], 600)
+        self.assertEqual(sim.export_state(), before)
+        first, second = answer['candidates']
+        self.assertTrue(first['ok'])
+        self.assertGreater(first['production']['iron-plate'], 0)
+        self.assertFalse(second['ok'])
+        self.assertEqual(second['production'], {})
+
+        import server
+        app = server.app.test_client()
+        headers = {'X-Session': 'whatif'}
+        r = app.post('/whatif', json={'candidates': ['mine stone 10'], 'minutes': 1}, headers=headers)
+        self.assertEqual(r.get_json()['candidates'][0]['inventory'], {'stone': 10})
+        self.assertEqual(float(app.get('/time', headers=headers).text), 0)
+        self.assertEqual(app.post('/whatif', json={'candidates': 'mine'}, headers=headers).status_code, 400)
+        too_many = ['mine stone 1'] * (whatif.MAX_CANDIDATES + 1)
+        self.assertEqual(app.post('/whatif', json={'candidates': too_many}, headers=headers).status_code, 400)
+        self.assertEqual(app.post('/whatif', json={'candidates': ['mine stone 1'], 'minutes': 61}, headers=headers).status_code, 400)
+
+    def test_what_if_stops_at_the_horizon(self):
+        import whatif
+        sim = Sim(load_files())
+        with open('demo.json') as save_file:
+            sim.deserialize_state(save_file.read())
+        candidates = [['next 600 -s 1', 'spawn iron-plate 1'], ['next 5', 'mine stone 100000', 'spawn iron-plate 1'], ['next 5']]
+        answer = whatif.evaluate(sim, candidates, 600)
+        results = [[(r['command'], r['res'], r['msg']) for r in c['results']] for c in answer['candidates']]
+
+        self.assertEqual(results[0], [('next 600 -s 1', 1, whatif.PAST_HORIZON)])
+        self.assertEqual(results[1], [('next 5', 0, None), ('mine stone 100000', 1, whatif.PAST_HORIZON)])
+        self.assertEqual(results[2], [('next 5', 0, None)])
+        # every candidate is compared over the same game time
+        for candidate in answer['candidates']:
+            self.assertEqual(candidate['game_time'], sim.game_time + 600)
+        self.assertEqual(answer['baseline']['game_time'], sim.game_time + 600)
+        self.assertNotIn('stone', answer['candidates'][1]['inventory'])
+
+    def test_batch_variants_match_sequential(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as script:
+            script.write('mine stone $stone\ncraft stone-furnace\nspawn iron-plate 10\nplace stone-furnace iron-plate\nnext $minutes\n')
+        self.addCleanup(os.unlink, script.name)
+        jobs = batch.make_jobs([script.name], {'stone': ['5', '20'], 'minutes': ['1', '3']})
+        parallel = batch.run_batch(jobs, workers=2)
+        sequential = batch.run_batch(jobs, workers=1)
+
+        self.assertEqual(len(parallel), 4)
+        self.assertEqual([r['state'] for r in parallel], [r['state'] for r in sequential])
+        times = [r['game_time'] for r in parallel]
+        self.assertEqual([times[1] - times[0], times[3] - times[2]], [120, 120])
+
+    def test_local_backend_matches_server_responses(self):
+        backend = client.LocalBackend(Sim(load_files()))
+
+        self.assertEqual(backend.mine('stone', 5), 'pog')
+        self.assertEqual(backend.craft('stone-furnace', 1), 'pog')
+        self.assertEqual(backend.craftable('stone-furnace', 1), 'not pog')
+        self.assertEqual(backend.place('stone-furnace', 'iron-plate', 1), 'pog')
+        self.assertEqual(backend.launch(), 'NOT ENOUGH ROCKET PARTS')
+        backend.next(1)
+        self.assertEqual(backend.get_game_time(), 65.5)
+        # the shell parses production the same way it parses the server response
+        self.assertEqual(ast.literal_eval(backend.production()), Sim.production(backend.sim))
+
+    def test_data_cache_matches_json(self):
+        cached = load_files()
+        fresh = compact(parse_files())
+
+        self.assertEqual(cached, fresh)
+        self.assertEqual(cached, load_files(use_cache=False))
+        with open(files.CACHE_FILE, 'rb') as cache:
+            self.assertEqual(files.cache_key(), pickle.load(cache)['key'])
+
+    def test_server_sends_game_time_and_version(self):
+        import server
+        app = server.app.test_client()
+        before = app.get('/limits')
+        after = app.post('/mine?resource=stone&amount=10')
+
+        self.assertEqual(float(after.headers['X-Game-Time']), server.pool.active['default'].sim.game_time)
+        self.assertGreater(int(after.headers['X-State-Version']), int(before.headers['X-State-Version']))
+        self.assertEqual(app.get('/limits').headers['X-State-Version'], after.headers['X-State-Version'])
+
+    def test_server_batch_stops_on_error(self):
+        import server
+        app = server.app.test_client()
+        app.post('/clear')
+        commands = ['mine stone 5', 'craft stone-furnace', 'save hack.json', 'next 2', 'craft iron-chest 100', 'next 1']
+        results = app.post('/batch', json={'commands': commands, 'stop_on_error': True}).get_json()['results']
+
+        self.assertEqual([r['res'] for r in results], [0, 0, 1])
+        self.assertEqual(len(app.post('/batch', json={'commands': commands}).get_json()['results']), 6)
+        self.assertEqual(app.post('/batch', json=['next']).status_code, 400)
+        self.assertEqual(app.post('/batch', json={'commands': [1]}).status_code, 400)
+        self.assertEqual(app.post('/batch', json={'commands': [['mine']]}).status_code, 400)
+
+    def test_craftable_all_cached_until_state_changes(self):
+        sim = Sim(load_files())
+        self.addCleanup(client.use_backend, client.backend)
+        client.use_backend(client.LocalBackend(sim))
+        sim.place_in_inventory('stone', 12)
+        first = client.craftable_all()
+
+        self.assertEqual(first['stone-furnace'], 2)
+        self.assertIs(client.craftable_all(), first)
+        client.mine('stone', 5)
+        self.assertEqual(client.craftable_all()['stone-furnace'], 3)
+
+    def test_availability_matches_full_recompute(self):
+        sim = Sim(load_files())
+        with open('fullgame_save.json') as save_file:
+            sim.deserialize_state(save_file.read())
+        sim.craftable_all()
+        sim.researchable_all()
+        sim.next(600)
+        sim.research('automation-3')
+        sim.craft('assembling-machine-1', 5)
+
+        frontier = {tech for tech in sim.data.technology if tech not in sim.current_tech and sim.preqs_researched(tech)}
+        self.assertEqual(sim.all_researchable(), frontier)
+        self.assertEqual(sim.researchable_all(), {tech: sim.researchable(tech)[0] == 0 for tech in sorted(frontier)})
+        self.assertEqual(sim.craftable_all(), {item: max_craftable(sim, item) for item in sorted(sim.current_recipes)})
+
+    def test_plan_craft_shared_order(self):
+        sim = Sim(load_files())
+        sim.current_items.clear()
+        sim.place_in_inventory('iron-plate', 20)
+        sim.place_in_inventory('copper-plate', 2)
+        plan = plan_craft(sim, {'inserter': 1, 'electronic-circuit': 1})
+
+        self.assertEqual(plan.res, 2)
+        self.assertEqual(plan.short, {'copper-plate': 1})
+        # both circuits' 6 cables are crafted at once, 3 crafts instead of 2 + 2
+        sim.place_in_inventory('copper-plate', 1)
+        plan = plan_craft(sim, {'inserter': 1, 'electronic-circuit': 1})
+        self.assertEqual(plan.res, 0)
+        self.assertEqual(plan.missing, {'electronic-circuit': 1, 'iron-gear-wheel': 1, 'copper-cable': 6})
+        self.assertEqual(plan.available, {'iron-plate': 5, 'copper-plate': 3})
+        self.assertEqual(max_craftable(sim, 'iron-gear-wheel'), 10)
+
+    def test_sessions_evicted_and_restored(self):
+        pool = SessionPool(load_files(), size=2)
+        for token in ('a', 'b', 'c'):
+            session = pool.checkout(token)
+            session.sim.place_machine('burner-mining-drill', 'stone')
+            session.sim.place_in_inventory('burner-mining-drill', 2)
+            session.sim.place_machine('burner-mining-drill', 'iron-ore')
+            session.sim.next(60 * len(token * 3))
+            pool.checkin(session)
+        before = pool.active['b'].sim.export_state()
+
+        self.assertEqual(list(pool.active), ['b', 'c'])
+        self.assertIn('a', pool.evicted)
+        pool.checkout('a')
+        self.assertEqual(list(pool.active), ['c', 'a'])
+        restored = pool.checkout('b')
+        self.assertEqual(pickle.loads(restored.sim.export_state()), pickle.loads(before))
+        self.assertEqual(list(restored.sim.machines), ['stone:burner-mining-drill:0', 'iron-ore:burner-mining-drill:0'])
+
+    def test_sessions_evicted_are_capped(self):
+        pool = SessionPool(load_files(), size=1, keep=2)
+        for token in ('a', 'b', 'c', 'd'):
+            pool.checkin(pool.checkout(token))
+
+        self.assertEqual(list(pool.evicted), ['b', 'c'])
+        self.assertEqual(pool.checkout('a').sim.machines, {})
+
+    def test_deltas_rebuild_the_state(self):
+        sim = Sim(load_files())
+        runner = CommandRunner(sim)
+        state = apply_delta(None, delta(sim))
+        with open('fullgame_script.txt') as script:
+            lines = script.read().splitlines()
+        for i, line in enumerate(lines):
+            runner.run(line)
+            if i % 7 == 0:
+                state = apply_delta(state, delta(sim, state['version']))
+        state = apply_delta(state, delta(sim, state['version']))
+        last = delta(sim, state['version'])
+
+        self.assertEqual(state, apply_delta(None, delta(sim)))
+        self.assertEqual((last['full'], last['current_items'], last['current_tech']), (False, {}, []))
+        sim.clear()
+        self.assertTrue(delta(sim, state['version'])['full'])
+
+    def test_rewind_matches_replay(self):
+        sim = Sim(load_files())
+        runner = CommandRunner(sim)
+        with open('fullgame_script.txt') as script:
+            lines = script.read().splitlines()
+        # the latest checkpoints are one per command, older ones get thinned out
+        runner.run_lines(lines[:-20])
+        middle = sim.export_state()
+        index = sim.checkpoints.index
+        runner.run_lines(lines[-20:])
+        end = sim.export_state()
+        machines = list(sim.machines)
+
+        self.assertEqual(runner.run(f'rewind {index}')[0], 0)
+        self.assertEqual(pickle.loads(sim.export_state())['current_items'], pickle.loads(middle)['current_items'])
+        runner.run_lines(lines[-20:])
+        self.assertEqual({k: v for k, v in pickle.loads(sim.export_state()).items() if k != 'version'},
+                         {k: v for k, v in pickle.loads(end).items() if k != 'version'})
+        self.assertEqual(list(sim.machines), machines)
+        self.assertLess(len(sim.checkpoints.points), 130)
+
+        import server
+        app = server.app.test_client()
+        headers = {'X-Session': 'rewind'}
+        app.post('/mine?resource=stone&amount=5', headers=headers)
+        app.post('/mine?resource=coal&amount=5', headers=headers)
+        self.assertEqual(app.post('/undo', headers=headers).get_json()['command'], '/mine?resource=stone&amount=5')
+        self.assertEqual(float(app.get('/time', headers=headers).text), 5)
+        self.assertEqual(app.post('/undo?n=5', headers=headers).status_code, 400)
+
+    def test_binary_save_round_trip(self):
+        sim = Sim(load_files())
+        with open('fullgame_save.json') as save:
+            sim.deserialize_state(save.read())
+        raw = sim.serialize_binary()
+        loaded = Sim(load_files())
+        loaded.deserialize_binary(raw)
+
+        self.assertLess(len(raw), len(sim.serialize_state()) / 5)
+        self.assertEqual(savefile.to_json(raw, sim.data), sim.serialize_state())
+        self.assertEqual(loaded.serialize_state(), sim.serialize_state())
+        self.assertEqual(savefile.from_json(sim.serialize_state(), sim.data), raw)
+        self.assertRaises(SaveFileError, savefile.loads, raw[:-1] + bytes([raw[-1] ^ 1]), sim.data)
+
+        import server
+        app = server.app.test_client()
+        headers = {'X-Session': 'binary'}
+        app.post('/update', data=raw, headers=headers, content_type='application/octet-stream')
+        self.assertEqual(app.get('/state?format=binary', headers=headers).data, raw)
+
+    def test_request_log_pages_past_memory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'logs', 'requests.jsonl')
+            log = RequestLog(path, size=10)
+            for i in range(3000):
+                log.record(session='other' if i == 5 else 'default', command=['craft', 'mine', 'place'][i % 3], path=f'/{i}')
+            ids = lambda entries: [e['id'] for e in entries]
+
+            self.assertEqual(len(log.entries), 10)
+            self.assertEqual(ids(log.page(after=1020, limit=5)), [1021, 1022, 1023, 1024, 1025])
+            self.assertEqual(ids(log.page(before=2050, limit=4, command='mine')), [2038, 2041, 2044, 2047])
+            self.assertEqual(ids(log.page(after=2985, command='place')), [2987, 2990, 2993, 2996, 2999])
+            self.assertEqual(ids(log.page(limit=3)), [2997, 2998, 2999])
+            self.assertEqual(ids(log.page(session='other')), [5])
+            self.assertEqual(log.page(session='nobody'), [])
+            # only the chunks with the session are read
+            self.assertEqual(log.chunks(0, 3000, {('session', 'other')}), [0])
+            with open(path + '.index') as index:
+                self.assertEqual(len(index.readlines()), 2)
+            log.close()
+            # a crash half way through a line
+            with open(path, 'a') as f:
+                f.write('{"id": 30')
+            log = RequestLog(path, size=10)
+            log.record(session='default', command='mine', path='/3000')
+            self.assertEqual(ids(log.page(before=3, limit=10)), [0, 1, 2])
+            self.assertEqual(ids(log.page(after=2997)), [2998, 2999, 3000])
+            self.assertEqual(ids(log.page(before=1000, session='other')), [5])
+            log.close()
+            # without the index the log is read once to build it again
+            os.remove(path + '.index')
+            log = RequestLog(path, size=10)
+            self.assertEqual(ids(log.page(before=2050, limit=4, command='mine')), [2038, 2041, 2044, 2047])
+            self.assertEqual(log.chunks(0, 3001, {('session', 'other')}), [0])
+            log.close()
+
+    def test_stream_pushes_only_changes(self):
+        import server
+        app = server.app.test_client()
+        response = app.get('/stateping?session=streams', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        stream = iter(response.response)
+
+        def frame(data):
+            return json.loads(data[len(b'data: '):])
+
+        first = frame(next(stream))
+        app.post('/spawn?item=iron-plate&amount=7', headers={'X-Session': 'streams'})
+        second = frame(next(stream))
+        self.assertEqual(second['current_items'], {'iron-plate': first['current_items'].get('iron-plate', 0) + 7})
+        self.assertEqual(second['since'], first['version'])
+        # the hub's own port, only used when STREAM_PORT is set
+        port = server.hub.listen()
+        with mock.patch.dict(os.environ, {'STREAM_PORT': str(port)}):
+            self.assertIn(f':{port}/stateping?session=streams', app.get('/stateping?session=streams').location)
+        conn = socket.create_connection(('127.0.0.1', port), timeout=5)
+        conn.sendall(b'GET /stateping HTTP/1.1\r\nX-Session: streams\r\n\r\n')
+        other = conn.makefile('rb')
+        while other.readline() != b'\r\n':
+            pass
+        # a late subscriber can't apply the next delta, it has to catch up first
+        app.post('/mine?resource=stone&amount=1', headers={'X-Session': 'streams'})
+        self.assertEqual(other.readline(), b'event: resync\n')
+        other.readline()
+        other.readline()
+        stone = first['current_items'].get('stone', 0) + 1
+        self.assertEqual(frame(next(stream))['current_items']['stone'], stone)
+        self.assertEqual(frame(other.readline())['current_items']['stone'], stone)
+        other.readline()
+        # nothing changed, nothing sent
+        app.get('/inventory', headers={'X-Session': 'streams'})
+        app.post('/spawn?item=iron-plate&amount=7')
+        conn.settimeout(0.3)
+        self.assertRaises(socket.timeout, other.readline)
+        response.close()
+        other.close()
+        conn.close()
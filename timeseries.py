@@ -0,0 +1,145 @@
+"""Production over game time, recorded as next() runs the factory, at a few resolutions"""
+
+from array import array
+import csv
+import io
+import math
+
+# name -> bucket width in seconds, 0 keeps every next() as a sample of its own
+RESOLUTIONS = {'raw': 0, '1m': 60, '10m': 600}
+FIELDS = ('actual', 'potential', 'stock')
+
+class Ring():
+    """
+    The latest size buckets of one resolution, stored by column: an array per
+    item and field, indexed by slot. A bucket's key is game time // width, or
+    the sample number for raw. actual and potential are summed over a bucket,
+    stock is the inventory at the end of it.
+    """
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        self.keys = array('q', [-1]) * size
+        self.starts = array('d', [0.0]) * size
+        self.ends = array('d', [0.0]) * size
+        # item -> one array per field
+        self.columns = {}
+
+    def slot(self, key, start):
+        # slot for bucket key, emptied first if it still holds an older bucket
+        slot = key % self.size
+        if self.keys[slot] != key:
+            self.keys[slot] = key
+            self.starts[slot] = start
+            for column in self.columns.values():
+                for field in column:
+                    field[slot] = 0.0
+        return slot
+
+    def column(self, item):
+        if item not in self.columns:
+            self.columns[item] = tuple(array('d', [0.0]) * self.size for _ in FIELDS)
+        return self.columns[item]
+
+    def add(self, key, start, end, share, rates, stock):
+        slot = self.slot(key, start)
+        self.ends[slot] = end
+        for item, r in rates.items():
+            actual, potential, _ = self.column(item)
+            actual[slot] += r['actual'] * share
+            potential[slot] += r['potential'] * share
+        for item, count in stock.items():
+            self.column(item)[2][slot] = count
+
+    def truncate(self, time):
+        # forget every bucket that reaches past time
+        for slot in range(self.size):
+            if self.keys[slot] != -1 and self.ends[slot] > time:
+                self.keys[slot] = -1
+
+    def buckets(self, start=None, end=None):
+        slots = sorted((key, slot) for slot, key in enumerate(self.keys) if key != -1)
+        for _, slot in slots:
+            if (start is None or self.ends[slot] > start) and (end is None or self.starts[slot] < end):
+                yield slot
+
+class TimeSeries():
+    """
+    What the factory made, and the inventory, over game time. Every resolution
+    keeps the latest size buckets, a next() that spans several buckets is spread
+    over them by time, with the inventory in between drawn as a straight line.
+    When game time goes backwards (clear, load, rewind) everything after it is
+    dropped, so the bucket it lands in starts over.
+    """
+    def __init__(self, size=360):
+        self.rings = {name: Ring(width, size) for name, width in RESOLUTIONS.items()}
+        self.samples = 0
+        # game time the latest sample ends at
+        self.end = 0
+
+    def record(self, start, end, rates, before, after):
+        """
+        One run of the factory from game time start to end. rates is item ->
+        {'actual', 'potential'} for the whole run, before and after are the
+        inventory, only the items in before are kept.
+        """
+        if end <= start:
+            return
+        self.truncate(start)
+        after = {x: after.get(x, 0) for x in before}
+        span = end - start
+        for ring in self.rings.values():
+            if ring.width == 0:
+                ring.add(self.samples, start, end, 1, rates, after)
+                continue
+            w = ring.width
+            last = math.ceil(end / w) - 1
+            for key in range(max(int(start // w), last - ring.size + 1), last + 1):
+                lo, hi = max(start, key * w), min(end, (key + 1) * w)
+                f = (hi - start) / span
+                stock = {x: before[x] + (after[x] - before[x]) * f for x in before}
+                ring.add(key, lo, hi, (hi - lo) / span, rates, stock)
+        self.samples += 1
+        self.end = end
+
+    def truncate(self, time):
+        # the state went back to game time, what was recorded after it didn't happen
+        if time < self.end:
+            for ring in self.rings.values():
+                ring.truncate(time)
+            self.end = time
+
+    def range(self, resolution='1m', start=None, end=None, items=None):
+        """Buckets overlapping game time start to end, oldest first, as dicts of start, end and item -> fields"""
+        ring = self.rings[resolution]
+        out = []
+        for slot in ring.buckets(start, end):
+            columns = ring.columns.items() if items is None else ((x, ring.columns[x]) for x in items if x in ring.columns)
+            out.append({
+                'start': ring.starts[slot],
+                'end': ring.ends[slot],
+                'items': {x: dict(zip(FIELDS, (field[slot] for field in column))) for x, column in columns},
+            })
+        return out
+
+    def to_csv(self, resolution='1m', start=None, end=None, items=None):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(('start', 'end', 'item') + FIELDS)
+        for bucket in self.range(resolution, start, end, items):
+            for item, fields in sorted(bucket['items'].items()):
+                writer.writerow((bucket['start'], bucket['end'], item) + tuple(fields[f] for f in FIELDS))
+        return out.getvalue()
+
+    def latest(self):
+        """
+        actual and potential per minute over the latest full minute of game time,
+        None before there is one. Short next() calls, like the ones craft and mine
+        make, don't stand for a minute on their own
+        """
+        ring = self.rings['1m']
+        full = [slot for slot in ring.buckets() if ring.ends[slot] - ring.starts[slot] >= ring.width]
+        if not full:
+            return None
+        slot = full[-1]
+        return {x: (actual[slot], potential[slot]) for x, (actual, potential, _) in ring.columns.items() if potential[slot]}
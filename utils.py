@@ -1,6 +1,7 @@
 """Stateless functions that can exist outside the simulation"""
 from collections import defaultdict
 from errors import * 
+from fractions import Fraction
 import math
 
 # given a goal technology, return all the technologies required to unlock it,
@@ -33,6 +34,73 @@ def get_potion_list(technology, tech):
             packs[name] += amount
         return packs
 
+class RecipeIndex():
+    """
+    Recipe data flattened once so lookups don't scan every recipe.
+
+    ingredients:    recipe name -> tuple of (ingredient, amount) pairs for one craft
+    product_amount: recipe name -> amount of the first product made by one craft
+    order:          recipe name -> position in the recipe data, keeps output order stable
+    raw:            recipe name -> raw materials consumed by one craft, expanded through
+                    every intermediate recipe (items without a recipe count as raw)
+    hand_order:     hand crafting recipe name -> position in a topological order of the
+                    hand crafting recipes, every recipe comes before its ingredients
+    """
+    def __init__(self, recipes):
+        self.order = {}
+        self.ingredients = {}
+        self.product_amount = {}
+        for position, (name, recipe) in enumerate(recipes.items()):
+            self.order[name] = position
+            self.ingredients[name] = tuple((ing['name'], ing['amount']) for ing in recipe['ingredients'])
+            self.product_amount[name] = recipe['products'][0]['amount']
+        self.raw = {}
+        for name in self.ingredients:
+            self.expand(name, set())
+        # hand crafting recipes don't loop back on themselves, unlike the ones machines run
+        self.crafting = {name for name, recipe in recipes.items() if recipe['category'] == 'crafting'}
+        done = []
+        seen = set()
+        for name in self.ingredients:
+            if name in self.crafting and name not in seen:
+                self.visit(name, seen, done)
+        self.hand_order = {name: position for position, name in enumerate(reversed(done))}
+
+    def expand(self, name, visiting):
+        if name in self.raw:
+            return self.raw[name]
+        visiting.add(name)
+        raw = defaultdict(Fraction)
+        for ingredient, amount in self.ingredients[name]:
+            # recipe cycles (barrels, cracking) are cut by treating the ingredient as raw
+            if ingredient in self.ingredients and ingredient not in visiting:
+                crafts = Fraction(amount, self.product_amount[ingredient])
+                for raw_name, raw_amount in self.expand(ingredient, visiting).items():
+                    raw[raw_name] += crafts * raw_amount
+            else:
+                raw[ingredient] += amount
+        visiting.discard(name)
+        self.raw[name] = dict(raw)
+        return self.raw[name]
+
+    def visit(self, name, seen, done):
+        # depth first, a recipe is done once all of its ingredients are
+        seen.add(name)
+        for ingredient, _ in self.ingredients[name]:
+            if ingredient in self.crafting and ingredient not in seen:
+                self.visit(ingredient, seen, done)
+        done.append(name)
+
+_recipe_indexes = {}
+
+def recipe_index(recipes):
+    """Return the RecipeIndex for a recipe dict, building it on first use"""
+    entry = _recipe_indexes.get(id(recipes))
+    if entry is None or entry[0] is not recipes:
+        entry = (recipes, RecipeIndex(recipes))
+        _recipe_indexes[id(recipes)] = entry
+    return entry[1]
+
 def shopping_list(recipes, items): 
     """
     Generates a shopping list of ingredients based on the desired items and their recipes.
@@ -43,19 +111,34 @@ def shopping_list(recipes, items):
     ... }
     >>> items = {'Cake': 2, 'Pie': 3}
     >>> shopping_list(recipes, items) == {'Flour': 13, 'Sugar': 8}
-    False 
+    True
     """
-    filtered_recipes = filter(lambda z: z['name'] in items.keys(), recipes.values())
-    name_to_ing = map(lambda recipe: (recipe['name'], recipe['ingredients']), filtered_recipes)
+    index = recipe_index(recipes)
+    # ingredients are listed in recipe data order, no matter the order of the request
+    names = [name for name in items if name in index.order]
+    if len(names) > 1:
+        names.sort(key=index.order.__getitem__)
     sh = defaultdict(int) 
-    for name, ingredients in name_to_ing:
-        for ingredient in ingredients: 
-            # amount_needed always rounds up, excess production is always put in player inventory
-            # see grant_excess_production()
-            amount_needed = ingredient['amount'] * math.ceil(items[name] / recipes[name]['products'][0]['amount'])
-            sh[ingredient['name']] += amount_needed
+    for name in names:
+        # amount_needed always rounds up, excess production is always put in player inventory
+        # see grant_excess_production()
+        crafts = math.ceil(items[name] / index.product_amount[name])
+        for ingredient, amount in index.ingredients[name]:
+            sh[ingredient] += amount * crafts
     return sh 
 
+def raw_materials(recipes, items):
+    """Full bill of materials for the desired items, expanded down to raw resources"""
+    index = recipe_index(recipes)
+    totals = defaultdict(Fraction)
+    for name in items:
+        if name not in index.raw:
+            continue
+        crafts = math.ceil(items[name] / index.product_amount[name])
+        for raw_name, amount in index.raw[name].items():
+            totals[raw_name] += crafts * amount
+    return {name: math.ceil(amount) for name, amount in totals.items()}
+
 def does_recipe_exist(self, item):
     if item in self.data.recipes:
         return True
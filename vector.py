@@ -0,0 +1,207 @@
+"""Vectorized production engine, runs a ProductionPlan with numpy arrays"""
+
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from errors import FactorioError
+from plan import MINER
+
+# padding slot for ingredient columns, big enough to never be the bottleneck
+UNLIMITED = 2 ** 56
+# fewest groups a vectorized round has to settle before handing over to the dict engine
+MIN_ROUND_COST = 32
+
+class VectorPlan():
+    """
+    Same results as ProductionPlan.run(), computed with array operations.
+
+    Items are interned to integer ids and the inventory becomes a dense int64 array
+    for the duration of a run. Machine groups still see the inventory exactly as it
+    is after every group before them in priority order: each group reads the starting
+    inventory plus a prefix sum over the writes of earlier groups. All groups are
+    computed at once and the prefix sums refreshed until the results stop changing.
+    That fixed point is unique and equals the sequential result. Once a prefix of
+    groups comes out the same two rounds in a row it is final, so when scarce
+    ingredients make the final prefix grow slowly, the remaining groups are handed
+    over to the dict engine instead of iterating one group per round.
+
+    Python ints and floats are tracked separately so the production rates come out
+    with the exact same values and types as the dict engine.
+    """
+    def __init__(self, plan):
+        if np is None:
+            raise FactorioError('the numpy engine requires numpy to be installed')
+        self.plan = plan
+        self.entries = plan.entries
+        self.items = []
+        self.ids = {}
+        for item, kind, rate, energy, limit, bottleneck, ingredients, product, product_amount in self.entries:
+            # only intern what the dict engine touches, reading an item adds it to the inventory
+            touched = [product] + [x for x, _ in bottleneck] + [x for x, _ in (ingredients or ())]
+            if kind != MINER and limit is not None:
+                touched.append(item)
+            for name in touched:
+                if name not in self.ids:
+                    self.ids[name] = len(self.items)
+                    self.items.append(name)
+        self.sentinel = len(self.items)
+        # rates are reported per produced item, in order of first appearance
+        self.rate_items = list(dict.fromkeys(entry[0] for entry in self.entries))
+        self.compile()
+
+    def compile(self):
+        entries = self.entries
+        n = len(entries)
+        rate_ids = {item: i for i, item in enumerate(self.rate_items)}
+        self.rate_ids = np.array([rate_ids[e[0]] for e in entries], dtype=np.int64)
+        self.miner = np.array([e[1] == MINER for e in entries], dtype=bool)
+        self.rate = np.array([e[2] for e in entries], dtype=np.float64)
+        self.rate_is_int = np.array([isinstance(e[2], int) for e in entries], dtype=bool)
+        self.energy = np.array([e[3] for e in entries], dtype=np.float64)
+        self.energy_is_one = np.array([e[3] == 1 for e in entries], dtype=bool)
+        self.energy_is_int = np.array([isinstance(e[3], int) for e in entries], dtype=bool)
+        self.has_limit = np.array([e[1] != MINER and e[4] is not None for e in entries], dtype=bool)
+        self.limit = np.array([e[4] if e[4] is not None else 0 for e in entries], dtype=np.int64)
+        self.product_amount = np.array([e[8] for e in entries], dtype=np.int64)
+
+        # reads: one column per bottleneck ingredient, plus a last column for the limited item
+        width = max([len(e[5]) for e in entries] + [1])
+        read_ids = np.full((n, width + 1), self.sentinel, dtype=np.int64)
+        self.bottleneck_amounts = np.ones((n, width), dtype=np.int64)
+        # writes: ingredient deductions followed by the product, kept in (item, entry) order
+        writes = []
+        deduct_entry, deduct_amount = [], []
+        for j, e in enumerate(entries):
+            for col, (x, amount) in enumerate(e[5]):
+                read_ids[j, col] = self.ids[x]
+                self.bottleneck_amounts[j, col] = amount
+            if self.has_limit[j]:
+                read_ids[j, width] = self.ids[e[0]]
+            for x, amount in (e[6] or ()):
+                writes.append((self.ids[x], j, len(deduct_entry)))
+                deduct_entry.append(j)
+                deduct_amount.append(amount)
+            writes.append((self.ids[e[7]], j, -1))
+        writes.sort(key=lambda w: (w[0], w[1]))
+        self.read_ids = read_ids
+        self.deduct_entry = np.array(deduct_entry, dtype=np.int64)
+        self.deduct_amount = np.array(deduct_amount, dtype=np.int64)
+        # position of every write once sorted, deductions and products separately
+        self.deduct_slot = np.zeros(len(deduct_entry), dtype=np.int64)
+        self.product_slot = np.zeros(n, dtype=np.int64)
+        for slot, (_, j, deduct) in enumerate(writes):
+            if deduct >= 0:
+                self.deduct_slot[deduct] = slot
+            else:
+                self.product_slot[j] = slot
+        self.write_count = len(writes)
+
+        # for every read, the range of sorted writes to the same item made by earlier entries
+        write_items = np.array([w[0] for w in writes], dtype=np.int64)
+        write_entries = np.array([w[1] for w in writes], dtype=np.int64)
+        segment_start = np.searchsorted(write_items, read_ids, side='left')
+        segment_end = np.searchsorted(write_items, read_ids, side='right')
+        read_hi = segment_start.copy()
+        for j in range(n):
+            for col in range(width + 1):
+                lo, hi = segment_start[j, col], segment_end[j, col]
+                read_hi[j, col] = lo + np.searchsorted(write_entries[lo:hi], j, side='left')
+        self.read_lo = segment_start
+        self.read_hi = read_hi
+        # total change per item at the end of a run
+        self.item_lo = np.searchsorted(write_items, np.arange(len(self.items)), side='left')
+        self.item_hi = np.searchsorted(write_items, np.arange(len(self.items)), side='right')
+
+    def run(self, ci, seconds):
+        """Run every machine group once over the given seconds, changing ci in place"""
+        start = np.fromiter((ci[x] for x in self.items), dtype=np.int64, count=len(self.items))
+        start = np.append(start, UNLIMITED)
+        start_reads = start[self.read_ids]
+
+        # potential = amount_of_machines * craft_speed * seconds // energy
+        per_craft = np.where(self.energy_is_one, seconds, np.floor_divide(seconds, self.energy))
+        potential = self.rate * per_craft
+        potential_is_float = ~self.rate_is_int | ~(isinstance(seconds, int) & (self.energy_is_one | self.energy_is_int))
+
+        actual, actual_is_float = self.actual(start_reads, potential, potential_is_float)
+        # a round costs about as much as running this many groups one by one
+        round_cost = max(MIN_ROUND_COST, len(self.entries) // 10)
+        settled = 0
+        while True:
+            cumulative = self.cumulative_writes(actual)
+            reads = start_reads + (cumulative[self.read_hi] - cumulative[self.read_lo])
+            new_actual, actual_is_float = self.actual(reads, potential, potential_is_float)
+            changed = np.flatnonzero(new_actual != actual)
+            actual = new_actual
+            if not changed.size:
+                break
+            if changed[0] - settled < round_cost:
+                return self.finish(ci, seconds, changed[0], start, potential, potential_is_float, actual, actual_is_float)
+            settled = changed[0]
+
+        end = start[:-1] + (cumulative[self.item_hi] - cumulative[self.item_lo])
+        for i, x in enumerate(self.items):
+            ci[x] = int(end[i])
+        return self.rates(len(self.entries), potential, potential_is_float, actual, actual_is_float)
+
+    def finish(self, ci, seconds, first, start, potential, potential_is_float, actual, actual_is_float):
+        # groups before first are final, run the rest through the dict engine
+        prefix = actual.copy()
+        prefix[first:] = 0
+        cumulative = self.cumulative_writes(prefix)
+        end = start[:-1] + (cumulative[self.item_hi] - cumulative[self.item_lo])
+        inventory = dict(zip(self.items, end.tolist()))
+        prod_rates = self.rates(first, potential, potential_is_float, actual, actual_is_float)
+        self.plan.run(inventory, seconds, first, prod_rates)
+        for x in self.items:
+            ci[x] = inventory[x]
+        return prod_rates
+
+    def actual(self, reads, potential, potential_is_float):
+        # respect rate limits, min() keeps the first argument on ties
+        headroom = np.maximum(0, self.limit - reads[:, -1])
+        use_headroom = self.has_limit & (headroom < potential)
+        capped = np.where(use_headroom, headroom, potential)
+        capped_is_float = potential_is_float & ~use_headroom
+        # find the bottleneck ingredient ratio and multiply by amount produced by recipe
+        ratios = np.floor_divide(reads[:, :-1], self.bottleneck_amounts)
+        a = ratios.min(axis=1) * self.product_amount
+        use_capped = capped < a
+        actual = np.where(self.miner, potential, np.where(use_capped, capped, a))
+        actual_is_float = np.where(self.miner, potential_is_float, use_capped & capped_is_float)
+        return actual, actual_is_float
+
+    def cumulative_writes(self, actual):
+        writes = np.zeros(self.write_count, dtype=np.int64)
+        # amount needed always rounds up, same as shopping_list()
+        crafts = np.ceil(actual / self.product_amount).astype(np.int64)
+        writes[self.deduct_slot] = -self.deduct_amount * crafts[self.deduct_entry]
+        # enfore integral system - avoid very real issues
+        writes[self.product_slot] = np.trunc(actual).astype(np.int64)
+        return np.concatenate(([0], np.cumsum(writes)))
+
+    def rates(self, count, potential, potential_is_float, actual, actual_is_float):
+        # production rates of the first count groups
+        ids = self.rate_ids[:count]
+        size = len(self.rate_items)
+        potential_sum, actual_sum = np.zeros(size), np.zeros(size)
+        potential_float, actual_float = np.zeros(size, dtype=bool), np.zeros(size, dtype=bool)
+        seen = np.zeros(size, dtype=bool)
+        seen[ids] = True
+        # add.at is unbuffered and goes in entry order, same float rounding as adding one by one
+        np.add.at(potential_sum, ids, potential[:count])
+        np.add.at(actual_sum, ids, actual[:count])
+        np.logical_or.at(potential_float, ids, potential_is_float[:count])
+        np.logical_or.at(actual_float, ids, actual_is_float[:count])
+        prod_rates = defaultdict(lambda: defaultdict(int))
+        for i, item in enumerate(self.rate_items):
+            if not seen[i]:
+                continue
+            rates = prod_rates[item]
+            rates['potential'] = float(potential_sum[i]) if potential_float[i] else int(potential_sum[i])
+            rates['actual'] = float(actual_sum[i]) if actual_float[i] else int(actual_sum[i])
+        return prod_rates
@@ -0,0 +1,106 @@
+"""What a few candidate actions would do to the factory, each tried out on its own fork of the sim"""
+
+from commands import CommandRunner, SIM_COMMANDS
+
+# game seconds the factory runs for at a time after a candidate's commands, like next -s 1
+STEP = 60
+# every candidate is a fork and a run of the factory, so a call only gets so many
+MAX_CANDIDATES = 16
+MAX_COMMANDS = 20
+# game seconds the forks run for at most
+MAX_HORIZON = 60 * 60
+PAST_HORIZON = 'past the horizon'
+
+class CandidateRunner(CommandRunner):
+    """The sim commands, a next that would go past game time end is refused before it runs"""
+    def __init__(self, sim, end):
+        super().__init__(sim, SIM_COMMANDS)
+        self.end = end
+
+    def next(self, args):
+        if self.sim.game_time + args.minutes * 60 > self.end:
+            return 1, PAST_HORIZON
+        return super().next(args)
+
+def parse_candidates(candidates):
+    """A list of candidates, each a script line or a list of them -> a list of lists of lines"""
+    if not isinstance(candidates, list) or not candidates:
+        raise ValueError('expected a list of candidates')
+    if len(candidates) > MAX_CANDIDATES:
+        raise ValueError(f'at most {MAX_CANDIDATES} candidates at a time')
+    out = []
+    for candidate in candidates:
+        lines = [candidate] if isinstance(candidate, str) else candidate
+        if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+            raise ValueError('a candidate is a command, or a list of commands')
+        if len(lines) > MAX_COMMANDS:
+            raise ValueError(f'at most {MAX_COMMANDS} commands in a candidate')
+        out.append(lines)
+    return out
+
+def run(sim, lines, end, step=STEP):
+    """
+    Run lines on sim, then the factory up to game time end. Returns the
+    results of the lines and item -> amount made by the machines since the start.
+    The first line that would take sim past end fails and the rest don't run.
+    """
+    start = sim.game_time
+    runner = CandidateRunner(sim, end)
+    results = []
+    for line in lines:
+        results += runner.run_lines([line])
+        if sim.game_time > end:
+            # mining and crafting take game time too, go back to before the line
+            sim.checkpoints.rewind(game_time=end)
+            results[-1] = (results[-1][0], 1, PAST_HORIZON)
+        if results and results[-1][2] == PAST_HORIZON:
+            break
+    if sim.game_time < end:
+        sim.fast_forward(end - sim.game_time, step)
+    made = {}
+    for sample in sim.series.range('raw', start):
+        for item, fields in sample['items'].items():
+            made[item] = made.get(item, 0) + fields['actual']
+    return results, made
+
+def difference(a, b):
+    # a - b per item, without the items that came out the same
+    diff = {x: a.get(x, 0) - b.get(x, 0) for x in sorted(a.keys() | b.keys())}
+    return {x: d for x, d in diff.items() if d != 0}
+
+def evaluate(sim, candidates, horizon, step=STEP):
+    """
+    Try every candidate, a list of script lines, on its own fork of sim: run
+    its lines, then the factory until horizon seconds after the current game
+    time. Next to a baseline that only runs the factory, every candidate gets
+    what the machines made and the inventory it ends with compared to the
+    baseline. sim itself is left as it was.
+
+    The forks run one after the other. They share the game data and the
+    compiled production plan, so forking costs little more than the inventory.
+    horizon is at most MAX_HORIZON, ValueError otherwise.
+    """
+    if horizon > MAX_HORIZON:
+        raise ValueError(f'the forks run for {MAX_HORIZON // 60} minutes at most')
+    end = sim.game_time + horizon
+    forks = [sim.fork() for _ in range(len(candidates) + 1)]
+    jobs = [[]] + list(candidates)
+    runs = [run(fork, lines, end, step) for fork, lines in zip(forks, jobs)]
+    (_, base_made), base = runs[0], forks[0]
+    base_items = dict(base.current_items)
+    out = []
+    for lines, fork, (results, made) in zip(candidates, forks[1:], runs[1:]):
+        out.append({
+            'commands': lines,
+            'results': [{'command': command, 'res': res, 'msg': msg} for command, res, msg in results],
+            'ok': all(res == 0 for _, res, _ in results),
+            'game_time': fork.game_time,
+            'production': difference(made, base_made),
+            'inventory': difference(fork.current_items, base_items),
+        })
+    return {
+        'game_time': sim.game_time,
+        'horizon': horizon,
+        'baseline': {'game_time': base.game_time, 'production': difference(base_made, {})},
+        'candidates': out,
+    }